@@ -37,6 +37,7 @@ class Configs:
         self.gcn_depth = 2      # GCN的深度
         self.propalpha = 0.05   # 图卷积中的propalpha系数
         self.node_dim = 10      # 节点维度
+        self.period_reuse = 1   # 周期(FFT top-k)复用的batch数, 1表示每个batch都重新计算
 class TriangularCausalMask():
     def __init__(self, B, L, device="cpu"):
         mask_shape = [B, 1, L, L]
@@ -189,21 +190,27 @@ class GraphBlock(nn.Module):
 
         return self.norm(x + out)
 
-def FFT_for_Period(x, k=2):
+def FFT_for_Period(x, k=2, top_list=None):
     # [B, T, C]
+    # everything stays on the device: period and top_list are tensors, top_list can be passed back in to reuse
+    # the frequencies of an earlier batch (only the scale weights are recomputed then)
     xf = torch.fft.rfft(x, dim=1)
-    frequency_list = abs(xf).mean(0).mean(-1)
-    frequency_list[0] = 0
-    _, top_list = torch.topk(frequency_list, k)
-    top_list = top_list.detach().cpu().numpy()
+    amplitude = abs(xf)
+    if top_list is None:
+        frequency_list = amplitude.mean(0).mean(-1)
+        frequency_list[0] = 0
+        _, top_list = torch.topk(frequency_list, k)
     period = x.shape[1] // top_list
-    return period, abs(xf).mean(-1)[:, top_list]
+    return period, amplitude.mean(-1)[:, top_list], top_list
 class ScaleGraphBlock(nn.Module):
     def __init__(self, configs):
         super(ScaleGraphBlock, self).__init__()
         self.seq_len = configs.seq_len
         self.pred_len = configs.pred_len
         self.k = configs.top_k
+        # number of forward calls that share one period detection
+        self.period_reuse = getattr(configs, "period_reuse", 1)
+        self._periods = None
 
         self.att0 = Attention_Block(configs.d_model, configs.d_ff,
                                    n_heads=configs.n_heads, dropout=configs.dropout, activation="gelu")
@@ -215,40 +222,60 @@ class ScaleGraphBlock(nn.Module):
                 GraphBlock(configs.c_out , configs.d_model , configs.conv_channel, configs.skip_channel,
                         configs.gcn_depth , configs.dropout, configs.propalpha ,configs.seq_len,
                            configs.node_dim))
+    def reset_periods(self):
+        """ Forget the cached periods, e.g. at the start of a new window or stream. """
+        self._periods = None
+
+    def _scale_list(self, x):
+        key = (x.shape[1], x.device)
+        if self._periods is not None and self._periods["key"] == key and self._periods["age"] < self.period_reuse:
+            _, scale_weight, _ = FFT_for_Period(x, self.k, top_list=self._periods["top_list"])
+            self._periods["age"] += 1
+            return self._periods["scale_list"], scale_weight
+        period, scale_weight, top_list = FFT_for_Period(x, self.k)
+        # the only host sync: the periods are needed as python ints for the reshapes
+        scale_list = period.tolist()
+        self._periods = dict(key=key, top_list=top_list, scale_list=scale_list, age=1)
+        return scale_list, scale_weight
+
     def forward(self, x):
         B, T, N = x.size()
-        scale_list, scale_weight = FFT_for_Period(x, self.k)
-        res = []
+        scale_list, scale_weight = self._scale_list(x)
+
+        # the graph convolutions are chained, so they run one after another
+        gconv_out = []
         for i in range(self.k):
-            scale = scale_list[i]
-            #Gconv
             x = self.gconv[i](x)
+            gconv_out.append(x)
+
+        # att0 is shared by all scales: scales with the same period are stacked along the batch and run in one call
+        groups = {}
+        for i, scale in enumerate(scale_list):
+            groups.setdefault(scale, []).append(i)
+        res = [None] * self.k
+        for scale, idx in groups.items():
+            out = torch.cat([gconv_out[i] for i in idx], dim=0) if len(idx) > 1 else gconv_out[idx[0]]
             # paddng
-            if (self.seq_len) % scale != 0:
-                length = (((self.seq_len) // scale) + 1) * scale
-                padding = torch.zeros([x.shape[0], (length - (self.seq_len)), x.shape[2]]).to(x.device)
-                out = torch.cat([x, padding], dim=1)
-            else:
-                length = self.seq_len
-                out = x
-            out = out.reshape(B, length // scale, scale, N)
+            length = -(-self.seq_len // scale) * scale
+            if length != self.seq_len:
+                out = F.pad(out, (0, 0, 0, length - self.seq_len))
         #for Mul-attetion
-            out = out.reshape(-1 , scale , N)
+            out = out.reshape(-1, scale, N)
             out = self.norm(self.att0(out))
             out = self.gelu(out)
-            out = out.reshape(B, -1 , scale , N).reshape(B ,-1 ,N)
+            out = out.reshape(len(idx) * B, length, N)
         # #for simpleVIT
         #     out = self.att(out.permute(0, 3, 1, 2).contiguous()) #return
         #     out = out.permute(0, 2, 3, 1).reshape(B, -1 ,N)
 
             out = out[:, :self.seq_len, :]
-            res.append(out)
+            for j, i in enumerate(idx):
+                res[i] = out[j * B:(j + 1) * B]
 
         res = torch.stack(res, dim=-1)
         # adaptive aggregation
         scale_weight = F.softmax(scale_weight, dim=1)
-        scale_weight = scale_weight.unsqueeze(1).unsqueeze(1).repeat(1, T, N, 1)
-        res = torch.sum(res * scale_weight, -1)
+        res = torch.sum(res * scale_weight[:, None, None, :], -1)
         # residual connection
         res = res + x
         return res
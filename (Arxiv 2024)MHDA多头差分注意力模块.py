@@ -89,22 +89,82 @@ class SwiGLU(nn.Module):
         z = self.W1(x)  # Linear part
         # Element-wise multiplication and projection
         return self.W2(g * z)
+class DiffAttentionCache:
+    """
+    Key/value cache of one MultiHeadDifferentialAttention layer for incremental (autoregressive) decoding.
+    K1, K2 and V of all positions seen so far live in preallocated buffers of `capacity` positions that double when
+    they are full, so appending a token is a copy of that token only. Meant for inference (torch.no_grad);
+    call reset() before starting a new sequence.
+    """
+
+    def __init__(self, capacity=256):
+        """
+        Args:
+            capacity (int): Number of positions allocated up front.
+        """
+        self.capacity = capacity
+        self.reset()
+
+    def reset(self):
+        self.length = 0
+        self.k1 = self.k2 = self.v = None
+
+    def _grow(self, buffer, size):
+        grown = buffer.new_empty(*buffer.shape[:2], size, buffer.shape[3])
+        grown[:, :, :self.length] = buffer[:, :, :self.length]
+        return grown
+
+    def append(self, K1, K2, V):
+        """
+        Append the keys/values (batch, num_heads, n, d) of n new positions.
+
+        Returns:
+            (K1, K2, V) of all cached positions, views of the buffers.
+        """
+        n = K1.shape[2]
+        end = self.length + n
+        if self.k1 is None:
+            size = max(self.capacity, n)
+            self.k1, self.k2, self.v = [t.new_empty(*t.shape[:2], size, t.shape[3]) for t in (K1, K2, V)]
+        elif end > self.k1.shape[2]:
+            size = max(2 * self.k1.shape[2], end)
+            self.k1, self.k2, self.v = [self._grow(t, size) for t in (self.k1, self.k2, self.v)]
+        self.k1[:, :, self.length:end] = K1
+        self.k2[:, :, self.length:end] = K2
+        self.v[:, :, self.length:end] = V
+        self.length = end
+        return self.k1[:, :, :end], self.k2[:, :, :end], self.v[:, :, :end]
+
+
 class MultiHeadDifferentialAttention(nn.Module):
     """
     Multi-Head Differential Attention Mechanism.
     Replaces the conventional softmax attention with a differential attention.
     Incorporates a causal mask to ensure autoregressive behavior.
+
+    With impl='sdpa' the two causal softmax(Q_i K_i^T)V products are computed by two scaled_dot_product_attention
+    calls (is_causal=True, no explicit mask) and combined as softmax(A1)V - lambda * softmax(A2)V, which is the same
+    as (softmax(A1) - lambda * softmax(A2))V but never materialises an (N, N) score matrix when a flash /
+    memory-efficient kernel is available. impl='math' is the explicit-mask formulation.
+
+    Passing a DiffAttentionCache to forward decodes incrementally: X only holds the new positions, their keys/values
+    are appended to the cache and their queries attend to all cached positions (causally within X).
     """
 
-    def __init__(self, d_model, num_heads, lambda_init):
+    def __init__(self, d_model, num_heads, lambda_init, impl='auto'):
         """
         Args:
             d_model (int): Dimension of the model. Must be divisible by num_heads.
             num_heads (int): Number of attention heads.
             lambda_init (float): Initial value for lambda.
+            impl (str): 'sdpa', 'math' or 'auto' (sdpa if torch provides scaled_dot_product_attention).
         """
         super().__init__()
         assert d_model % num_heads == 0, "d_model must be divisible by num_heads"
+        assert impl in ('auto', 'sdpa', 'math'), f"unknown impl '{impl}'"
+        if impl == 'auto':
+            impl = 'sdpa' if hasattr(F, 'scaled_dot_product_attention') else 'math'
+        self.impl = impl
 
         self.num_heads = num_heads
         self.d_head = d_model // num_heads
@@ -141,92 +201,113 @@ class MultiHeadDifferentialAttention(nn.Module):
         nn.init.xavier_uniform_(self.W_o.weight)
         nn.init.constant_(self.rms_scale, 1.0)
 
-    def forward(self, X):
+    def _project(self, X):
         """
-        Forward pass for Multi-Head Differential Attention.
-
-        Args:
-            X (Tensor): Input tensor of shape (batch, sequence_length, d_model).
-
-        Returns:
-            Tensor: Output tensor after applying differential attention.
+        Queries, keys and values of X (batch, N, d_model): Q1, Q2, K1, K2 of shape (batch, num_heads, N, d_head)
+        and V of shape (batch, num_heads, N, 2 * d_head).
         """
         batch, N, d_model = X.shape
 
         # Project inputs to queries, keys, and values
-        Q = self.W_q(X)  # Shape: (batch, N, 2 * num_heads * d_head)
-        K = self.W_k(X)  # Shape: (batch, N, 2 * num_heads * d_head)
-        V = self.W_v(X)  # Shape: (batch, N, 2 * num_heads * d_head)
-
         # Reshape and permute for multi-head attention
         # New shape: (batch, num_heads, sequence_length, 2 * d_head)
-        Q = Q.view(batch, N, self.num_heads, 2 * self.d_head).transpose(1, 2)
-        K = K.view(batch, N, self.num_heads, 2 * self.d_head).transpose(1, 2)
-        V = V.view(batch, N, self.num_heads, 2 * self.d_head).transpose(1, 2)
+        Q = self.W_q(X).view(batch, N, self.num_heads, 2 * self.d_head).transpose(1, 2)
+        K = self.W_k(X).view(batch, N, self.num_heads, 2 * self.d_head).transpose(1, 2)
+        V = self.W_v(X).view(batch, N, self.num_heads, 2 * self.d_head).transpose(1, 2)
 
         # Split Q and K into Q1, Q2 and K1, K2
         Q1, Q2 = Q.chunk(2, dim=-1)  # Each of shape: (batch, num_heads, N, d_head)
         K1, K2 = K.chunk(2, dim=-1)  # Each of shape: (batch, num_heads, N, d_head)
+        return Q1, Q2, K1, K2, V
 
-        # Compute lambda using reparameterization
-        # lambda_val = exp(lambda_q1 . lambda_k1) - exp(lambda_q2 . lambda_k2) + lambda_init
-        # Compute dot products for each head
-        # Shape of lambda_val: (num_heads,)
+    def _lambda(self):
+        """
+        lambda_val = exp(lambda_q1 . lambda_k1) - exp(lambda_q2 . lambda_k2) + lambda_init, shape (1, num_heads, 1, 1).
+        """
         lambda_q1_dot_k1 = torch.sum(self.lambda_q1 * self.lambda_k1, dim=-1).float()  # (num_heads,)
         lambda_q2_dot_k2 = torch.sum(self.lambda_q2 * self.lambda_k2, dim=-1).float()  # (num_heads,)
         lambda_val = torch.exp(lambda_q1_dot_k1) - torch.exp(lambda_q2_dot_k2) + self.lambda_init  # (num_heads,)
+        return lambda_val.view(1, -1, 1, 1)
 
-        # Expand lambda_val to match attention dimensions
-        # Shape: (batch, num_heads, 1, 1)
-        lambda_val = lambda_val.unsqueeze(0).unsqueeze(-1).unsqueeze(-1)
-
-        # ------------------- Causal Mask Implementation ------------------- #
-        # Create a causal mask to prevent attention to future tokens
-        # Shape of mask: (1, 1, N, N)
-        mask = torch.tril(torch.ones((N, N), device=X.device)).unsqueeze(0).unsqueeze(0)  # (1, 1, N, N)
-        # Replace 1s with 0.0 and 0s with -inf
-        mask = mask.masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, 0.0)
-        # -------------------------------------------------------------------- #
+    def _attention_math(self, Q1, Q2, K1, K2, V, lambda_val):
+        N, M = Q1.shape[2], K1.shape[2]
+        # Causal mask: query i is position M - N + i, 0 on and below that diagonal, -inf above, shape (N, M)
+        mask = torch.full((N, M), float('-inf'), device=Q1.device, dtype=Q1.dtype).triu(M - N + 1)
 
         # Compute attention scores
         scaling = 1 / math.sqrt(self.d_head)
-        A1 = torch.matmul(Q1, K1.transpose(-2, -1)) * scaling  # (batch, num_heads, N, N)
-        A2 = torch.matmul(Q2, K2.transpose(-2, -1)) * scaling  # (batch, num_heads, N, N)
-
-        # Apply the causal mask
-        A1 = A1 + mask  # Mask out future positions
-        A2 = A2 + mask  # Mask out future positions
+        A1 = torch.matmul(Q1, K1.transpose(-2, -1)) * scaling + mask  # (batch, num_heads, N, N)
+        A2 = torch.matmul(Q2, K2.transpose(-2, -1)) * scaling + mask  # (batch, num_heads, N, N)
 
         # Apply softmax to get attention weights
-        attention1 = F.softmax(A1, dim=-1)  # (batch, num_heads, N, N)
-        attention2 = F.softmax(A2, dim=-1)  # (batch, num_heads, N, N)
-        attention = attention1 - lambda_val * attention2  # (batch, num_heads, N, N)
+        attention = F.softmax(A1, dim=-1) - lambda_val * F.softmax(A2, dim=-1)  # (batch, num_heads, N, N)
 
         # Apply attention weights to values
-        O = torch.matmul(attention, V)  # (batch, num_heads, N, 2 * d_head)
-
+        return torch.matmul(attention, V)  # (batch, num_heads, N, 2 * d_head)
+
+    def _attention_sdpa(self, Q1, Q2, K1, K2, V, lambda_val):
+        # the attention is linear in its weights: (softmax(A1) - lambda * softmax(A2)) V
+        # = softmax(A1) V - lambda * softmax(A2) V, so each map goes through one (causal, fused) SDPA call
+        N, M = Q1.shape[2], K1.shape[2]
+        if N == M:
+            mask, causal = None, True
+        elif N == 1:
+            # a single new query sees every cached position
+            mask, causal = None, False
+        else:
+            # is_causal aligns the diagonal top-left, the new queries are the last N of M positions
+            mask, causal = torch.ones(N, M, dtype=torch.bool, device=Q1.device).tril(M - N), False
+        # Flash attention (CUDA and the fused CPU kernel) needs one head dim for q, k and v: V is split into its two
+        # d_head halves, stacked along the batch dim, and Q_i/K_i are repeated to match, so each call stays fused
+        V_halves = torch.cat(V.chunk(2, dim=-1), dim=0)  # (2 * batch, num_heads, M, d_head)
+
+        def attend(Q, K):  # softmax(Q K^T / sqrt(d_head)) V, (batch, num_heads, N, 2 * d_head)
+            O = F.scaled_dot_product_attention(Q.repeat(2, 1, 1, 1), K.repeat(2, 1, 1, 1), V_halves,
+                                               attn_mask=mask, is_causal=causal)
+            return torch.cat(O.chunk(2, dim=0), dim=-1)
+
+        O1 = attend(Q1, K1)
+        O2 = attend(Q2, K2)
+        return O1 - lambda_val.to(O2.dtype) * O2
+
+    def _merge_heads(self, O):
+        """
+        Per-head RMSNorm, (1 - lambda_init) scaling, concatenation of the heads and the output projection of
+        O (batch, num_heads, N, 2 * d_head).
+        """
+        batch, _, N, _ = O.shape
         # Normalize each head independently using RMSNorm
-        # First, reshape for RMSNorm
-        O_reshaped = O.contiguous().view(batch * self.num_heads, N, 2 * self.d_head)  # (batch*num_heads, N, 2*d_head)
-
-        # Compute RMSNorm
-        rms_norm = torch.sqrt(O_reshaped.pow(2).mean(dim=-1, keepdim=True) + self.eps)  # (batch*num_heads, N, 1)
-        O_normalized = (O_reshaped / rms_norm) * self.rms_scale  # (batch*num_heads, N, 2*d_head)
-
-        # Reshape back to (batch, num_heads, N, 2 * d_head)
-        O_normalized = O_normalized.view(batch, self.num_heads, N, 2 * self.d_head)
+        rms_norm = torch.sqrt(O.pow(2).mean(dim=-1, keepdim=True) + self.eps)  # (batch, num_heads, N, 1)
+        O_normalized = (O / rms_norm) * self.rms_scale  # (batch, num_heads, N, 2*d_head)
 
         # Scale the normalized output
         O_normalized = O_normalized * (1 - self.lambda_init)  # Scalar scaling
 
         # Concatenate all heads
         # New shape: (batch, N, num_heads * 2 * d_head)
-        O_concat = O_normalized.transpose(1, 2).contiguous().view(batch, N, self.num_heads * 2 * self.d_head)
+        O_concat = O_normalized.transpose(1, 2).reshape(batch, N, self.num_heads * 2 * self.d_head)
 
         # Final linear projection
-        out = self.W_o(O_concat)  # (batch, N, d_model)
+        return self.W_o(O_concat)  # (batch, N, d_model)
 
-        return out
+    def forward(self, X, cache=None):
+        """
+        Forward pass for Multi-Head Differential Attention.
+
+        Args:
+            X (Tensor): Input tensor of shape (batch, sequence_length, d_model).
+            cache (DiffAttentionCache, optional): Keys/values of the previous positions; X then holds the new
+                positions only and the cache is extended with them.
+
+        Returns:
+            Tensor: Output tensor after applying differential attention.
+        """
+        Q1, Q2, K1, K2, V = self._project(X)
+        if cache is not None:
+            K1, K2, V = cache.append(K1, K2, V)
+        attention = self._attention_sdpa if self.impl == 'sdpa' else self._attention_math
+        O = attention(Q1, Q2, K1, K2, V, self._lambda())  # (batch, num_heads, N, 2 * d_head)
+        return self._merge_heads(O)
 
 
 class DiffTransformerLayer(nn.Module):
@@ -235,31 +316,34 @@ class DiffTransformerLayer(nn.Module):
     Consists of Multi-Head Differential Attention followed by a SwiGLU Feed-Forward Network.
     """
 
-    def __init__(self, d_model, num_heads, lambda_init):
+    def __init__(self, d_model, num_heads, lambda_init, impl='auto'):
         """
         Args:
             d_model (int): Dimension of the model.
             num_heads (int): Number of attention heads.
             lambda_init (float): Initial value for lambda in Differential Attention.
+            impl (str): Attention backend of MultiHeadDifferentialAttention ('auto', 'sdpa' or 'math').
         """
         super().__init__()
         self.norm1 = RMSNorm(d_model)
-        self.attn = MultiHeadDifferentialAttention(d_model, num_heads, lambda_init)
+        self.attn = MultiHeadDifferentialAttention(d_model, num_heads, lambda_init, impl=impl)
         self.norm2 = RMSNorm(d_model)
         self.ff = SwiGLU(d_model)
 
-    def forward(self, x):
+    def forward(self, x, cache=None):
         """
         Forward pass for a single transformer layer.
 
         Args:
             x (Tensor): Input tensor of shape (batch, sequence_length, d_model).
+            cache (DiffAttentionCache, optional): Attention cache of this layer for incremental decoding; x then
+                holds the new positions only (RMSNorm and SwiGLU are position-wise and only see those).
 
         Returns:
             Tensor: Output tensor after processing through the layer.
         """
         # Apply Multi-Head Differential Attention with residual connection
-        y = self.attn(self.norm1(x)) + x
+        y = self.attn(self.norm1(x), cache=cache) + x
         # Apply SwiGLU Feed-Forward Network with residual connection
         z = self.ff(self.norm2(y)) + y
         return z
@@ -289,3 +373,34 @@ if __name__ == '__main__':
     print('NLP_MHDA_input size:', input.size())
     print('NLP_MHDA_output size:', output.size())
 
+    # SDPA 后端（两次因果 scaled_dot_product_attention，不显式构造 N×N 掩码与注意力图）与显式掩码实现结果一致
+    if hasattr(F, 'scaled_dot_product_attention'):
+        with torch.no_grad():
+            MHDA.impl = 'math'
+            ref = MHDA(input)
+            MHDA.impl = 'sdpa'
+            out = MHDA(input)
+        assert torch.allclose(ref, out, rtol=1e-4, atol=1e-4), (ref - out).abs().max()
+
+        # 长序列：q/k/v 头维度一致，SDPA 可走 flash 内核（显存随 N 线性增长），结果仍与显式实现一致
+        long_mhda = MultiHeadDifferentialAttention(d_model=64, num_heads=4, lambda_init=0.8, impl='math')
+        long_input = torch.randn(1, 4096, 64)
+        with torch.no_grad():
+            ref = long_mhda(long_input)
+            long_mhda.impl = 'sdpa'
+            out = long_mhda(long_input)
+        assert torch.allclose(ref, out, rtol=1e-4, atol=1e-4), (ref - out).abs().max()
+
+    # 增量解码：每层一个 DiffAttentionCache，每步只输入新 token，结果与整段因果前向一致
+    layer = DiffTransformerLayer(d_model=64, num_heads=4, lambda_init=0.8)
+    seq = torch.randn(2, 20, 64)
+    with torch.no_grad():
+        ref = layer(seq)
+        for impl in ('math', 'sdpa') if hasattr(F, 'scaled_dot_product_attention') else ('math',):
+            layer.attn.impl = impl
+            cache = DiffAttentionCache(capacity=4)  # 容量不足时自动扩容
+            outs = [layer(seq[:, :5], cache=cache)]  # 先输入前缀
+            outs += [layer(seq[:, i:i + 1], cache=cache) for i in range(5, 12)]  # 逐 token 解码
+            outs.append(layer(seq[:, 12:], cache=cache))  # 一次输入多个新 token
+            out = torch.cat(outs, dim=1)
+            assert torch.allclose(ref, out, rtol=1e-4, atol=1e-4), (impl, (ref - out).abs().max())
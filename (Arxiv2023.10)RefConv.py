@@ -6,35 +6,101 @@ from torch.nn import functional as F
 class RepConv(nn.Module):
 
     def __init__(self, in_channels, out_channels, kernel_size, stride, padding=None, groups=1,
-                 map_k=3):
+                 map_k=3, bias=False, deploy=False):
         super(RepConv, self).__init__()
         assert map_k <= kernel_size
+        self.in_channels = in_channels
+        self.out_channels = out_channels
         self.origin_kernel_shape = (out_channels, in_channels // groups, kernel_size, kernel_size)
+        # in deploy mode this buffer holds the refocused kernel, so the state_dict matches a plain nn.Conv2d
         self.register_buffer('weight', torch.zeros(*self.origin_kernel_shape))
         G = in_channels * out_channels // (groups ** 2)
         self.num_2d_kernels = out_channels * in_channels // groups
         self.kernel_size = kernel_size
-        self.convmap = nn.Conv2d(in_channels=self.num_2d_kernels,
-                                 out_channels=self.num_2d_kernels, kernel_size=map_k, stride=1, padding=map_k // 2,
-                                 groups=G, bias=False)
+        self.deploy = deploy
+        if not deploy:
+            self.convmap = nn.Conv2d(in_channels=self.num_2d_kernels,
+                                     out_channels=self.num_2d_kernels, kernel_size=map_k, stride=1, padding=map_k // 2,
+                                     groups=G, bias=False)
         # nn.init.zeros_(self.convmap.weight)
-        self.bias = None  # nn.Parameter(torch.zeros(out_channels), requires_grad=True)     # must have a bias for identical initialization
+        # must have a bias for identical initialization
+        self.bias = nn.Parameter(torch.zeros(out_channels), requires_grad=True) if bias else None
         self.stride = stride
         self.groups = groups
         if padding is None:
             padding = kernel_size // 2
         self.padding = padding
 
-    def forward(self, inputs):
+    def get_equivalent_kernel(self):
+        if self.deploy:
+            return self.weight
         origin_weight = self.weight.view(1, self.num_2d_kernels, self.kernel_size, self.kernel_size)
-        kernel = self.weight + self.convmap(origin_weight).view(*self.origin_kernel_shape)
+        return self.weight + self.convmap(origin_weight).view(*self.origin_kernel_shape)
+
+    def forward(self, inputs):
+        kernel = self.get_equivalent_kernel()
         return F.conv2d(inputs, kernel, stride=self.stride, padding=self.padding, dilation=1, groups=self.groups,
                         bias=self.bias)
 
+    @torch.no_grad()
+    def switch_to_deploy(self):
+        """ Freeze the refocused kernel into the weight buffer and drop convmap (same as RepConv(..., deploy=True)). """
+        if self.deploy:
+            return self
+        self.weight.copy_(self.get_equivalent_kernel())
+        del self.convmap
+        self.deploy = True
+        if self.bias is not None:
+            self.bias.requires_grad_(False)
+        return self
+
+    @torch.no_grad()
+    def to_conv2d(self):
+        """ Plain nn.Conv2d with the refocused kernel; its state_dict has the same keys as a deployed RepConv. """
+        conv = nn.Conv2d(self.in_channels, self.out_channels, self.kernel_size, stride=self.stride,
+                         padding=self.padding, groups=self.groups, bias=self.bias is not None)
+        conv = conv.to(device=self.weight.device, dtype=self.weight.dtype)
+        conv.weight.copy_(self.get_equivalent_kernel())
+        if self.bias is not None:
+            conv.bias.copy_(self.bias)
+        conv.requires_grad_(False)
+        return conv
+
+
+def convert_refconv(model, to_conv2d=True):
+    """
+    Convert every RepConv (RefConv) in model for inference, in place, and return the model.
+
+    to_conv2d=True replaces each RepConv with a plain nn.Conv2d, False keeps the RepConv modules in deploy mode
+    (their state_dict then loads into a model built with RepConv(..., deploy=True)).
+    """
+    if isinstance(model, RepConv):
+        return model.to_conv2d() if to_conv2d else model.switch_to_deploy()
+    for name, child in model.named_children():
+        if isinstance(child, RepConv):
+            setattr(model, name, child.to_conv2d() if to_conv2d else child.switch_to_deploy())
+        else:
+            convert_refconv(child, to_conv2d)
+    return model
+
 
 # 输入 N C H W,  输出 N C H W
 if __name__ == '__main__':
-    block = RepConv(64, 64, kernel_size=3, stride=1).cuda()
-    input = torch.rand(3, 64, 64, 64).cuda()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    block = RepConv(64, 64, kernel_size=3, stride=1).to(device)
+    input = torch.rand(3, 64, 64, 64).to(device)
     output = block(input)
     print(input.size(), output.size())
+
+    # 部署模式：重聚焦后的卷积核只计算一次，前后输出一致，且 state_dict 可以和普通 nn.Conv2d 互相加载
+    nn.init.normal_(block.weight)
+    model = nn.Sequential(block, nn.ReLU(), RepConv(64, 32, kernel_size=3, stride=2, bias=True)).to(device).eval()
+    with torch.no_grad():
+        before = model(input)
+        after = convert_refconv(model)(input)
+    assert torch.allclose(before, after, rtol=1e-4, atol=1e-4), (before - after).abs().max()
+    deploy_block = RepConv(64, 32, kernel_size=3, stride=2, bias=True, deploy=True).to(device)
+    deploy_block.load_state_dict(model[2].state_dict())
+    with torch.no_grad():
+        assert torch.allclose(deploy_block(input), model[2](input))
+    print('deploy max abs diff:', (before - after).abs().max().item())
@@ -23,6 +23,31 @@ TKSA模块对传统Transformer中的自注意力机制进行了改进。
              图像超分辨率任务等计算机视觉CV任务通用的即插即用模块
 '''
 
+# top-k fractions (numerator, denominator) of the four sparse attentions, k = int(C * num / den)
+TOPK_RATIOS = ((1, 2), (2, 3), (3, 4), (4, 5))
+
+
+def topk_sparse_attention(attn, weights, ratios=TOPK_RATIOS):
+    """
+    sum_i weights[i] * softmax(attn restricted to the top k_i scores of each row) as one (..., C, C) matrix.
+
+    One sort per row replaces the topk + scatter mask + where(-inf) of every k: with the row sorted in descending
+    order (s_0 >= s_1 >= ...), the i-th masked softmax of the element of rank r is exp(s_r - s_0) / Z_i for r < k_i
+    and 0 otherwise, where Z_i is the prefix sum of exp(s - s_0) at k_i - 1.
+    """
+    C = attn.shape[-1]
+    ks = [int(C * num / den) for num, den in ratios]
+    sorted_attn, index = attn.sort(dim=-1, descending=True)
+    sorted_exp = torch.exp(sorted_attn - sorted_attn[..., :1])
+    normaliser = sorted_exp.cumsum(dim=-1)[..., [k - 1 for k in ks]]  # (..., len(ks))
+    coeff = torch.cat([w.reshape(-1) for w in weights]).to(attn.dtype) / normaliser
+    # rank r < k_i indicator, (len(ks), C); coeff @ steps gives the summed weight of every rank
+    steps = (torch.arange(C, device=attn.device) < torch.tensor(ks, device=attn.device)[:, None]).to(attn.dtype)
+    sorted_weights = sorted_exp * (coeff @ steps)
+    # index is a permutation of every row, so each entry is written exactly once
+    return torch.empty_like(attn).scatter(-1, index, sorted_weights)
+
+
 class TKSA(nn.Module):
     def __init__(self, dim, num_heads=8, bias=False):
         super(TKSA, self).__init__()
@@ -53,42 +78,11 @@ class TKSA(nn.Module):
         q = torch.nn.functional.normalize(q, dim=-1)
         k = torch.nn.functional.normalize(k, dim=-1)
 
-        _, _, C, _ = q.shape
-
-        mask1 = torch.zeros(b, self.num_heads, C, C, device=x.device, requires_grad=False)
-        mask2 = torch.zeros(b, self.num_heads, C, C, device=x.device, requires_grad=False)
-        mask3 = torch.zeros(b, self.num_heads, C, C, device=x.device, requires_grad=False)
-        mask4 = torch.zeros(b, self.num_heads, C, C, device=x.device, requires_grad=False)
-
         attn = (q @ k.transpose(-2, -1)) * self.temperature
+        # the four top-k softmaxes (k = C/2, 2C/3, 3C/4, 4C/5) weighted by attn1..attn4 as one matrix
+        attn = topk_sparse_attention(attn, (self.attn1, self.attn2, self.attn3, self.attn4))
 
-        index = torch.topk(attn, k=int(C/2), dim=-1, largest=True)[1]
-        mask1.scatter_(-1, index, 1.)
-        attn1 = torch.where(mask1 > 0, attn, torch.full_like(attn, float('-inf')))
-
-        index = torch.topk(attn, k=int(C*2/3), dim=-1, largest=True)[1]
-        mask2.scatter_(-1, index, 1.)
-        attn2 = torch.where(mask2 > 0, attn, torch.full_like(attn, float('-inf')))
-
-        index = torch.topk(attn, k=int(C*3/4), dim=-1, largest=True)[1]
-        mask3.scatter_(-1, index, 1.)
-        attn3 = torch.where(mask3 > 0, attn, torch.full_like(attn, float('-inf')))
-
-        index = torch.topk(attn, k=int(C*4/5), dim=-1, largest=True)[1]
-        mask4.scatter_(-1, index, 1.)
-        attn4 = torch.where(mask4 > 0, attn, torch.full_like(attn, float('-inf')))
-
-        attn1 = attn1.softmax(dim=-1)
-        attn2 = attn2.softmax(dim=-1)
-        attn3 = attn3.softmax(dim=-1)
-        attn4 = attn4.softmax(dim=-1)
-
-        out1 = (attn1 @ v)
-        out2 = (attn2 @ v)
-        out3 = (attn3 @ v)
-        out4 = (attn4 @ v)
-
-        out = out1 * self.attn1 + out2 * self.attn2 + out3 * self.attn3 + out4 * self.attn4
+        out = (attn @ v)
 
         out = rearrange(out, 'b head c (h w) -> b (head c) h w', head=self.num_heads, h=h, w=w)
 
@@ -151,42 +145,11 @@ class TKESA(nn.Module):
         q = torch.nn.functional.normalize(q, dim=-1)
         k = torch.nn.functional.normalize(k, dim=-1)
 
-        _, _, C, _ = q.shape
-
-        mask1 = torch.zeros(b, self.num_heads, C, C, device=x.device, requires_grad=False)
-        mask2 = torch.zeros(b, self.num_heads, C, C, device=x.device, requires_grad=False)
-        mask3 = torch.zeros(b, self.num_heads, C, C, device=x.device, requires_grad=False)
-        mask4 = torch.zeros(b, self.num_heads, C, C, device=x.device, requires_grad=False)
-
         attn = (q @ k.transpose(-2, -1)) * self.temperature
+        # the four top-k softmaxes (k = C/2, 2C/3, 3C/4, 4C/5) weighted by attn1..attn4 as one matrix
+        attn = topk_sparse_attention(attn, (self.attn1, self.attn2, self.attn3, self.attn4))
 
-        index = torch.topk(attn, k=int(C/2), dim=-1, largest=True)[1]
-        mask1.scatter_(-1, index, 1.)
-        attn1 = torch.where(mask1 > 0, attn, torch.full_like(attn, float('-inf')))
-
-        index = torch.topk(attn, k=int(C*2/3), dim=-1, largest=True)[1]
-        mask2.scatter_(-1, index, 1.)
-        attn2 = torch.where(mask2 > 0, attn, torch.full_like(attn, float('-inf')))
-
-        index = torch.topk(attn, k=int(C*3/4), dim=-1, largest=True)[1]
-        mask3.scatter_(-1, index, 1.)
-        attn3 = torch.where(mask3 > 0, attn, torch.full_like(attn, float('-inf')))
-
-        index = torch.topk(attn, k=int(C*4/5), dim=-1, largest=True)[1]
-        mask4.scatter_(-1, index, 1.)
-        attn4 = torch.where(mask4 > 0, attn, torch.full_like(attn, float('-inf')))
-
-        attn1 = attn1.softmax(dim=-1)
-        attn2 = attn2.softmax(dim=-1)
-        attn3 = attn3.softmax(dim=-1)
-        attn4 = attn4.softmax(dim=-1)
-
-        out1 = (attn1 @ v)
-        out2 = (attn2 @ v)
-        out3 = (attn3 @ v)
-        out4 = (attn4 @ v)
-
-        out = out1 * self.attn1 + out2 * self.attn2 + out3 * self.attn3 + out4 * self.attn4
+        out = (attn @ v)
 
         out = rearrange(out, 'b head c (h w) -> b (head c) h w', head=self.num_heads, h=h, w=w)
 
@@ -199,6 +162,16 @@ if __name__ == "__main__":
     output = tksa(input)
     print('input_size:', input.size())
     print('output_size:', output.size())
+
+    # 与原始的 topk + mask + where(-inf) + 四次 softmax 写法一致
+    attn = torch.randn(2, 8, 12, 12)
+    weights = [torch.rand(1) for _ in range(4)]
+    ref = 0
+    for (num, den), weight in zip(TOPK_RATIOS, weights):
+        index = torch.topk(attn, k=int(12 * num / den), dim=-1)[1]
+        mask = torch.zeros_like(attn).scatter_(-1, index, 1.)
+        ref = ref + torch.where(mask > 0, attn, torch.full_like(attn, float('-inf'))).softmax(dim=-1) * weight
+    assert torch.allclose(topk_sparse_attention(attn, weights), ref, atol=1e-6)
     tkesa = TKESA(32)
     output = tkesa(input)
     print('input_size:', input.size())
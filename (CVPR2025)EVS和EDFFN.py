@@ -13,6 +13,7 @@ except ImportError as e:
 from torchvision.transforms.functional import resize, to_pil_image  # type: ignore
 import warnings
 from ultralytics.nn.modules import C2f, C3
+from tile_util import merge_tiles, split_tiles, tiled_apply
 
 warnings.filterwarnings('ignore')
 def to_3d(x):
@@ -298,7 +299,8 @@ class SS2D(nn.Module):
 ##########################################################################
 
 class EVSblock(nn.Module):
-    def __init__(self, dim, ffn_expansion_factor=3, bias=False, LayerNorm_type='WithBias', att=True, idx=3, patch=128):
+    def __init__(self, dim, ffn_expansion_factor=3, bias=False, LayerNorm_type='WithBias', att=True, idx=3, patch=128,
+                 max_tiles=None):
         super(EVSblock, self).__init__()
 
         self.att = att
@@ -311,64 +313,15 @@ class EVSblock(nn.Module):
         self.ffn = EDFFN(dim, ffn_expansion_factor, bias)
 
         self.kernel_size = (patch, patch)
+        # tiles processed at once (each with the whole batch), None = all; bounds the memory on large images
+        self.max_tiles = max_tiles
 
     def grids(self, x):
-        b, c, h, w = x.shape
-        self.original_size = (b, c, h, w)
-        # assert b == 1
-        k1, k2 = self.kernel_size
-        k1 = min(h, k1)
-        k2 = min(w, k2)
-        num_row = (h - 1) // k1 + 1
-        num_col = (w - 1) // k2 + 1
-        self.nr = num_row
-        self.nc = num_col
-
-        import math
-        step_j = k2 if num_col == 1 else math.ceil((w - k2) / (num_col - 1) - 1e-8)
-        step_i = k1 if num_row == 1 else math.ceil((h - k1) / (num_row - 1) - 1e-8)
-
-        parts = []
-        idxes = []
-        i = 0  # 0~h-1
-        last_i = False
-        while i < h and not last_i:
-            j = 0
-            if i + k1 >= h:
-                i = h - k1
-                last_i = True
-            last_j = False
-            while j < w and not last_j:
-                if j + k2 >= w:
-                    j = w - k2
-                    last_j = True
-                parts.append(x[:, :, i:i + k1, j:j + k2])
-                idxes.append({'i': i, 'j': j})
-                j = j + step_j
-            i = i + step_i
-
-        parts = torch.cat(parts, dim=0)
-        self.idxes = idxes
-        return parts
-
-    def grids_inverse(self, outs):
-        preds = torch.zeros(self.original_size).to(outs.device)
-        b, c, h, w = self.original_size
-
-        count_mt = torch.zeros((b, 1, h, w)).to(outs.device)
-        k1, k2 = self.kernel_size
-        k1 = min(h, k1)
-        k2 = min(w, k2)
-
-        for cnt, each_idx in enumerate(self.idxes):
-            i = each_idx['i']
-            j = each_idx['j']
-            preds[0, :, i:i + k1, j:j + k2] += outs[cnt, :, :, :]
-            count_mt[0, 0, i:i + k1, j:j + k2] += 1.
-
-        del outs
-        torch.cuda.empty_cache()
-        return preds / count_mt
+        # stateless: returns the (n * b, c, k1, k2) tiles, see tile_util
+        return split_tiles(x, self.kernel_size)
+
+    def grids_inverse(self, outs, original_size):
+        return merge_tiles(outs, original_size, self.kernel_size)
 
     def forward(self, x):
         if self.idx % 2 == 1:
@@ -380,13 +333,15 @@ class EVSblock(nn.Module):
         #            if self.idx % 4 == 0:
         #                x = torch.transpose(x, dim0=-2, dim1=-1).contiguous()
 
-        x = self.grids(x)
-        x = x + self.attn(self.norm1(x))
-        x = self.grids_inverse(x)
+        x = tiled_apply(self._attn_tile, x, self.kernel_size, self.max_tiles)
 
         return x
+
+    def _attn_tile(self, x):
+        return x + self.attn(self.norm1(x))
 class EVSS(nn.Module):
-    def __init__(self, dim, ffn_expansion_factor=3, bias=False, LayerNorm_type='WithBias', att=False, idx=3, patch=128):
+    def __init__(self, dim, ffn_expansion_factor=3, bias=False, LayerNorm_type='WithBias', att=False, idx=3, patch=128,
+                 max_tiles=None):
         super(EVSS, self).__init__()
 
         self.att = att
@@ -399,64 +354,15 @@ class EVSS(nn.Module):
         self.ffn = EDFFN(dim, ffn_expansion_factor, bias)
 
         self.kernel_size = (patch, patch)
+        # tiles processed at once (each with the whole batch), None = all; bounds the memory on large images
+        self.max_tiles = max_tiles
 
     def grids(self, x):
-        b, c, h, w = x.shape
-        self.original_size = (b, c, h, w)
-        # assert b == 1
-        k1, k2 = self.kernel_size
-        k1 = min(h, k1)
-        k2 = min(w, k2)
-        num_row = (h - 1) // k1 + 1
-        num_col = (w - 1) // k2 + 1
-        self.nr = num_row
-        self.nc = num_col
-
-        import math
-        step_j = k2 if num_col == 1 else math.ceil((w - k2) / (num_col - 1) - 1e-8)
-        step_i = k1 if num_row == 1 else math.ceil((h - k1) / (num_row - 1) - 1e-8)
-
-        parts = []
-        idxes = []
-        i = 0  # 0~h-1
-        last_i = False
-        while i < h and not last_i:
-            j = 0
-            if i + k1 >= h:
-                i = h - k1
-                last_i = True
-            last_j = False
-            while j < w and not last_j:
-                if j + k2 >= w:
-                    j = w - k2
-                    last_j = True
-                parts.append(x[:, :, i:i + k1, j:j + k2])
-                idxes.append({'i': i, 'j': j})
-                j = j + step_j
-            i = i + step_i
-
-        parts = torch.cat(parts, dim=0)
-        self.idxes = idxes
-        return parts
-
-    def grids_inverse(self, outs):
-        preds = torch.zeros(self.original_size).to(outs.device)
-        b, c, h, w = self.original_size
-
-        count_mt = torch.zeros((b, 1, h, w)).to(outs.device)
-        k1, k2 = self.kernel_size
-        k1 = min(h, k1)
-        k2 = min(w, k2)
-
-        for cnt, each_idx in enumerate(self.idxes):
-            i = each_idx['i']
-            j = each_idx['j']
-            preds[0, :, i:i + k1, j:j + k2] += outs[cnt, :, :, :]
-            count_mt[0, 0, i:i + k1, j:j + k2] += 1.
-
-        del outs
-        torch.cuda.empty_cache()
-        return preds / count_mt
+        # stateless: returns the (n * b, c, k1, k2) tiles, see tile_util
+        return split_tiles(x, self.kernel_size)
+
+    def grids_inverse(self, outs, original_size):
+        return merge_tiles(outs, original_size, self.kernel_size)
 
     def forward(self, x):
         if self.att:
@@ -470,13 +376,14 @@ class EVSS(nn.Module):
             #            if self.idx % 4 == 0:
             #                x = torch.transpose(x, dim0=-2, dim1=-1).contiguous()
 
-            x = self.grids(x)
-            x = x + self.attn(self.norm1(x))
-            x = self.grids_inverse(x)
+            x = tiled_apply(self._attn_tile, x, self.kernel_size, self.max_tiles)
 
         x = x + self.ffn(self.norm2(x))
 
         return x
+
+    def _attn_tile(self, x):
+        return x + self.attn(self.norm1(x))
 if __name__ == '__main__':
     block = EVSS(64,att=True).to('cuda')
     input = torch.rand(1, 64, 32, 32).to('cuda')
@@ -494,4 +401,17 @@ if __name__ == '__main__':
     input = torch.rand(1, 64, 32, 32).to('cuda')
     output = block(input)
     print('EDFFN input_size:', input.size())
-    print('EDFFN output_size:', output.size())
\ No newline at end of file
+    print('EDFFN output_size:', output.size())
+    # 分块推理：支持 batch > 1，max_tiles 限制同时处理的块数（大图省显存），结果与一次处理全部块一致
+    block = EVSblock(64, patch=24).to('cuda').eval()
+    input = torch.rand(2, 64, 40, 40).to('cuda')
+    with torch.no_grad():
+        full = block(input)
+        block.max_tiles = 1
+        streamed = block(input)
+        # batch = 2：与显式的 split_tiles -> 逐块处理 -> merge_tiles 结果一致（EVSblock(idx=3) 先翻转输入）
+        flipped = torch.flip(input, dims=(-2, -1))
+        reference = merge_tiles(block._attn_tile(split_tiles(flipped, block.kernel_size)), flipped.shape,
+                                block.kernel_size)
+    assert torch.allclose(full, streamed, atol=1e-5), (full - streamed).abs().max()
+    assert torch.allclose(full, reference, atol=1e-5), (full - reference).abs().max()
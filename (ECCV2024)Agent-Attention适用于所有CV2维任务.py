@@ -56,6 +56,60 @@ class AgentAttention(nn.Module):
         pool_size = int(agent_num ** 0.5)
         self.pool = nn.AdaptiveAvgPool2d(output_size=(pool_size, pool_size))
         self.softmax = nn.Softmax(dim=-1)
+        self.deploy = False
+        # (key, biases) of the last interpolated position biases, reused while no gradient is needed
+        self._bias_cache = None
+
+    def _bias_parameters(self):
+        return self.an_bias, self.na_bias, self.ah_bias, self.aw_bias, self.ha_bias, self.wa_bias
+
+    def _compute_position_biases(self):
+        num_heads = self.num_heads
+        kv_size = (self.window_size[0] // self.sr_ratio, self.window_size[1] // self.sr_ratio)
+        position_bias1 = nn.functional.interpolate(self.an_bias, size=kv_size, mode='bilinear')
+        position_bias1 = position_bias1.reshape(1, num_heads, self.agent_num, -1)
+        position_bias2 = (self.ah_bias + self.aw_bias).reshape(1, num_heads, self.agent_num, -1)
+        position_bias = position_bias1 + position_bias2
+
+        agent_bias1 = nn.functional.interpolate(self.na_bias, size=self.window_size, mode='bilinear')
+        agent_bias1 = agent_bias1.reshape(1, num_heads, self.agent_num, -1).permute(0, 1, 3, 2)
+        agent_bias2 = (self.ha_bias + self.wa_bias).reshape(1, num_heads, -1, self.agent_num)
+        agent_bias = agent_bias1 + agent_bias2
+        return position_bias, agent_bias
+
+    def position_biases(self):
+        """
+        (agent -> key bias (1, nH, agent_num, N_kv), query -> agent bias (1, nH, N, agent_num)), broadcast over the
+        batch. They only depend on the bias parameters and the window size, so they are cached while no gradient is
+        needed; the key holds the parameter versions, so in-place updates (optimizer steps, load_state_dict) and
+        device/dtype moves invalidate the cache.
+        """
+        if self.deploy:
+            return self.position_bias, self.agent_bias
+        params = self._bias_parameters()
+        if torch.is_grad_enabled() and any(p.requires_grad for p in params):
+            return self._compute_position_biases()
+        key = (self.window_size, self.sr_ratio, self.an_bias.device, self.an_bias.dtype,
+               tuple(p._version for p in params))
+        if self._bias_cache is None or self._bias_cache[0] != key:
+            self._bias_cache = (key, self._compute_position_biases())
+        return self._bias_cache[1]
+
+    @torch.no_grad()
+    def switch_to_deploy(self):
+        """ Export mode: bake the position biases of the fixed window size into buffers and drop the bias parameters. """
+        if self.deploy:
+            return self
+        position_bias, agent_bias = self._compute_position_biases()
+        for name in ('an_bias', 'na_bias', 'ah_bias', 'aw_bias', 'ha_bias', 'wa_bias'):
+            delattr(self, name)
+        self.register_buffer('position_bias', position_bias.contiguous())
+        self.register_buffer('agent_bias', agent_bias.contiguous())
+        self._bias_cache = None
+        self.deploy = True
+        return self
+
+    export = switch_to_deploy
 
     def forward(self, x, H, W):
         b1,c1,h1,w1 = x.shape
@@ -79,19 +133,12 @@ class AgentAttention(nn.Module):
         v = v.reshape(b, n // self.sr_ratio ** 2, num_heads, head_dim).permute(0, 2, 1, 3)
         agent_tokens = agent_tokens.reshape(b, self.agent_num, num_heads, head_dim).permute(0, 2, 1, 3)
 
-        kv_size = (self.window_size[0] // self.sr_ratio, self.window_size[1] // self.sr_ratio)
-        position_bias1 = nn.functional.interpolate(self.an_bias, size=kv_size, mode='bilinear')
-        position_bias1 = position_bias1.reshape(1, num_heads, self.agent_num, -1).repeat(b, 1, 1, 1)
-        position_bias2 = (self.ah_bias + self.aw_bias).reshape(1, num_heads, self.agent_num, -1).repeat(b, 1, 1, 1)
-        position_bias = position_bias1 + position_bias2
+        # position biases are (1, ...) and broadcast over the batch instead of being repeated b times
+        position_bias, agent_bias = self.position_biases()
         agent_attn = self.softmax((agent_tokens * self.scale) @ k.transpose(-2, -1) + position_bias)
         agent_attn = self.attn_drop(agent_attn)
         agent_v = agent_attn @ v
 
-        agent_bias1 = nn.functional.interpolate(self.na_bias, size=self.window_size, mode='bilinear')
-        agent_bias1 = agent_bias1.reshape(1, num_heads, self.agent_num, -1).permute(0, 1, 3, 2).repeat(b, 1, 1, 1)
-        agent_bias2 = (self.ha_bias + self.wa_bias).reshape(1, num_heads, -1, self.agent_num).repeat(b, 1, 1, 1)
-        agent_bias = agent_bias1 + agent_bias2
         q_attn = self.softmax((q * self.scale) @ agent_tokens.transpose(-2, -1) + agent_bias)
         q_attn = self.attn_drop(q_attn)
         x = q_attn @ agent_v
@@ -113,4 +160,13 @@ if __name__ == '__main__':
     x = torch.randn(1,dim, H,W)
     output = block(x, H, W)
     print(f"Input size: {x.size()}")
-    print(f"Output size: {output.size()}")
\ No newline at end of file
+    print(f"Output size: {output.size()}")
+
+    # 推理时位置偏置按分辨率缓存；export/switch_to_deploy 把固定输入尺寸的偏置直接固化为 buffer
+    block.eval()
+    with torch.no_grad():
+        x = torch.randn(4, dim, H, W)
+        ref = block(x, H, W)
+        assert torch.equal(block(x, H, W), ref)  # 第二次直接使用缓存
+        out = block.export()(x, H, W)
+    assert torch.allclose(ref, out, atol=1e-6)
\ No newline at end of file
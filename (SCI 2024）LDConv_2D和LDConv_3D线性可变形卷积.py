@@ -1,8 +1,10 @@
 import math
 import torch
 import torch.nn as nn
-from einops import rearrange
 import warnings
+
+from deform_sampling_util import cached_grid, linear_sample
+
 warnings.filterwarnings('ignore')
 # 论文：https://www.sciencedirect.com/science/article/abs/pii/S0262885624002956   SCI 2024
 '''
@@ -52,41 +54,14 @@ class LDConv_2D(nn.Module):
         N = offset.size(1) // 2
         # (b, 2N, h, w)
         p = self._get_p(offset, dtype)
+        b, _, h, w = p.size()
 
-        # (b, h, w, 2N)
-        p = p.contiguous().permute(0, 2, 3, 1)
-        q_lt = p.detach().floor()
-        q_rb = q_lt + 1
-
-        q_lt = torch.cat([torch.clamp(q_lt[..., :N], 0, x.size(2) - 1), torch.clamp(q_lt[..., N:], 0, x.size(3) - 1)],
-                         dim=-1).long()
-        q_rb = torch.cat([torch.clamp(q_rb[..., :N], 0, x.size(2) - 1), torch.clamp(q_rb[..., N:], 0, x.size(3) - 1)],
-                         dim=-1).long()
-        q_lb = torch.cat([q_lt[..., :N], q_rb[..., N:]], dim=-1)
-        q_rt = torch.cat([q_rb[..., :N], q_lt[..., N:]], dim=-1)
-
-        # clip p
-        p = torch.cat([torch.clamp(p[..., :N], 0, x.size(2) - 1), torch.clamp(p[..., N:], 0, x.size(3) - 1)], dim=-1)
-
-        # bilinear kernel (b, h, w, N)
-        g_lt = (1 + (q_lt[..., :N].type_as(p) - p[..., :N])) * (1 + (q_lt[..., N:].type_as(p) - p[..., N:]))
-        g_rb = (1 - (q_rb[..., :N].type_as(p) - p[..., :N])) * (1 - (q_rb[..., N:].type_as(p) - p[..., N:]))
-        g_lb = (1 + (q_lb[..., :N].type_as(p) - p[..., :N])) * (1 - (q_lb[..., N:].type_as(p) - p[..., N:]))
-        g_rt = (1 - (q_rt[..., :N].type_as(p) - p[..., :N])) * (1 + (q_rt[..., N:].type_as(p) - p[..., N:]))
-
-        # resampling the features based on the modified coordinates.
-        x_q_lt = self._get_x_q(x, q_lt, N)
-        x_q_rb = self._get_x_q(x, q_rb, N)
-        x_q_lb = self._get_x_q(x, q_lb, N)
-        x_q_rt = self._get_x_q(x, q_rt, N)
-
-        # bilinear
-        x_offset = g_lt.unsqueeze(dim=1) * x_q_lt + \
-                   g_rb.unsqueeze(dim=1) * x_q_rb + \
-                   g_lb.unsqueeze(dim=1) * x_q_lb + \
-                   g_rt.unsqueeze(dim=1) * x_q_rt
-
-        x_offset = self._reshape_x_offset(x_offset, self.num_param)
+        # (b, 2, h, N, w): the sampled points come out already stacked in the row direction
+        p = p.reshape(b, 2, N, h, w).transpose(2, 3)
+
+        # resampling the features based on the modified coordinates, bilinear over the four corners of all
+        # N points in one gather: (b, c, h, N, w) -> (b, c, h*N, w)
+        x_offset = linear_sample(x, p).reshape(b, x.size(1), h * N, w)
         out = self.conv(x_offset)
 
         return out
@@ -128,40 +103,21 @@ class LDConv_2D(nn.Module):
     def _get_p(self, offset, dtype):
         N, h, w = offset.size(1) // 2, offset.size(2), offset.size(3)
 
-        # (1, 2N, 1, 1)
-        p_n = self._get_p_n(N, dtype)
-        # (1, 2N, h, w)
-        p_0 = self._get_p_0(h, w, N, dtype)
-        p = p_0 + p_n + offset
+        # (1, 2N, h, w) = p_0 + p_n, built once per (h, w, stride, N, device, dtype)
+        p_base = cached_grid(
+            (type(self), h, w, self.stride, N, offset.device, dtype),
+            lambda: (self._get_p_0(h, w, N, dtype) + self._get_p_n(N, dtype)).to(offset.device),
+        )
+        p = p_base + offset
         return p
 
-    def _get_x_q(self, x, q, N):
-        b, h, w, _ = q.size()
-        padded_w = x.size(3)
-        c = x.size(1)
-        # (b, c, h*w)
-        x = x.contiguous().view(b, c, -1)
-
-        # (b, h, w, N)
-        index = q[..., :N] * padded_w + q[..., N:]  # offset_x*w + offset_y
-        # (b, c, h*w*N)
-        index = index.contiguous().unsqueeze(dim=1).expand(-1, c, -1, -1, -1).contiguous().view(b, c, -1)
-
-        x_offset = x.gather(dim=-1, index=index).contiguous().view(b, c, h, w, N)
-
-        return x_offset
-
-    #  Stacking resampled features in the row direction.
-    @staticmethod
-    def _reshape_x_offset(x_offset, num_param):
-        b, c, h, w, n = x_offset.size()
-        x_offset = rearrange(x_offset, 'b c h w n -> b c (h n) w')
-        return x_offset
-
 
 
 
 class LDConv_3D(nn.Module):
+    # 采样用到的角点 (z, x, y)，0 为 floor，1 为 floor + 1: lt, rb, lb, rt
+    CORNERS = ((0, 0, 0), (1, 1, 1), (0, 1, 0), (1, 0, 1))
+
     def __init__(self, inc, outc, num_param, stride=1, bias=None):
         super(LDConv_3D, self).__init__()
         self.num_param = num_param
@@ -186,51 +142,13 @@ class LDConv_3D(nn.Module):
         N = offset.size(1) // 3
         # (b, 3N, d, h, w)
         p = self._get_p(offset, dtype)
+        b, _, d, h, w = p.size()
+
+        # (b, 3, d, N, h, w): 采样点直接按深度方向堆叠
+        p = p.reshape(b, 3, N, d, h, w).transpose(2, 3)
 
-        # (b, d, h, w, 3N)
-        p = p.contiguous().permute(0, 2, 3, 4, 1)
-        q_lt = p.detach().floor()
-        q_rb = q_lt + 1
-
-        q_lt = torch.cat([torch.clamp(q_lt[..., :N], 0, x.size(2) - 1),
-                          torch.clamp(q_lt[..., N:2 * N], 0, x.size(3) - 1),
-                          torch.clamp(q_lt[..., 2 * N:], 0, x.size(4) - 1)], dim=-1).long()
-
-        q_rb = torch.cat([torch.clamp(q_rb[..., :N], 0, x.size(2) - 1),
-                          torch.clamp(q_rb[..., N:2 * N], 0, x.size(3) - 1),
-                          torch.clamp(q_rb[..., 2 * N:], 0, x.size(4) - 1)], dim=-1).long()
-
-        q_lb = torch.cat([q_lt[..., :N], q_rb[..., N:2 * N], q_lt[..., 2 * N:]], dim=-1)
-        q_rt = torch.cat([q_rb[..., :N], q_lt[..., N:2 * N], q_rb[..., 2 * N:]], dim=-1)
-
-        p = torch.cat([torch.clamp(p[..., :N], 0, x.size(2) - 1),
-                       torch.clamp(p[..., N:2 * N], 0, x.size(3) - 1),
-                       torch.clamp(p[..., 2 * N:], 0, x.size(4) - 1)], dim=-1)
-
-        g_lt = (1 + (q_lt[..., :N].type_as(p) - p[..., :N])) * \
-               (1 + (q_lt[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * \
-               (1 + (q_lt[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-
-        g_rb = (1 - (q_rb[..., :N].type_as(p) - p[..., :N])) * \
-               (1 - (q_rb[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * \
-               (1 - (q_rb[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-
-        g_lb = (1 + (q_lb[..., :N].type_as(p) - p[..., :N])) * \
-               (1 - (q_lb[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * \
-               (1 + (q_lb[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-
-        g_rt = (1 - (q_rt[..., :N].type_as(p) - p[..., :N])) * \
-               (1 + (q_rt[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * \
-               (1 - (q_rt[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-        x_q_lt = self._get_x_q(x, q_lt, N)
-        x_q_rb = self._get_x_q(x, q_rb, N)
-        x_q_lb = self._get_x_q(x, q_lb, N)
-        x_q_rt = self._get_x_q(x, q_rt, N)
-        x_offset = g_lt.unsqueeze(dim=1) * x_q_lt + \
-                   g_rb.unsqueeze(dim=1) * x_q_rb + \
-                   g_lb.unsqueeze(dim=1) * x_q_lb + \
-                   g_rt.unsqueeze(dim=1) * x_q_rt
-        x_offset = self._reshape_x_offset(x_offset, self.num_param)
+        # 与原实现相同的四个角点 lt/rb/lb/rt，所有采样点一次 gather: (b, c, d, N, h, w) -> (b, c, d*N, h, w)
+        x_offset = linear_sample(x, p, corners=self.CORNERS).reshape(b, x.size(1), d * N, h, w)
         out = self.conv(x_offset)
         return out
     def _get_p_n(self, N, dtype):
@@ -276,31 +194,13 @@ class LDConv_3D(nn.Module):
     def _get_p(self, offset, dtype):
         N, d, h, w = offset.size(1) // 3, offset.size(2), offset.size(3), offset.size(4)
 
-        # (1, 3N, 1, 1, 1)
-        p_n = self._get_p_n(N, dtype)
-        # (1, 3N, d, h, w)
-        p_0 = self._get_p_0(d, h, w, N, dtype)
-        p = p_0 + p_n + offset
+        # (1, 3N, d, h, w) = p_0 + p_n，按 (d, h, w, stride, N, device, dtype) 缓存
+        p_base = cached_grid(
+            (type(self), d, h, w, self.stride, N, offset.device, dtype),
+            lambda: (self._get_p_0(d, h, w, N, dtype) + self._get_p_n(N, dtype)).to(offset.device),
+        )
+        p = p_base + offset
         return p
-    def _get_x_q(self, x, q, N):
-        b, d, h, w, _ = q.size()
-        padded_w = x.size(4)
-        padded_h = x.size(3)
-        c = x.size(1)
-        # (b, c, d*h*w)
-        x = x.contiguous().view(b, c, -1)
-        # (b, d, h, w, N)
-        index = q[..., :N] * (padded_h * padded_w) + q[..., N:2 * N] * padded_w + q[...,2 * N:]  # offset_z*h*w + offset_x*w + offset_y
-        # (b, c, d*h*w*N)
-        index = index.contiguous().unsqueeze(dim=1).expand(-1, c, -1, -1, -1, -1).contiguous().view(b, c, -1)
-        x_offset = x.gather(dim=-1, index=index).contiguous().view(b, c, d, h, w, N)
-        return x_offset
-    @staticmethod
-    def _reshape_x_offset(x_offset, num_param):
-        b, c, d, h, w, n = x_offset.size()
-
-        x_offset = rearrange(x_offset, 'b c d h w n -> b c (d n) h w')
-        return x_offset
 
 if __name__ == '__main__':
     # input = torch.rand(1, 32, 256, 256) #输入 B C H W,
@@ -23,6 +23,7 @@ import math
 import torch
 from torch import nn
 from einops.layers.torch import Rearrange
+from reparam_util import frozen_conv
 
 class Conv2d_cd(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size=3, stride=1,
@@ -36,7 +37,7 @@ class Conv2d_cd(nn.Module):
         conv_weight = self.conv.weight
         conv_shape = conv_weight.shape
         conv_weight = Rearrange('c_in c_out k1 k2 -> c_in c_out (k1 k2)')(conv_weight)
-        conv_weight_cd = torch.cuda.FloatTensor(conv_shape[0], conv_shape[1], 3 * 3).fill_(0)
+        conv_weight_cd = conv_weight.new_zeros(conv_shape[0], conv_shape[1], 3 * 3)
         conv_weight_cd[:, :, :] = conv_weight[:, :, :]
         conv_weight_cd[:, :, 4] = conv_weight[:, :, 4] - conv_weight[:, :, :].sum(2)
         conv_weight_cd = Rearrange('c_in c_out (k1 k2) -> c_in c_out k1 k2', k1=conv_shape[2], k2=conv_shape[3])(
@@ -79,10 +80,7 @@ class Conv2d_rd(nn.Module):
         else:
             conv_weight = self.conv.weight
             conv_shape = conv_weight.shape
-            if conv_weight.is_cuda:
-                conv_weight_rd = torch.cuda.FloatTensor(conv_shape[0], conv_shape[1], 5 * 5).fill_(0)
-            else:
-                conv_weight_rd = torch.zeros(conv_shape[0], conv_shape[1], 5 * 5)
+            conv_weight_rd = conv_weight.new_zeros(conv_shape[0], conv_shape[1], 5 * 5)
             conv_weight = Rearrange('c_in c_out k1 k2 -> c_in c_out (k1 k2)')(conv_weight)
             conv_weight_rd[:, :, [0, 2, 4, 10, 14, 20, 22, 24]] = conv_weight[:, :, 1:]
             conv_weight_rd[:, :, [6, 7, 8, 11, 13, 16, 17, 18]] = -conv_weight[:, :, 1:] * self.theta
@@ -104,7 +102,7 @@ class Conv2d_hd(nn.Module):
     def get_weight(self):
         conv_weight = self.conv.weight
         conv_shape = conv_weight.shape
-        conv_weight_hd = torch.cuda.FloatTensor(conv_shape[0], conv_shape[1], 3 * 3).fill_(0)
+        conv_weight_hd = conv_weight.new_zeros(conv_shape[0], conv_shape[1], 3 * 3)
         conv_weight_hd[:, :, [0, 3, 6]] = conv_weight[:, :, :]
         conv_weight_hd[:, :, [2, 5, 8]] = -conv_weight[:, :, :]
         conv_weight_hd = Rearrange('c_in c_out (k1 k2) -> c_in c_out k1 k2', k1=conv_shape[2], k2=conv_shape[2])(
@@ -122,7 +120,7 @@ class Conv2d_vd(nn.Module):
     def get_weight(self):
         conv_weight = self.conv.weight
         conv_shape = conv_weight.shape
-        conv_weight_vd = torch.cuda.FloatTensor(conv_shape[0], conv_shape[1], 3 * 3).fill_(0)
+        conv_weight_vd = conv_weight.new_zeros(conv_shape[0], conv_shape[1], 3 * 3)
         conv_weight_vd[:, :, [0, 1, 2]] = conv_weight[:, :, :]
         conv_weight_vd[:, :, [6, 7, 8]] = -conv_weight[:, :, :]
         conv_weight_vd = Rearrange('c_in c_out (k1 k2) -> c_in c_out k1 k2', k1=conv_shape[2], k2=conv_shape[2])(
@@ -140,7 +138,7 @@ class DEConv(nn.Module):
         self.conv1_4 = Conv2d_ad(dim, dim, 3, bias=True)
         self.conv1_5 = nn.Conv2d(dim, dim, 3, padding=1, bias=True)
 
-    def forward(self, x):
+    def get_equivalent_kernel_bias(self):
         w1, b1 = self.conv1_1.get_weight()
         w2, b2 = self.conv1_2.get_weight()
         w3, b3 = self.conv1_3.get_weight()
@@ -149,9 +147,28 @@ class DEConv(nn.Module):
 
         w = w1 + w2 + w3 + w4 + w5
         b = b1 + b2 + b3 + b4 + b5
+        return w, b
+
+    def forward(self, x):
+        if hasattr(self, 'conv'):  # deploy mode
+            return self.conv(x)
+        w, b = self.get_equivalent_kernel_bias()
         res = nn.functional.conv2d(input=x, weight=w, bias=b, stride=1, padding=1, groups=1)
         return res
 
+    @torch.no_grad()
+    def switch_to_deploy(self):
+        # 推理阶段：五个差分卷积分支只合并一次，得到一个等价的普通 3x3 卷积
+        if hasattr(self, 'conv'):
+            return self
+        w, b = self.get_equivalent_kernel_bias()
+        self.conv = frozen_conv(w, b)
+        for name in ('conv1_1', 'conv1_2', 'conv1_3', 'conv1_4', 'conv1_5'):
+            delattr(self, name)
+        return self
+
+    fuse = switch_to_deploy
+
 #DEConv_2二次创新模块：这里我只是对DEConv模块进行了初步的改进想法分享给大家，
 # 1.使用了通道拼接再卷积压缩方法可以使得特征表达更充分
 # 2.使用了门控权重缝合模块获取一个权重a，a*res1+(1-a)*res2突显res1和res2二者特征图之间的特征增强。
@@ -173,7 +190,8 @@ class DEConv_2(nn.Module):
         self.conv1_5 = nn.Conv2d(dim, dim, 3, padding=1, bias=True)
         self.conv1 =nn.Conv2d(dim*5,dim,1)
         self.sigmod = nn.Sigmoid()
-    def forward(self, x):
+
+    def get_equivalent_kernel_bias(self):
         w1, b1 = self.conv1_1.get_weight()
         w2, b2 = self.conv1_2.get_weight()
         w3, b3 = self.conv1_3.get_weight()
@@ -185,16 +203,46 @@ class DEConv_2(nn.Module):
 
         w2 = torch.cat([w1,w2,w3,w4,w5],dim=1)
         w2 = self.conv1(w2)
-        res1 = nn.functional.conv2d(input=x, weight=w1, bias=b, stride=1, padding=1, groups=1)
-        res2 = nn.functional.conv2d(input=x, weight=w2, bias=b, stride=1, padding=1, groups=1)
+        return w1, w2, b
+
+    def forward(self, x):
+        if hasattr(self, 'conv'):  # deploy mode: res1 和 res2 由一个 2*dim 输出的卷积一次算出
+            res1, res2 = self.conv(x).chunk(2, dim=1)
+        else:
+            w1, w2, b = self.get_equivalent_kernel_bias()
+            res1 = nn.functional.conv2d(input=x, weight=w1, bias=b, stride=1, padding=1, groups=1)
+            res2 = nn.functional.conv2d(input=x, weight=w2, bias=b, stride=1, padding=1, groups=1)
         a  =self.sigmod(res1+res2)
         out = x+a*res1+(1-a)*res2
         return out
+
+    @torch.no_grad()
+    def switch_to_deploy(self):
+        # 拼接权重经过 1x1 卷积得到的 w2 也只和参数有关，推理时同样可以提前算好
+        if hasattr(self, 'conv'):
+            return self
+        w1, w2, b = self.get_equivalent_kernel_bias()
+        self.conv = frozen_conv(torch.cat([w1, w2], dim=0), torch.cat([b, b], dim=0))
+        for name in ('conv1_1', 'conv1_2', 'conv1_3', 'conv1_4', 'conv1_5', 'conv1'):
+            delattr(self, name)
+        return self
+
+    fuse = switch_to_deploy
 # 双分支特征融合
 # 输入 N C H W,  输出 N C H W
 if __name__ == '__main__':
-    models = DEConv_2(32).cuda()
-    input = torch.rand(3, 32, 64, 64).cuda()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    models = DEConv_2(32).to(device)
+    input = torch.rand(3, 32, 64, 64).to(device)
     output = models(input)
     print('input_size:',input.size())
     print('output_size:',output.size())
+
+    # 重参数化等价性检查：switch_to_deploy() 前后输出应一致
+    for model in (DEConv(32), DEConv_2(32)):
+        model = model.to(device).eval()
+        with torch.no_grad():
+            before = model(input)
+            after = model.switch_to_deploy()(input)
+        assert torch.allclose(before, after, rtol=1e-4, atol=1e-4), (before - after).abs().max()
+        print(type(model).__name__, 'deploy max abs diff:', (before - after).abs().max().item())
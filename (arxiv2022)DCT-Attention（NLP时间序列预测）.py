@@ -16,60 +16,78 @@
 此外，我们还证明了这种频率增强的通道注意力机制可以灵活地应用于不同的网络中。
 """
 
+import functools
+import math
+
 import torch.nn as nn
-import numpy as np
 import torch
-try:
-    from torch import irfft
-    from torch import rfft
-except ImportError:
-    def rfft(x, d):
-        t = torch.fft.fft(x, dim=(-d))
-        r = torch.stack((t.real, t.imag), -1)
-        return r
+
+# sequences up to this length use the DCT matrix (one GEMM), longer ones the FFT
+DCT_MATMUL_MAX_LEN = 128
+
+
+@functools.lru_cache(maxsize=32)
+def _dct_twiddle(N, device, dtype):
+    """ exp(-i*pi*k/(2N)) for the FFT path, cached per (length, device, dtype). """
+    with torch.inference_mode(False):
+        k = - torch.arange(N, dtype=dtype, device=device) * math.pi / (2 * N)
+        return torch.complex(torch.cos(k), torch.sin(k))
 
 
-    def irfft(x, d):
-        t = torch.fft.ifft(torch.complex(x[:, :, 0], x[:, :, 1]), dim=(-d))
-        return t.real
+@functools.lru_cache(maxsize=32)
+def _dct_matrix(N, device, dtype):
+    """ (N, N) DCT-II matrix (transposed, x @ M), cached per (length, device, dtype). """
+    with torch.inference_mode(False):
+        n = torch.arange(N, dtype=torch.float64, device=device)
+        M = 2 * torch.cos(math.pi * (2 * n[:, None] + 1) * n[None, :] / (2 * N))
+        return M.to(dtype)
 
 
-def dct(x, norm=None):
+@functools.lru_cache(maxsize=32)
+def _dct_ortho_scale(N, device, dtype):
+    with torch.inference_mode(False):
+        scale = torch.full((N,), 1 / (math.sqrt(N / 2) * 2), dtype=dtype, device=device)
+        scale[0] = 1 / (math.sqrt(N) * 2)
+        return scale
+
+
+def dct(x, norm=None, use_matmul=None):
     """
     Discrete Cosine Transform, Type II (a.k.a. the DCT)
 
     For the meaning of the parameter `norm`, see:
     https://docs.scipy.org/doc/scipy-0.14.0/reference/generated/scipy.fftpack.dct.html
 
+    All leading dimensions are transformed in one call and the result stays in the autograd graph.
+
     :param x: the input signal
     :param norm: the normalization, None or 'ortho'
+    :param use_matmul: multiply with the cached DCT matrix instead of using the FFT,
+        None chooses the matrix for lengths up to DCT_MATMUL_MAX_LEN
     :return: the DCT-II of the signal over the last dimension
     """
-    x_shape = x.shape
-    N = x_shape[-1]
-    x = x.contiguous().view(-1, N)
-
-    v = torch.cat([x[:, ::2], x[:, 1::2].flip([1])], dim=1)
-
-    # Vc = torch.fft.rfft(v, 1, onesided=False)
-    Vc = rfft(v, 1)
-
-    k = - torch.arange(N, dtype=x.dtype, device=x.device)[None, :] * np.pi / (2 * N)
-    W_r = torch.cos(k)
-    W_i = torch.sin(k)
-
-    V = Vc[:, :, 0] * W_r - Vc[:, :, 1] * W_i
+    N = x.shape[-1]
+    if use_matmul is None:
+        use_matmul = N <= DCT_MATMUL_MAX_LEN
+
+    if use_matmul:
+        V = x @ _dct_matrix(N, x.device, x.dtype)
+    else:
+        # Makhoul: reorder to [x0, x2, ..., x3, x1], FFT, rotate by the twiddle factors
+        v = torch.cat([x[..., ::2], x[..., 1::2].flip([-1])], dim=-1)
+        Vc = torch.fft.fft(v, dim=-1)
+        V = 2 * (Vc * _dct_twiddle(N, x.device, x.dtype)).real
 
     if norm == 'ortho':
-        V[:, 0] /= np.sqrt(N) * 2
-        V[:, 1:] /= np.sqrt(N / 2) * 2
-
-    V = 2 * V.view(*x_shape)
+        V = V * _dct_ortho_scale(N, x.device, x.dtype)
 
     return V
+
+
 class DCT_Attention(nn.Module):
-    def __init__(self, channel):
+    def __init__(self, channel, use_matmul=None):
         super(DCT_Attention, self).__init__()
+        self.use_matmul = use_matmul
         # self.avg_pool = nn.AdaptiveAvgPool1d(1) #innovation
         self.fc = nn.Sequential(
             nn.Linear(channel, channel * 2, bias=False),
@@ -85,14 +103,8 @@ class DCT_Attention(nn.Module):
 
     def forward(self, x):
         b, c, l = x.size()  # (B,C,L) (32,96,512)
-        list = []
-        for i in range(c):
-            freq = dct(x[:, i, :])
-            # print("freq-shape:",freq.shape)
-            list.append(freq)
-
-        stack_dct = torch.stack(list, dim=1)
-        stack_dct = torch.tensor(stack_dct)
+        # DCT of all channels at once
+        stack_dct = dct(x, use_matmul=self.use_matmul)
         '''
         for traffic mission:f_weight = self.dct_norm(f_weight.permute(0,2,1))#matters for traffic datasets
         '''
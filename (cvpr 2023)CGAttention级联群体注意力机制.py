@@ -1,5 +1,5 @@
-import itertools
 import torch
+import torch.nn.functional as F
 # https://arxiv.org/pdf/2305.07027
 '''
 EfficientViT：具有级联群注意力的内存高效视觉转换器    cvpr 2023 顶会论文
@@ -48,6 +48,11 @@ class CascadedGroupAttention(torch.nn.Module):
         attn_ratio (int): Multiplier for the query dim for value dimension.
         resolution (int): Input resolution, correspond to the window size.
         kernels (List[int]): The kernel size of the dw conv on query.
+
+    switch_to_deploy() folds all Conv2d_BN layers and packs the per-head weights into stacked buffers, so every head
+    runs as one 1x1 conv, one dw conv, one baddbmm (scale and bias folded in) and one bmm. With parallel_heads=True the
+    deployed block drops the cascade (head i only sees its own input split) and runs all heads at once; this is an
+    approximation of the trained block, its error is printed by the benchmark in __main__.
     """
 
     def __init__(self, dim, num_heads=4,
@@ -73,32 +78,81 @@ class CascadedGroupAttention(torch.nn.Module):
         self.proj = torch.nn.Sequential(torch.nn.ReLU(), Conv2d_BN(
             self.d * num_heads, dim, bn_weight_init=0, resolution=resolution))
 
-        points = list(itertools.product(range(resolution), range(resolution)))
-        N = len(points)
-        attention_offsets = {}
-        idxs = []
-        for p1 in points:
-            for p2 in points:
-                offset = (abs(p1[0] - p2[0]), abs(p1[1] - p2[1]))
-                if offset not in attention_offsets:
-                    attention_offsets[offset] = len(attention_offsets)
-                idxs.append(attention_offsets[offset])
+        # offset (dy, dx) -> dy * resolution + dx, the numbering of the first-seen order of the original p1/p2 loop
+        rows, cols = torch.arange(resolution).repeat_interleave(resolution), torch.arange(resolution).repeat(resolution)
+        idxs = (rows[:, None] - rows[None, :]).abs() * resolution + (cols[:, None] - cols[None, :]).abs()
         self.attention_biases = torch.nn.Parameter(
-            torch.zeros(num_heads, len(attention_offsets)))
-        self.register_buffer('attention_bias_idxs',
-                             torch.LongTensor(idxs).view(N, N))
+            torch.zeros(num_heads, resolution * resolution))
+        self.register_buffer('attention_bias_idxs', idxs)
+        self.deploy = False
+        self.parallel_heads = False
 
     @torch.no_grad()
     def train(self, mode=True):
         super().train(mode)
+        if self.deploy:
+            return
         if mode and hasattr(self, 'ab'):
             del self.ab
         else:
             self.ab = self.attention_biases[:, self.attention_bias_idxs]
 
+    @torch.no_grad()
+    def switch_to_deploy(self, parallel_heads=False):
+        self.parallel_heads = parallel_heads
+        if self.deploy:
+            return self
+        qkvs = [m.switch_to_deploy() for m in self.qkvs]
+        dws = [m.switch_to_deploy() for m in self.dws]
+        # dw kernels of all heads zero-padded to the largest one, the attention scale folded into the query
+        k = max(m.kernel_size[0] for m in dws)
+        dw_weight = torch.stack([F.pad(m.weight, [(k - m.kernel_size[0]) // 2] * 4) for m in dws])
+        self.register_buffer('qkv_weight', torch.stack([m.weight[..., 0] for m in qkvs]))  # h, 2kd+d, C/h, 1
+        self.register_buffer('qkv_bias', torch.stack([m.bias for m in qkvs]))
+        self.register_buffer('dw_weight', dw_weight * self.scale)  # h, kd, 1, k, k
+        self.register_buffer('dw_bias', torch.stack([m.bias for m in dws]) * self.scale)
+        self.register_buffer('attention_bias', self.attention_biases[:, self.attention_bias_idxs].contiguous())
+        self.dw_padding = k // 2
+        self.proj[1] = self.proj[1].switch_to_deploy()
+        for name in ('qkvs', 'dws', 'attention_biases', 'attention_bias_idxs', 'ab'):
+            if hasattr(self, name):
+                delattr(self, name)
+        self.deploy = True
+        return self
+
+    def _forward_deploy(self, x):
+        B, C, H, W = x.shape
+        kd, d = self.key_dim, self.d
+        feats_in = x.flatten(2).chunk(self.num_heads, dim=1)
+        feats_out = []
+        feat = feats_in[0]
+        for i in range(self.num_heads):
+            if i > 0:
+                feat = feat + feats_in[i]
+            qkv = F.conv1d(feat, self.qkv_weight[i], self.qkv_bias[i])  # B, 2kd+d, N
+            q = F.conv2d(qkv[:, :kd].view(B, kd, H, W), self.dw_weight[i], self.dw_bias[i],
+                         padding=self.dw_padding, groups=kd)
+            attn = torch.baddbmm(self.attention_bias[i], q.flatten(2).transpose(1, 2), qkv[:, kd:2 * kd])
+            feat = torch.bmm(qkv[:, 2 * kd:], attn.softmax(dim=-1).transpose(1, 2))  # B, d, N
+            feats_out.append(feat)
+        return self.proj(torch.cat(feats_out, 1).view(B, -1, H, W))
+
+    def _forward_parallel(self, x):
+        B, C, H, W = x.shape
+        h, kd, d = self.num_heads, self.key_dim, self.d
+        qkv = F.conv2d(x, self.qkv_weight.flatten(0, 1).unsqueeze(-1), self.qkv_bias.flatten(), groups=h)
+        qkv = qkv.view(B, h, -1, H * W)
+        q = F.conv2d(qkv[:, :, :kd].reshape(B, h * kd, H, W), self.dw_weight.flatten(0, 1), self.dw_bias.flatten(),
+                     padding=self.dw_padding, groups=h * kd)
+        attn = q.view(B, h, kd, -1).transpose(-2, -1) @ qkv[:, :, kd:2 * kd] + self.attention_bias
+        x = qkv[:, :, 2 * kd:] @ attn.softmax(dim=-1).transpose(-2, -1)  # B, h, d, N
+        return self.proj(x.reshape(B, h * d, H, W))
+
     def forward(self, x):  # x (B,C,H,W)
+        if self.deploy:
+            return self._forward_parallel(x) if self.parallel_heads else self._forward_deploy(x)
         B, C, H, W = x.shape
-        trainingab = self.attention_biases[:, self.attention_bias_idxs]
+        trainingab = self.attention_biases[:, self.attention_bias_idxs] if self.training else None
         feats_in = x.chunk(len(self.qkvs), dim=1)
         feats_out = []
         feat = feats_in[0]
@@ -123,3 +177,47 @@ if __name__ == '__main__':
     output = model(input)
     print('input_size:', input.size())
     print('output_size:', output.size())
+
+    # 部署模式（BN 融合 + 打包的逐头权重）与原始级联结果一致；parallel_heads 为去掉级联的近似
+    import copy
+    import sys
+
+    def randomise(block):
+        # 随机 BN 统计量与位置偏置（proj 的 BN 初始权重为 0，否则输出与注意力无关）
+        for m in block.modules():
+            if isinstance(m, torch.nn.BatchNorm2d):
+                torch.nn.init.uniform_(m.weight, 0.5, 1.5)
+                torch.nn.init.uniform_(m.running_var, 0.5, 1.5)
+                torch.nn.init.normal_(m.running_mean)
+        torch.nn.init.normal_(block.attention_biases)
+        return block
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = randomise(model).to(device)
+    model.eval()
+    deploy = copy.deepcopy(model).switch_to_deploy()
+    with torch.no_grad():
+        input = torch.randn(4, 64, 32, 32, device=device)
+        ref = model(input)
+        out = deploy(input)
+        assert torch.allclose(ref, out, rtol=1e-4, atol=1e-4), (ref - out).abs().max()
+
+    # 微基准：python "(cvpr 2023)CGAttention级联群体注意力机制.py" --benchmark，比较原始 / 部署 / 并行头的前向耗时及并行头的误差
+    if '--benchmark' in sys.argv:
+        from blocks.benchmark import measure
+
+        for num_heads in (4, 8):
+            # 级联相加要求每个头的输出通道 d 等于输入分组通道 dim / num_heads
+            base = randomise(CascadedGroupAttention(dim=128, num_heads=num_heads, attn_ratio=16 // num_heads,
+                                                    resolution=14, kernels=[5] * num_heads)).to(device)
+            base.eval()
+            variants = {'original': base, 'deploy': copy.deepcopy(base).switch_to_deploy(),
+                        'parallel': copy.deepcopy(base).switch_to_deploy(parallel_heads=True)}
+            times = {name: measure(m, [('tensor', (8, 128, 14, 14))], device=device,
+                                   backward=False, flops=False)['fwd_ms'] for name, m in variants.items()}
+            with torch.no_grad():
+                input = torch.randn(8, 128, 14, 14, device=device)
+                ref, approx = variants['original'](input), variants['parallel'](input)
+                err = ((approx - ref).norm() / ref.norm().clamp_min(1e-12)).item()
+            print(f"heads {num_heads}: " + "  ".join(f"{name} {t:7.2f} ms" for name, t in times.items())
+                  + f"  parallel rel. error {err:.3e}")
@@ -59,12 +59,18 @@ class WindowAttention_acmix(nn.Module):
         qk_scale (float | None, optional): Override default qk scale of head_dim ** -0.5 if set
         attn_drop (float, optional): Dropout ratio of attention weight. Default: 0.0
         proj_drop (float, optional): Dropout ratio of output. Default: 0.0
+        fused (bool, optional): Produce qkv directly in the (head_dim, 3 * num_heads) channel order that the conv path
+            groups by, so both paths read the same qkv tensor, and run fc + dep_conv as one grouped 3x3 conv.
+            Same parameters and results as the default path. Default: False
     """
 
-    def __init__(self, dim, window_size, num_heads, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, window_size, num_heads, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0.,
+                 fused=False):
 
         super().__init__()
         self.dim = dim
+        self.fused = fused
+        self.deploy = False
         self.window_size = window_size  # Wh, Ww
         self.num_heads = num_heads
         head_dim = dim // num_heads
@@ -108,20 +114,117 @@ class WindowAttention_acmix(nn.Module):
     def reset_parameters(self):
         ones(self.rate1)
         ones(self.rate2)
-        # shift initialization for group convolution
-        kernel = torch.zeros(9, 3, 3)
-        for i in range(9):
-            kernel[i, i // 3, i % 3] = 1.
-        kernel = kernel.squeeze(0).repeat(self.dim, 1, 1, 1)
+        # shift initialization for group convolution: kernel i is a one-hot at tap (i // 3, i % 3)
+        kernel = torch.eye(9).view(9, 3, 3).repeat(self.dim, 1, 1, 1)
         self.dep_conv.weight = nn.Parameter(data=kernel, requires_grad=True)
         self.dep_conv.bias = zeros(self.dep_conv.bias)
 
+    def _window_attention(self, q, k, v, H, W, mask=None):
+        # q, k, v: (nW*B, nH, N, C // nH) -> (B, H, W, C)
+        B_, _, N, _ = q.shape
+        C = self.dim
+
+        q = q * self.scale
+        attn = (q @ k.transpose(-2, -1))
+
+        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
+            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
+        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        attn = attn + relative_position_bias.unsqueeze(0)
+
+        if mask is not None:
+            nW = mask.shape[0]
+            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
+            attn = attn.view(-1, self.num_heads, N, N)
+            attn = self.softmax(attn)
+        else:
+            attn = self.softmax(attn)
+
+        attn = self.attn_drop(attn)
+
+        x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
+        x = self.proj(x)
+
+        # merge windows
+        x = x.view(-1, self.window_size[0], self.window_size[1], C)
+        x = window_reverse(x, self.window_size[0], H, W)  # B H' W' C
+        return x
+
+    def fused_parameters(self):
+        """
+        (qkv weight, qkv bias, conv weight, conv bias, bias kernel) of the fused path.
+
+        qkv channel g * head_dim + d (g over 3 * nH) is moved to d * 3 * nH + g, so the 3 * nH channels that the conv
+        path mixes for head_dim index d are contiguous and form group d of a grouped conv. The 1x1 fc and the shift
+        dep_conv are linear, so they compose into one grouped 3x3 conv with weight dep_conv.weight x fc.weight; the
+        fc bias only reaches the in-bounds taps (dep_conv zero-pads after the fc) and is added as
+        conv2d(ones, bias kernel).
+        """
+        if self.deploy:
+            return (self.qkv.weight, self.qkv.bias, self.fused_conv.weight, self.fused_conv.bias,
+                    self.fused_bias_kernel)
+        head_dim = self.dim // self.num_heads
+        qkv_weight = self.qkv.weight.view(3 * self.num_heads, head_dim, self.dim).transpose(0, 1).reshape(
+            3 * self.dim, self.dim)
+        qkv_bias = None
+        if self.qkv.bias is not None:
+            qkv_bias = self.qkv.bias.view(3 * self.num_heads, head_dim).t().reshape(-1)
+        fc_weight = self.fc.weight.view(9, 3 * self.num_heads)
+        conv_weight = torch.einsum('otij,tg->ogij', self.dep_conv.weight, fc_weight)
+        bias_kernel = torch.einsum('otij,t->oij', self.dep_conv.weight, self.fc.bias).unsqueeze(1)
+        return qkv_weight, qkv_bias, conv_weight, self.dep_conv.bias, bias_kernel
+
+    def _forward_fused(self, x, H, W, mask=None):
+        qkv_weight, qkv_bias, conv_weight, conv_bias, bias_kernel = self.fused_parameters()
+        head_dim = self.dim // self.num_heads
+        qkv = F.linear(x, qkv_weight, qkv_bias)  # B, H, W, 3C in (head_dim, 3, nH) order
+
+        # conv path straight on the channels-last qkv (the permute is a view), fc + dep_conv in one grouped conv
+        out_conv = F.conv2d(qkv.permute(0, 3, 1, 2), conv_weight, conv_bias, padding=1, groups=head_dim)
+        out_conv = out_conv + F.conv2d(qkv.new_ones(1, 1, H, W), bias_kernel, padding=1)
+        out_conv = out_conv.permute(0, 2, 3, 1)  # B, H, W, C
+
+        # attention path on the same qkv
+        qkv = window_partition(qkv, self.window_size[0])
+        N = self.window_size[0] * self.window_size[1]
+        qkv = qkv.view(-1, N, head_dim, 3, self.num_heads).permute(3, 0, 4, 1, 2)
+        x = self._window_attention(qkv[0], qkv[1], qkv[2], H, W, mask)
+
+        x = self.rate1 * x + self.rate2 * out_conv
+
+        x = self.proj_drop(x)
+        return x
+
+    @torch.no_grad()
+    def switch_to_deploy(self):
+        """ Freeze the fused path: qkv rows permuted once, fc + dep_conv folded into one precomputed grouped conv. """
+        if self.deploy:
+            return self
+        qkv_weight, qkv_bias, conv_weight, conv_bias, bias_kernel = self.fused_parameters()
+        qkv = nn.Linear(self.dim, 3 * self.dim, bias=qkv_bias is not None).to(qkv_weight)
+        qkv.weight.copy_(qkv_weight)
+        if qkv_bias is not None:
+            qkv.bias.copy_(qkv_bias)
+        fused_conv = nn.Conv2d(3 * self.dim, self.dim, 3, padding=1, groups=self.dim // self.num_heads,
+                               bias=conv_bias is not None).to(conv_weight)
+        fused_conv.weight.copy_(conv_weight)
+        if conv_bias is not None:
+            fused_conv.bias.copy_(conv_bias)
+        self.qkv = qkv.requires_grad_(False)
+        self.fused_conv = fused_conv.requires_grad_(False)
+        self.register_buffer('fused_bias_kernel', bias_kernel.clone())
+        del self.fc, self.dep_conv
+        self.fused = self.deploy = True
+        return self
+
     def forward(self, x, H, W, mask=None):
         """
         Args:
             x: input features with shape of (B, H, W, C)
             mask: (0/-inf) mask with shape of (num_windows, Wh*Ww, Wh*Ww) or None
         """
+        if self.fused:
+            return self._forward_fused(x, H, W, mask)
 
         qkv = self.qkv(x)
 
@@ -144,31 +247,7 @@ class WindowAttention_acmix(nn.Module):
 
         qkv = qkv.reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
-
-        q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))
-
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-        attn = attn + relative_position_bias.unsqueeze(0)
-
-        if mask is not None:
-            nW = mask.shape[0]
-            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
-            attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
-        else:
-            attn = self.softmax(attn)
-
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
-        x = self.proj(x)
-
-        # merge windows
-        x = x.view(-1, self.window_size[0], self.window_size[1], C)
-        x = window_reverse(x, self.window_size[0], H, W)  # B H' W' C
+        x = self._window_attention(q, k, v, H, W, mask)
 
         x = self.rate1 * x + self.rate2 * out_conv
 
@@ -194,7 +273,36 @@ class WindowAttention_acmix(nn.Module):
 
 # 输入 n h w c,  输出 n h w c
 if __name__ == '__main__':
-    block = WindowAttention_acmix(64, (7, 7), 8).cuda()  # dim,window_size, num_heads
-    input = torch.rand(1, 56, 56, 64).cuda()        # 通道数需为num_heads的倍数
+    import copy
+    import sys
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    block = WindowAttention_acmix(64, (7, 7), 8).to(device)  # dim,window_size, num_heads
+    input = torch.rand(1, 56, 56, 64).to(device)        # 通道数需为num_heads的倍数
     output = block(input, 56, 56)  # h w   需为window_size的倍数
     print(input.size(), output.size())
+
+    # 共享 qkv 布局的融合路径 / 部署模式（fc + dep_conv 预先合成一个分组卷积）与原始路径结果一致
+    nn.init.normal_(block.fc.bias)
+    block.eval()
+    fused = copy.deepcopy(block)
+    fused.fused = True
+    deploy = copy.deepcopy(block).switch_to_deploy()
+    with torch.no_grad():
+        ref = block(input, 56, 56)
+        for other in (fused, deploy):
+            out = other(input, 56, 56)
+            assert torch.allclose(ref, out, rtol=1e-4, atol=1e-4), (ref - out).abs().max()
+
+    # 微基准：python "(cvpr2022）acmix.py" --benchmark，比较不同窗口大小下三种路径的前向耗时
+    if '--benchmark' in sys.argv:
+        from blocks.benchmark import measure
+
+        for window_size in (4, 7, 8, 14):
+            base = WindowAttention_acmix(64, (window_size, window_size), 8)
+            fused = copy.deepcopy(base)
+            fused.fused = True
+            variants = {'original': base, 'fused': fused, 'deploy': copy.deepcopy(base).switch_to_deploy()}
+            times = {name: measure(m, [('tensor', (8, 56, 56, 64)), ('const', 56), ('const', 56)], device=device,
+                                   backward=False, flops=False)['fwd_ms'] for name, m in variants.items()}
+            print(f"window {window_size:2d}: " + "  ".join(f"{name} {t:7.2f} ms" for name, t in times.items()))
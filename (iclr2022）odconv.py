@@ -3,6 +3,16 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.autograd
 
+# strategy='auto' runs the K static kernels (unfold + one GEMM shared by the whole batch) once the batch has at least
+# STATIC_BATCH_PER_KERNEL samples per kernel, and the per-sample grouped conv below that; None never picks 'static'.
+# The static path materialises the unfolded input (k * k times the activation), which is also kept for backward.
+# CPU forward times of the --benchmark option (ODConv2d(64, 64, 3), 64x32x32 input, 1 thread, torch 2.14):
+#   kernel_num=1  B=1: grouped 1.94 ms / static 4.95 ms   B=8: 12.08 / 35.90   B=64: 111.77 / 426.30
+#   kernel_num=4  B=1: grouped 2.45 ms / static 7.99 ms   B=8: 12.71 / 55.54   B=64: 146.73 / 656.69
+# 'static' is 2.5-4.5x slower at every measured batch size, so there is no threshold to pick on CPU and 'grouped'
+# stays the default; set a threshold only after measuring a device where 'static' wins.
+STATIC_BATCH_PER_KERNEL = None
+
 
 class Attention(nn.Module):
     def __init__(self, in_planes, out_planes, kernel_size, groups=1, reduction=0.0625, kernel_num=4, min_channel=16):
@@ -85,8 +95,9 @@ class Attention(nn.Module):
 
 class ODConv2d(nn.Module):
     def __init__(self, in_planes, out_planes, kernel_size, stride=1, padding=0, dilation=1, groups=1,
-                 reduction=0.0625, kernel_num=4):
+                 reduction=0.0625, kernel_num=4, strategy='grouped'):
         super(ODConv2d, self).__init__()
+        assert strategy in ('auto', 'grouped', 'static')
         self.in_planes = in_planes
         self.out_planes = out_planes
         self.kernel_size = kernel_size
@@ -95,6 +106,7 @@ class ODConv2d(nn.Module):
         self.dilation = dilation
         self.groups = groups
         self.kernel_num = kernel_num
+        self.strategy = strategy
         self.attention = Attention(in_planes, out_planes, kernel_size, groups=groups,
                                    reduction=reduction, kernel_num=kernel_num)
         self.weight = nn.Parameter(torch.randn(kernel_num, out_planes, in_planes // groups, kernel_size, kernel_size),
@@ -104,7 +116,7 @@ class ODConv2d(nn.Module):
         if self.kernel_size == 1 and self.kernel_num == 1:
             self._forward_impl = self._forward_impl_pw1x
         else:
-            self._forward_impl = self._forward_impl_common
+            self._forward_impl = self._forward_impl_dynamic
 
     def _initialize_weights(self):
         for i in range(self.kernel_num):
@@ -129,6 +141,43 @@ class ODConv2d(nn.Module):
         output = output * filter_attention
         return output
 
+    def _forward_impl_static(self, x):
+        # Same output as _forward_impl_common without per-sample kernels: the input is unfolded once, scaled by the
+        # spatial attention, multiplied by all K static kernels in one batched GEMM, and the K outputs are mixed
+        # with the kernel attention. Costs K times the conv FLOPs but keeps a fixed weight for every batch size.
+        channel_attention, filter_attention, spatial_attention, kernel_attention = self.attention(x)
+        batch_size, in_planes, height, width = x.size()
+        k, groups, kernel_num = self.kernel_size, self.groups, self.kernel_num
+        x = x * channel_attention
+        cols = F.unfold(x, k, dilation=self.dilation, padding=self.padding, stride=self.stride)
+        cols = cols.view(batch_size, groups, in_planes // groups, k * k, -1)
+        if torch.is_tensor(spatial_attention):
+            cols = cols * spatial_attention.view(batch_size, 1, 1, k * k, 1)
+        cols = cols.flatten(2, 3)  # (B, g, in/g*k*k, L)
+        weight = self.weight.view(kernel_num, groups, self.out_planes // groups, -1).transpose(0, 1)
+        output = torch.matmul(weight.reshape(groups, kernel_num * self.out_planes // groups, -1), cols)
+        output = output.view(batch_size, groups, kernel_num, self.out_planes // groups, -1)
+        if torch.is_tensor(kernel_attention):
+            output = output * kernel_attention.view(batch_size, 1, kernel_num, 1, 1)
+        output = output.sum(dim=2)
+        out_h = (height + 2 * self.padding - self.dilation * (k - 1) - 1) // self.stride + 1
+        out_w = (width + 2 * self.padding - self.dilation * (k - 1) - 1) // self.stride + 1
+        output = output.view(batch_size, self.out_planes, out_h, out_w)
+        output = output * filter_attention
+        return output
+
+    def _select_strategy(self, batch_size):
+        if self.strategy != 'auto':
+            return self.strategy
+        if STATIC_BATCH_PER_KERNEL is None:
+            return 'grouped'
+        return 'static' if batch_size >= STATIC_BATCH_PER_KERNEL * self.kernel_num else 'grouped'
+
+    def _forward_impl_dynamic(self, x):
+        if self._select_strategy(x.size(0)) == 'static':
+            return self._forward_impl_static(x)
+        return self._forward_impl_common(x)
+
     def _forward_impl_pw1x(self, x):
         channel_attention, filter_attention, spatial_attention, kernel_attention = self.attention(x)
         x = x * channel_attention
@@ -141,19 +190,47 @@ class ODConv2d(nn.Module):
         return self._forward_impl(x)
 
 
-def odconv3x3(in_planes, out_planes, stride=1, reduction=0.0625, kernel_num=1):
+def odconv3x3(in_planes, out_planes, stride=1, reduction=0.0625, kernel_num=1, strategy='grouped'):
     return ODConv2d(in_planes, out_planes, kernel_size=3, stride=stride, padding=1,
-                    reduction=reduction, kernel_num=kernel_num)
+                    reduction=reduction, kernel_num=kernel_num, strategy=strategy)
 
 
-def odconv1x1(in_planes, out_planes, stride=1, reduction=0.0625, kernel_num=1):
+def odconv1x1(in_planes, out_planes, stride=1, reduction=0.0625, kernel_num=1, strategy='grouped'):
     return ODConv2d(in_planes, out_planes, kernel_size=1, stride=stride, padding=0,
-                    reduction=reduction, kernel_num=kernel_num)
+                    reduction=reduction, kernel_num=kernel_num, strategy=strategy)
 
 
 # 输入 N C H W,  输出 N C H W
 if __name__ == '__main__':
-    dconv3x3 = odconv3x3(64, 64).cuda()
-    input = torch.rand(3, 64, 32, 32).cuda()
+    import sys
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    dconv3x3 = odconv3x3(64, 64).to(device)
+    input = torch.rand(3, 64, 32, 32).to(device)
     output = dconv3x3(input)
     print(input.size(), output.size())
+
+    # 两种执行策略结果一致
+    block = ODConv2d(64, 64, 3, padding=1, kernel_num=4).to(device).eval()
+    with torch.no_grad():
+        block.strategy = 'grouped'
+        grouped = block(input)
+        block.strategy = 'static'
+        static = block(input)
+    assert torch.allclose(grouped, static, rtol=1e-4, atol=1e-4), (grouped - static).abs().max()
+
+    # CPU 基准：python "(iclr2022）odconv.py" --benchmark，比较 B = 1, 8, 64 时哪种策略更快
+    if '--benchmark' in sys.argv:
+        from blocks.benchmark import measure
+
+        for kernel_num in (1, 4):
+            block = ODConv2d(64, 64, 3, padding=1, kernel_num=kernel_num)
+            for batch in (1, 8, 64):
+                times = {}
+                for strategy in ('grouped', 'static'):
+                    block.strategy = strategy
+                    times[strategy] = measure(block, [('tensor', (batch, 64, 32, 32))], device='cpu',
+                                              backward=False, flops=False)['fwd_ms']
+                block.strategy = 'auto'
+                print(f"kernel_num={kernel_num} B={batch:<3d} grouped {times['grouped']:8.2f} ms  "
+                      f"static {times['static']:8.2f} ms  auto -> {block._select_strategy(batch)}")
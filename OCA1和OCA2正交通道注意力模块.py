@@ -1,5 +1,6 @@
 from __future__ import annotations
-from typing import Optional, Dict
+import threading
+from typing import Optional, Dict, Tuple
 import torch
 from torch import Tensor
 import torch.nn as nn
@@ -29,42 +30,74 @@ import torch.nn as nn
 这个注意力模块适用于所有CV任务，提高模型的效率和性能。
 '''
 
+def _orthonormal_rows(x):
+    # (..., n, d) with n <= d: Gram-Schmidt of the n rows in order, done with one (batched) QR decomposition.
+    # QR fixes the basis only up to the signs of the columns; a positive diag(R) is the Gram-Schmidt solution.
+    q, r = torch.linalg.qr(x.transpose(-1, -2).double())
+    q = q * torch.sign(torch.diagonal(r, dim1=-2, dim2=-1)).unsqueeze(-2)
+    return q.transpose(-1, -2).to(x.dtype)
+
+
 def gram_schmidt(input):
-    def projection(u, v):
-        return (v * u).sum() / (u * u).sum() * u
-    output = []
-    for x in input:
-        for y in output:
-            x = x - projection(y, x)
-        x = x/x.norm(p=2)
-        output.append(x)
-    return torch.stack(output)
-
-def initialize_orthogonal_filters(c, h, w):
+    return _orthonormal_rows(input.reshape(input.shape[0], -1)).view(input.shape)
+
+def initialize_orthogonal_filters(c, h, w, generator=None):
 
     if h*w < c:
-        n = c//(h*w)
-        gram = []
-        for i in range(n):
-            gram.append(gram_schmidt(torch.rand([h * w, 1, h, w])))
-        return torch.cat(gram, dim=0)
+        # blocks of h*w orthogonal filters, the last block is truncated when h*w does not divide c
+        n = -(-c // (h * w))
+        gram = _orthonormal_rows(torch.rand([n, h * w, h * w], generator=generator))
+        return gram.reshape(n * h * w, 1, h, w)[:c]
     else:
-        return gram_schmidt(torch.rand([c, 1, h, w]))
+        return _orthonormal_rows(torch.rand([c, h * w], generator=generator)).view(c, 1, h, w)
 class GramSchmidtTransform(torch.nn.Module):
-    instance: Dict[int, Optional[GramSchmidtTransform]] = {}
+    # process-wide cache of the (CPU) filter tensors per (c, h, seed, dtype); seed=None draws from the global RNG
+    # once. Only the values are shared: every transform registers its own copy as buffer, so load_state_dict and
+    # .to()/.cuda()/.half() of one model never touch the filters of another layer or model.
+    filters: Dict[Tuple[int, int, Optional[int], torch.dtype], Tensor] = {}
+    _lock = threading.Lock()
     constant_filter: Tensor
 
     @staticmethod
-    def build(c: int, h: int):
-        if c not in GramSchmidtTransform.instance:
-            GramSchmidtTransform.instance[(c, h)] = GramSchmidtTransform(c, h)
-        return GramSchmidtTransform.instance[(c, h)]
+    def build(c: int, h: int, seed: Optional[int] = None, dtype: torch.dtype = torch.float32):
+        key = (c, h, seed, dtype)
+        with GramSchmidtTransform._lock:
+            constant_filter = GramSchmidtTransform.filters.get(key)
+            if constant_filter is None:
+                constant_filter = GramSchmidtTransform(c, h, seed=seed, dtype=dtype).constant_filter
+                GramSchmidtTransform.filters[key] = constant_filter
+        return GramSchmidtTransform(c, h, seed=seed, dtype=dtype, constant_filter=constant_filter)
+
+    @staticmethod
+    def save_cache(path):
+        """ Write all cached filters to path (torch.save), see load_cache. """
+        with GramSchmidtTransform._lock:
+            entries = [(c, h, seed, str(dtype).replace('torch.', ''), constant_filter)
+                       for (c, h, seed, dtype), constant_filter in GramSchmidtTransform.filters.items()]
+        torch.save(entries, path)
+
+    @staticmethod
+    def load_cache(path):
+        """ Add the filters saved by save_cache to the cache; later build() calls reuse them instead of recomputing. """
+        entries = torch.load(path, map_location='cpu')
+        with GramSchmidtTransform._lock:
+            for c, h, seed, dtype, constant_filter in entries:
+                dtype = getattr(torch, dtype)
+                GramSchmidtTransform.filters[(c, h, seed, dtype)] = constant_filter.detach().to(dtype)
+
+    @staticmethod
+    def clear_cache():
+        with GramSchmidtTransform._lock:
+            GramSchmidtTransform.filters.clear()
 
-    def __init__(self, c: int, h: int):
+    def __init__(self, c: int, h: int, seed: Optional[int] = None, dtype: torch.dtype = torch.float32,
+                 constant_filter: Optional[Tensor] = None):
         super().__init__()
-        with torch.no_grad():
-            rand_ortho_filters = initialize_orthogonal_filters(c, h, h).view(c, h, h)
-        self.register_buffer("constant_filter", rand_ortho_filters.detach())
+        if constant_filter is None:
+            generator = torch.Generator().manual_seed(seed) if seed is not None else None
+            with torch.no_grad():
+                constant_filter = initialize_orthogonal_filters(c, h, h, generator=generator).view(c, h, h)
+        self.register_buffer("constant_filter", constant_filter.detach().to(dtype, copy=True))
 
     def forward(self, x):
         _, _, h, w = x.shape
@@ -89,7 +122,7 @@ def conv3x3(in_planes, out_planes, stride=1):
                      padding=1, bias=False)
 
 class OCA1(nn.Module):
-    def __init__(self, inplanes,planes, height, stride=1, downsample=None):
+    def __init__(self, inplanes,planes, height, stride=1, downsample=None, seed=None):
         super(OCA1, self).__init__()
         self._process: nn.Module = nn.Sequential(
             nn.Conv2d(inplanes, planes, kernel_size=1, bias=False),
@@ -113,7 +146,7 @@ class OCA1(nn.Module):
             nn.Sigmoid(),
         )
         self.OrthoAttention =Attention()
-        self.F_C_A = GramSchmidtTransform.build(4 * planes, height)
+        self.F_C_A = GramSchmidtTransform.build(4 * planes, height, seed=seed)
     def forward(self, x):
         residual = x if self.downsample is None else self.downsample(x)
         out = self._process(x)
@@ -127,7 +160,7 @@ class OCA1(nn.Module):
         return activated
 
 class OCA2(nn.Module):
-    def __init__(self, inplanes, planes, height, stride=1, downsample=None):
+    def __init__(self, inplanes, planes, height, stride=1, downsample=None, seed=None):
         super(OCA2, self).__init__()
 
         self._preprocess: nn.Module = nn.Sequential(
@@ -154,7 +187,7 @@ class OCA2(nn.Module):
             nn.Sigmoid(),
         )
         self.OrthoAttention = Attention()
-        self.F_C_A = GramSchmidtTransform.build(planes, height)
+        self.F_C_A = GramSchmidtTransform.build(planes, height, seed=seed)
 
     def forward(self, x):
         residual = x if self.downsample is None else self.downsample(x)
@@ -180,4 +213,21 @@ if __name__ == '__main__':
     output = block(input)
     # 打印输入和输出的形状
     print(f"Input shape: {input.shape}")
-    print(f"Output shape: {output.shape}")
\ No newline at end of file
+    print(f"Output shape: {output.shape}")
+
+    # 正交滤波器的数值按 (c, h, seed, dtype) 全进程缓存：同样配置的模块得到相同的滤波器，
+    # 但每个模块持有自己的 buffer 副本（load_state_dict / .cuda() 互不影响），也可以保存到磁盘再加载
+    other = OCA2(inplanes=64, planes=64, height=128).F_C_A
+    assert torch.equal(other.constant_filter, block.F_C_A.constant_filter)
+    assert other.constant_filter.data_ptr() != block.F_C_A.constant_filter.data_ptr()
+    filters = block.F_C_A.constant_filter.flatten(1)
+    print("max |F F^T - I|:", (filters @ filters.T - torch.eye(filters.shape[0])).abs().max().item())
+    import os
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache_file = os.path.join(cache_dir, "oca_filters.pt")
+        GramSchmidtTransform.save_cache(cache_file)
+        GramSchmidtTransform.clear_cache()
+        GramSchmidtTransform.load_cache(cache_file)
+    assert torch.equal(OCA2(inplanes=64, planes=64, height=128).F_C_A.constant_filter, block.F_C_A.constant_filter)
\ No newline at end of file
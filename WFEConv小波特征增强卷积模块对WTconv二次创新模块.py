@@ -1,12 +1,11 @@
 import torch.nn.functional as F
-from functools import partial
-import pywt
-import pywt.data
 import math
 import torch
 from torch import nn
 from einops.layers.torch import Rearrange
 import warnings
+from reparam_util import frozen_conv
+from wavelet_util import create_wavelet_filter, wavelet_pyramid
 warnings.filterwarnings('ignore')
 '''
 二次创新模块：WFEConv小波特征增强卷积模块   （冲二，三，保四）
@@ -72,37 +71,6 @@ class CBAM(nn.Module):
         out = x * self.ca(x)
         result = out * self.sa(out)
         return result
-def create_wavelet_filter(wave, in_size, out_size, type=torch.float):
-    w = pywt.Wavelet(wave)
-    dec_hi = torch.tensor(w.dec_hi[::-1], dtype=type)
-    dec_lo = torch.tensor(w.dec_lo[::-1], dtype=type)
-    dec_filters = torch.stack([dec_lo.unsqueeze(0) * dec_lo.unsqueeze(1),
-                               dec_lo.unsqueeze(0) * dec_hi.unsqueeze(1),
-                               dec_hi.unsqueeze(0) * dec_lo.unsqueeze(1),
-                               dec_hi.unsqueeze(0) * dec_hi.unsqueeze(1)], dim=0)
-
-    dec_filters = dec_filters[:, None].repeat(in_size, 1, 1, 1)
-
-    rec_hi = torch.tensor(w.rec_hi[::-1], dtype=type).flip(dims=[0])
-    rec_lo = torch.tensor(w.rec_lo[::-1], dtype=type).flip(dims=[0])
-    rec_filters = torch.stack([rec_lo.unsqueeze(0) * rec_lo.unsqueeze(1),
-                               rec_lo.unsqueeze(0) * rec_hi.unsqueeze(1),
-                               rec_hi.unsqueeze(0) * rec_lo.unsqueeze(1),
-                               rec_hi.unsqueeze(0) * rec_hi.unsqueeze(1)], dim=0)
-    rec_filters = rec_filters[:, None].repeat(out_size, 1, 1, 1)
-    return dec_filters, rec_filters
-def wavelet_transform(x, filters):
-    b, c, h, w = x.shape
-    pad = (filters.shape[2] // 2 - 1, filters.shape[3] // 2 - 1)
-    x = F.conv2d(x, filters, stride=2, groups=c, padding=pad)
-    x = x.reshape(b, c, 4, h // 2, w // 2)
-    return x
-def inverse_wavelet_transform(x, filters):
-    b, c, _, h_half, w_half = x.shape
-    pad = (filters.shape[2] // 2 - 1, filters.shape[3] // 2 - 1)
-    x = x.reshape(b, c * 4, h_half, w_half)
-    x = F.conv_transpose2d(x, filters, stride=2, groups=c, padding=pad)
-    return x
 class Conv2d_cd(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size=3, stride=1,
                  padding=1, dilation=1, groups=1, bias=False, theta=1.0):
@@ -115,7 +83,7 @@ class Conv2d_cd(nn.Module):
         conv_weight = self.conv.weight
         conv_shape = conv_weight.shape
         conv_weight = Rearrange('c_in c_out k1 k2 -> c_in c_out (k1 k2)')(conv_weight)
-        conv_weight_cd = torch.cuda.FloatTensor(conv_shape[0], conv_shape[1], 3 * 3).fill_(0)
+        conv_weight_cd = conv_weight.new_zeros(conv_shape[0], conv_shape[1], 3 * 3)
         conv_weight_cd[:, :, :] = conv_weight[:, :, :]
         conv_weight_cd[:, :, 4] = conv_weight[:, :, 4] - conv_weight[:, :, :].sum(2)
         conv_weight_cd = Rearrange('c_in c_out (k1 k2) -> c_in c_out k1 k2', k1=conv_shape[2], k2=conv_shape[3])(
@@ -158,10 +126,7 @@ class Conv2d_rd(nn.Module):
         else:
             conv_weight = self.conv.weight
             conv_shape = conv_weight.shape
-            if conv_weight.is_cuda:
-                conv_weight_rd = torch.cuda.FloatTensor(conv_shape[0], conv_shape[1], 5 * 5).fill_(0)
-            else:
-                conv_weight_rd = torch.zeros(conv_shape[0], conv_shape[1], 5 * 5)
+            conv_weight_rd = conv_weight.new_zeros(conv_shape[0], conv_shape[1], 5 * 5)
             conv_weight = Rearrange('c_in c_out k1 k2 -> c_in c_out (k1 k2)')(conv_weight)
             conv_weight_rd[:, :, [0, 2, 4, 10, 14, 20, 22, 24]] = conv_weight[:, :, 1:]
             conv_weight_rd[:, :, [6, 7, 8, 11, 13, 16, 17, 18]] = -conv_weight[:, :, 1:] * self.theta
@@ -183,7 +148,7 @@ class Conv2d_hd(nn.Module):
     def get_weight(self):
         conv_weight = self.conv.weight
         conv_shape = conv_weight.shape
-        conv_weight_hd = torch.cuda.FloatTensor(conv_shape[0], conv_shape[1], 3 * 3).fill_(0)
+        conv_weight_hd = conv_weight.new_zeros(conv_shape[0], conv_shape[1], 3 * 3)
         conv_weight_hd[:, :, [0, 3, 6]] = conv_weight[:, :, :]
         conv_weight_hd[:, :, [2, 5, 8]] = -conv_weight[:, :, :]
         conv_weight_hd = Rearrange('c_in c_out (k1 k2) -> c_in c_out k1 k2', k1=conv_shape[2], k2=conv_shape[2])(
@@ -200,7 +165,7 @@ class Conv2d_vd(nn.Module):
     def get_weight(self):
         conv_weight = self.conv.weight
         conv_shape = conv_weight.shape
-        conv_weight_vd = torch.cuda.FloatTensor(conv_shape[0], conv_shape[1], 3 * 3).fill_(0)
+        conv_weight_vd = conv_weight.new_zeros(conv_shape[0], conv_shape[1], 3 * 3)
         conv_weight_vd[:, :, [0, 1, 2]] = conv_weight[:, :, :]
         conv_weight_vd[:, :, [6, 7, 8]] = -conv_weight[:, :, :]
         conv_weight_vd = Rearrange('c_in c_out (k1 k2) -> c_in c_out k1 k2', k1=conv_shape[2], k2=conv_shape[2])(
@@ -218,7 +183,7 @@ class DEConv(nn.Module):
         self.conv1_4 = Conv2d_ad(dim, dim, 3, bias=True)
         self.conv1_5 = nn.Conv2d(dim, dim, 3, padding=1, bias=True)
 
-    def forward(self, x):
+    def get_equivalent_kernel_bias(self):
         w1, b1 = self.conv1_1.get_weight()
         w2, b2 = self.conv1_2.get_weight()
         w3, b3 = self.conv1_3.get_weight()
@@ -227,9 +192,28 @@ class DEConv(nn.Module):
 
         w = w1 + w2 + w3 + w4 + w5
         b = b1 + b2 + b3 + b4 + b5
+        return w, b
+
+    def forward(self, x):
+        if hasattr(self, 'conv'):  # deploy mode
+            return self.conv(x)
+        w, b = self.get_equivalent_kernel_bias()
         res = nn.functional.conv2d(input=x, weight=w, bias=b, stride=1, padding=1, groups=1)
         return res
 
+    @torch.no_grad()
+    def switch_to_deploy(self):
+        # 推理阶段：五个差分卷积分支只合并一次，得到一个等价的普通 3x3 卷积
+        if hasattr(self, 'conv'):
+            return self
+        w, b = self.get_equivalent_kernel_bias()
+        self.conv = frozen_conv(w, b)
+        for name in ('conv1_1', 'conv1_2', 'conv1_3', 'conv1_4', 'conv1_5'):
+            delattr(self, name)
+        return self
+
+    fuse = switch_to_deploy
+
 class WFEConv(nn.Module): #小波特征增强卷积模块
     def __init__(self, in_channels, out_channels, kernel_size=5, stride=1, bias=True, wt_levels=1, wt_type='db1'):
         super(WFEConv, self).__init__()
@@ -243,8 +227,6 @@ class WFEConv(nn.Module): #小波特征增强卷积模块
         self.wt_filter = nn.Parameter(self.wt_filter, requires_grad=False)
         self.iwt_filter = nn.Parameter(self.iwt_filter, requires_grad=False)
 
-        self.wt_function = partial(wavelet_transform, filters=self.wt_filter)
-        self.iwt_function = partial(inverse_wavelet_transform, filters=self.iwt_filter)
 
         self.base_conv = nn.Conv2d(in_channels, in_channels, kernel_size, padding='same', stride=1, dilation=1,
                                    groups=in_channels, bias=bias)
@@ -268,43 +250,8 @@ class WFEConv(nn.Module): #小波特征增强卷积模块
 
     def forward(self, x):
 
-        x_ll_in_levels = []
-        x_h_in_levels = []
-        shapes_in_levels = []
-        curr_x_ll = x
-
-        for i in range(self.wt_levels):
-            curr_shape = curr_x_ll.shape
-            shapes_in_levels.append(curr_shape)
-            if (curr_shape[2] % 2 > 0) or (curr_shape[3] % 2 > 0):
-                curr_pads = (0, curr_shape[3] % 2, 0, curr_shape[2] % 2)
-                curr_x_ll = F.pad(curr_x_ll, curr_pads)
-
-            curr_x = self.wt_function(curr_x_ll)
-            curr_x_ll = curr_x[:, :, 0, :, :]
-
-            shape_x = curr_x.shape
-            curr_x_tag = curr_x.reshape(shape_x[0], shape_x[1] * 4, shape_x[3], shape_x[4])
-            curr_x_tag = self.wavelet_scale[i](self.wavelet_convs[i](curr_x_tag))
-            curr_x_tag = curr_x_tag.reshape(shape_x)
-
-            x_ll_in_levels.append(curr_x_tag[:, :, 0, :, :])
-            x_h_in_levels.append(curr_x_tag[:, :, 1:4, :, :])
-        next_x_ll = 0
-        for i in range(self.wt_levels - 1, -1, -1):
-            curr_x_ll = x_ll_in_levels.pop()
-            curr_x_h = x_h_in_levels.pop()
-            curr_shape = shapes_in_levels.pop()
-
-            curr_x_ll = curr_x_ll + next_x_ll
-
-            curr_x = torch.cat([curr_x_ll.unsqueeze(2), curr_x_h], dim=2)
-            next_x_ll = self.iwt_function(curr_x)
-
-            next_x_ll = next_x_ll[:, :, :curr_shape[2], :curr_shape[3]]
-
-        x_tag = next_x_ll
-        assert len(x_ll_in_levels) == 0
+        # all wavelet levels in one pass, see wavelet_util.wavelet_pyramid
+        x_tag = wavelet_pyramid(x, self.wt_filter, self.iwt_filter, self.wavelet_convs, self.wavelet_scale)
         # x = self.base_scale(self.base_conv(x))
         x = self.base_scale(self.deconv(x)) #使用DEconv顶会卷积去替换普通卷积，
         x = x + x_tag
@@ -312,6 +259,25 @@ class WFEConv(nn.Module): #小波特征增强卷积模块
         if self.do_stride is not None:
             x = self.do_stride(x)
         return x
+
+    @torch.no_grad()
+    def switch_to_deploy(self):
+        # 推理阶段：DEConv 合并成一个 3x3 卷积，并把紧跟其后的 base_scale（逐通道缩放）折叠进卷积核和偏置；
+        # 小波分支的 wavelet_scale 同样折叠进前面的深度卷积
+        if isinstance(self.base_scale, nn.Identity):
+            return self
+        self.deconv.switch_to_deploy()
+        scale = self.base_scale.weight.reshape(-1)
+        self.deconv.conv.weight.mul_(scale.view(-1, 1, 1, 1))
+        self.deconv.conv.bias.mul_(scale)
+        self.base_scale = nn.Identity()
+        for conv, wavelet_scale in zip(self.wavelet_convs, self.wavelet_scale):
+            conv.weight.mul_(wavelet_scale.weight.reshape(-1, 1, 1, 1))
+            conv.requires_grad_(False)
+        self.wavelet_scale = nn.ModuleList([nn.Identity() for _ in range(self.wt_levels)])
+        return self
+
+    fuse = switch_to_deploy
 class _ScaleModule(nn.Module):
     def __init__(self, dims, init_scale=1.0, init_bias=0):
         super(_ScaleModule, self).__init__()
@@ -322,8 +288,17 @@ class _ScaleModule(nn.Module):
         return torch.mul(self.weight, x)
 # 输入 N C H W,  输出 N C H W
 if __name__ == '__main__':
-    block = WFEConv(32,32).cuda()
-    input = torch.rand(1, 32, 64, 64).cuda()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    block = WFEConv(32,32).to(device)
+    input = torch.rand(1, 32, 64, 64).to(device)
     output = block(input)
     print("input.shape:", input.shape)
-    print("output.shape:",output.shape)
\ No newline at end of file
+    print("output.shape:",output.shape)
+
+    # 重参数化等价性检查：switch_to_deploy() 前后输出应一致
+    block.eval()
+    with torch.no_grad():
+        before = block(input)
+        after = block.switch_to_deploy()(input)
+    assert torch.allclose(before, after, rtol=1e-4, atol=1e-4), (before - after).abs().max()
+    print("deploy max abs diff:", (before - after).abs().max().item())
@@ -0,0 +1,45 @@
+"""Importable access to the plug-and-play blocks of this repository.
+
+Block classes are resolved lazily: ``import blocks`` imports nothing but the
+standard library, and ``blocks.WTConv2d`` (or ``blocks.get("WTConv2d")``)
+imports only the single file that defines ``WTConv2d``.
+"""
+from .registry import (
+    REPO_ROOT,
+    AmbiguousBlockError,
+    BlockNotFoundError,
+    BlockRegistry,
+    MissingDependencyError,
+    registry,
+)
+
+__all__ = [
+    "REPO_ROOT",
+    "AmbiguousBlockError",
+    "BlockNotFoundError",
+    "BlockRegistry",
+    "MissingDependencyError",
+    "registry",
+    "get",
+    "list_blocks",
+]
+
+
+def get(name, source=None):
+    """Return the block class ``name`` (see :meth:`BlockRegistry.get`)."""
+    return registry.get(name, source=source)
+
+
+def list_blocks():
+    """Names of all blocks defined in the repository."""
+    return registry.names()
+
+
+def __getattr__(name):
+    if name.startswith("_") or name not in registry:
+        raise AttributeError(f"module 'blocks' has no attribute '{name}'")
+    return registry.get(name)
+
+
+def __dir__():
+    return sorted(set(globals()) | set(registry.names()))
@@ -0,0 +1,710 @@
+"""CPU-runnable latency / throughput / memory benchmark over every block's ``__main__`` example.
+
+Almost every block file ends in an ``if __name__ == '__main__':`` smoke test that
+builds one module with a hard-coded shape (often followed by ``.cuda()``) and
+prints the input and output sizes.  This module reads those smoke tests
+*statically* (see :func:`discover`), turns each ``block(input)`` call into an
+:class:`Example`, and measures it on any device over a sweep of batch sizes,
+resolutions and channel counts.
+
+Command line::
+
+    python -m blocks.benchmark --list
+    python -m blocks.benchmark --match "Attention|MDTA" --resolution 256 1024 \\
+        --json report.json --csv report.csv
+    python -m blocks.benchmark --json new.json --baseline report.json --tolerance 0.1
+
+Each record holds the forward and backward wall time (median, ms), the
+throughput (samples/s), the parameter count, the forward FLOPs (when
+``torch.utils.flop_counter`` is available), the peak RSS of the process and,
+on CUDA, the peak allocator memory.  RSS is a process-wide high-water mark, so
+use ``--isolate`` to run every case in a fresh interpreter when the memory
+columns matter.
+"""
+import argparse
+import ast
+import copy
+import csv
+import itertools
+import json
+import platform
+import re
+import statistics
+import sys
+import time
+import traceback
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from .registry import REPO_ROOT, registry
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+__all__ = [
+    "Example",
+    "discover",
+    "measure",
+    "run",
+    "compare",
+    "write_json",
+    "write_csv",
+    "main",
+]
+
+_TENSOR_FACTORIES = {"rand", "randn", "ones", "zeros", "empty"}
+_DEVICE_MOVES = {"cuda", "cpu", "to"}
+_TIME_METRICS = ("fwd_ms", "bwd_ms")
+_MEMORY_METRICS = ("peak_rss_mb", "peak_alloc_mb")
+CSV_FIELDS = [
+    "source", "block", "example", "batch", "channels", "resolution", "device", "status",
+    "params", "flops", "fwd_ms", "bwd_ms", "throughput", "peak_rss_mb", "peak_alloc_mb",
+    "input_shapes", "error",
+]
+
+
+@dataclass
+class Example:
+    """One ``block(inputs...)`` call found in a file's ``__main__`` smoke test.
+
+    ``ctor`` is the source of the constructor call with device moves stripped and
+    ``setup`` the constant/helper assignments that preceded it (e.g. ``dim = 64`` or
+    ``configs = Configs()``).  Forward arguments are stored as ``("tensor", shape)``,
+    ``("tensors", [shapes])`` or ``("const", value)`` entries.
+    """
+    source: str
+    block: str
+    ctor: str
+    setup: list = field(default_factory=list)
+    args: list = field(default_factory=list)
+    kwargs: dict = field(default_factory=dict)
+    index: int = 0
+
+    @property
+    def name(self):
+        return f"{Path(self.source).stem}:{self.block}" + (f"#{self.index}" if self.index else "")
+
+    @property
+    def shapes(self):
+        return _input_shapes(self.args, self.kwargs)
+
+
+def _input_shapes(args, kwargs):
+    shapes = []
+    for kind, value in itertools.chain(args, kwargs.values()):
+        if kind == "tensor":
+            shapes.append(tuple(value))
+        elif kind == "tensors":
+            shapes.extend(tuple(s) for s in value)
+    return shapes
+
+
+# --------------------------------------------------------------------------- discovery
+class _StripDeviceMoves(ast.NodeTransformer):
+    """``x.cuda()`` / ``x.to('cuda')`` / ``x.cpu()`` -> ``x``."""
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if isinstance(node.func, ast.Attribute) and node.func.attr in _DEVICE_MOVES:
+            return node.func.value
+        return node
+
+
+def _is_main_guard(node):
+    if not isinstance(node, ast.If) or not isinstance(node.test, ast.Compare):
+        return False
+    parts = [node.test.left, *node.test.comparators]
+    return any(isinstance(p, ast.Name) and p.id == "__name__" for p in parts) and any(
+        isinstance(p, ast.Constant) and p.value == "__main__" for p in parts)
+
+
+def _literal(value):
+    if isinstance(value, (list, tuple)):
+        return all(_literal(v) for v in value)
+    return value is None or isinstance(value, (bool, int, float, str))
+
+
+def _eval_const(node, consts):
+    try:
+        value = eval(compile(ast.Expression(node), "<example>", "eval"), {"__builtins__": {}}, dict(consts))
+    except Exception:
+        return None, False
+    return value, _literal(value)
+
+
+def _tensor_shape(node, consts):
+    """Shape of a ``torch.rand(...)``-style call, or ``None``."""
+    if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+            and node.func.attr in _TENSOR_FACTORIES
+            and isinstance(node.func.value, ast.Name) and node.func.value.id == "torch"):
+        return None
+    dims = []
+    args = list(node.args) + [kw.value for kw in node.keywords if kw.arg == "size"]
+    for arg in args:
+        value, ok = _eval_const(arg.value if isinstance(arg, ast.Starred) else arg, consts)
+        if not ok:
+            return None
+        if isinstance(value, (list, tuple)):
+            dims.extend(value)
+        else:
+            dims.append(value)
+    if not dims or not all(isinstance(d, int) and not isinstance(d, bool) for d in dims):
+        return None
+    return tuple(dims)
+
+
+def _main_body(tree):
+    body = []
+    for node in tree.body:
+        if _is_main_guard(node):
+            body.extend(node.body)
+    # flatten ``with torch.no_grad():`` style wrappers
+    flat = []
+    for stmt in body:
+        flat.extend(stmt.body if isinstance(stmt, ast.With) else [stmt])
+    return flat
+
+
+def discover_file(path):
+    """Return ``(examples, skipped)`` for one block file without importing it."""
+    path = Path(path)
+    tree = ast.parse(path.read_text(encoding="utf-8"), filename=str(path))
+    classes = {node.name for node in tree.body if isinstance(node, ast.ClassDef)}
+    consts, env, setup = {}, {}, []
+    examples, skipped, seen = [], [], set()
+
+    def forward_arg(node):
+        if isinstance(node, ast.Name) and env.get(node.id, (None,))[0] in ("tensor", "tensors"):
+            return env[node.id]
+        shape = _tensor_shape(node, consts)
+        if shape is not None:
+            return ("tensor", shape)
+        if isinstance(node, (ast.List, ast.Tuple)):
+            shapes = [forward_arg(elt) for elt in node.elts]
+            if shapes and all(s is not None and s[0] == "tensor" for s in shapes):
+                return ("tensors", [s[1] for s in shapes])
+            return None
+        value, ok = _eval_const(node, consts)
+        return ("const", value) if ok else None
+
+    def visit_call(call):
+        if not (isinstance(call, ast.Call) and isinstance(call.func, ast.Name)):
+            return
+        bound = env.get(call.func.id)
+        if bound is None or bound[0] != "module":
+            return
+        _, block, ctor, ctor_setup = bound
+        args = [forward_arg(a) for a in call.args]
+        kwargs = {kw.arg: forward_arg(kw.value) for kw in call.keywords if kw.arg}
+        if any(a is None for a in itertools.chain(args, kwargs.values())):
+            skipped.append((block, f"unsupported forward arguments: {ast.unparse(call)}"))
+            return
+        example = Example(str(path), block, ctor, ctor_setup, args, kwargs)
+        key = (block, ctor, repr(args), repr(kwargs))
+        if key not in seen:
+            seen.add(key)
+            example.index = sum(e.block == block for e in examples)
+            examples.append(example)
+
+    for stmt in _main_body(tree):
+        stmt = _StripDeviceMoves().visit(copy.deepcopy(stmt))
+        if isinstance(stmt, ast.Expr):
+            visit_call(stmt.value)
+            continue
+        if not isinstance(stmt, ast.Assign) or len(stmt.targets) != 1:
+            continue
+        target, value = stmt.targets[0], stmt.value
+        if isinstance(target, ast.Tuple):
+            values, ok = _eval_const(value, consts)
+            names = [t.id for t in target.elts if isinstance(t, ast.Name)]
+            if ok and isinstance(values, (list, tuple)) and len(values) == len(names) == len(target.elts):
+                for name, v in zip(names, values):
+                    consts[name] = v
+                    env[name] = ("const",)
+                setup.append(ast.unparse(stmt))
+            else:
+                visit_call(value)
+                for name in names:
+                    env.pop(name, None)
+            continue
+        if not isinstance(target, ast.Name):
+            continue
+        name = target.id
+        if isinstance(value, ast.Call) and isinstance(value.func, ast.Name):
+            bound = env.get(value.func.id)
+            if bound is not None and bound[0] == "module":
+                visit_call(value)
+                env.pop(name, None)
+                continue
+            if value.func.id in classes and bound is None:
+                env[name] = ("module", value.func.id, ast.unparse(value), list(setup))
+                consts.pop(name, None)
+                continue
+        shape = _tensor_shape(value, consts)
+        if shape is not None:
+            env[name] = ("tensor", shape)
+            consts.pop(name, None)
+            continue
+        arg = forward_arg(value) if isinstance(value, (ast.List, ast.Tuple)) else None
+        if arg is not None and arg[0] == "tensors":
+            env[name] = arg
+            continue
+        const, ok = _eval_const(value, consts)
+        if ok:
+            consts[name] = const
+            env[name] = ("const",)
+        else:
+            # helper objects such as ``configs = Configs()``; tensors derived from
+            # other tensors (``x.reshape(...)``) are not tracked
+            consts.pop(name, None)
+            env[name] = ("expr",)
+        setup.append(ast.unparse(stmt))
+    return examples, skipped
+
+
+def discover(root=None, match=None):
+    """Find every example in the block files under ``root`` (default: the repository root).
+
+    Returns ``(examples, skipped)`` where ``skipped`` lists ``(name, reason)`` pairs for
+    smoke tests that could not be turned into an :class:`Example`.
+    """
+    root = Path(root) if root is not None else REPO_ROOT
+    pattern = re.compile(match) if match else None
+    examples, skipped = [], []
+    for path in sorted(root.glob("*.py")):
+        try:
+            found, not_found = discover_file(path)
+        except SyntaxError as e:
+            skipped.append((path.stem, f"syntax error: {e}"))
+            continue
+        examples.extend(e for e in found if pattern is None or pattern.search(e.name))
+        skipped.extend((f"{path.stem}:{block}", reason) for block, reason in not_found
+                       if pattern is None or pattern.search(f"{path.stem}:{block}"))
+    return examples, skipped
+
+
+# --------------------------------------------------------------------------- sweeps
+class _ReplaceInts(ast.NodeTransformer):
+    def __init__(self, mapping):
+        self.mapping = mapping
+
+    def visit_Constant(self, node):
+        if type(node.value) is int and node.value in self.mapping:
+            return ast.copy_location(ast.Constant(self.mapping[node.value]), node)
+        return node
+
+
+def _ctor_ints(example):
+    ints = set()
+    for src in [example.ctor, *example.setup]:
+        for node in ast.walk(ast.parse(src)):
+            if isinstance(node, ast.Constant) and type(node.value) is int:
+                ints.add(node.value)
+    return ints
+
+
+def _layout(example):
+    """``(channel_dim, spatial_dims)`` of the first input tensor, or ``None``."""
+    shapes = example.shapes
+    if not shapes:
+        return None
+    shape = shapes[0]
+    if len(shape) == 3:
+        return -1, ()
+    if len(shape) < 4:
+        return None
+    ints = _ctor_ints(example)
+    if shape[1] not in ints and shape[-1] in ints:
+        return len(shape) - 1, tuple(range(1, len(shape) - 1))
+    return 1, tuple(range(2, len(shape)))
+
+
+def configure(example, batch=None, channels=None, resolution=None):
+    """Return ``(ctor, setup, args, kwargs)`` with the sweep overrides applied.
+
+    Channels are changed on every input whose channel dimension matches the example's
+    channel count and on every integer literal of the constructor with that value;
+    resolution scales the spatial dimensions of 4D/5D inputs proportionally to the
+    first input.  Raises ``ValueError`` when the override does not apply to the example.
+    """
+    layout = _layout(example)
+    first = example.shapes[0] if example.shapes else None
+    mapping = {}
+    if channels is not None:
+        if layout is None:
+            raise ValueError("channel sweep needs a tensor input")
+        mapping[first[layout[0]]] = channels
+    scale = size = None
+    if resolution is not None:
+        if layout is None or not layout[1]:
+            raise ValueError(f"resolution sweep needs a 4D/5D input, got {first}")
+        size = first[layout[1][-1]]
+        scale = resolution / size
+        spatial = {first[d] for d in layout[1]}
+        if len(spatial) == 1 and size not in mapping:
+            # e.g. ``input_resolution=128`` in the constructor
+            mapping[size] = resolution
+
+    def reshape(shape):
+        shape = list(shape)
+        if batch is not None:
+            shape[0] = batch
+        if layout is not None and len(shape) == len(first):
+            channel_dim, spatial_dims = layout
+            if channels is not None and shape[channel_dim] == first[channel_dim]:
+                shape[channel_dim] = channels
+            if scale is not None:
+                for d in spatial_dims:
+                    shape[d] = max(1, int(round(shape[d] * scale)))
+        return tuple(shape)
+
+    def convert(arg):
+        kind, value = arg
+        if kind == "tensor":
+            return kind, reshape(value)
+        if kind == "tensors":
+            return kind, [reshape(s) for s in value]
+        if scale is not None and type(value) is int and value == size:
+            return kind, resolution  # explicit ``H, W`` forward arguments
+        return arg
+
+    def rewrite(src):
+        return ast.unparse(_ReplaceInts(mapping).visit(ast.parse(src))) if mapping else src
+
+    args = [convert(a) for a in example.args]
+    kwargs = {k: convert(v) for k, v in example.kwargs.items()}
+    return rewrite(example.ctor), [rewrite(s) for s in example.setup], args, kwargs
+
+
+# --------------------------------------------------------------------------- measuring
+def _torch():
+    import torch
+    return torch
+
+
+def _rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in KiB on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _tensors(obj):
+    torch = _torch()
+    if isinstance(obj, torch.Tensor):
+        yield obj
+    elif isinstance(obj, (list, tuple)):
+        for o in obj:
+            yield from _tensors(o)
+    elif isinstance(obj, dict):
+        for o in obj.values():
+            yield from _tensors(o)
+
+
+def _make_inputs(args, kwargs, device, requires_grad=False):
+    torch = _torch()
+
+    def make(arg):
+        kind, value = arg
+        if kind == "tensor":
+            return torch.randn(*value, device=device, requires_grad=requires_grad)
+        if kind == "tensors":
+            return [torch.randn(*s, device=device, requires_grad=requires_grad) for s in value]
+        return value
+
+    return [make(a) for a in args], {k: make(v) for k, v in kwargs.items()}
+
+
+def _sync(device):
+    torch = _torch()
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize(device)
+
+
+def _count_flops(module, args, kwargs):
+    torch = _torch()
+    try:
+        from torch.utils.flop_counter import FlopCounterMode
+    except ImportError:
+        return None
+    counter = FlopCounterMode(display=False)
+    with torch.no_grad(), counter:
+        module(*args, **kwargs)
+    return counter.get_total_flops()
+
+
+def measure(module, args, kwargs=None, *, device="cpu", warmup=2, repeat=5, backward=True, flops=True):
+    """Time one module on prepared inputs.
+
+    ``args``/``kwargs`` are the forward arguments in the :class:`Example` encoding
+    (``("tensor", shape)``, ``("tensors", shapes)`` or ``("const", value)``).  Returns a dict
+    with ``params``, ``flops``, ``fwd_ms``, ``bwd_ms``, ``throughput``, ``peak_rss_mb`` and
+    ``peak_alloc_mb``.
+    """
+    torch = _torch()
+    kwargs = kwargs or {}
+    module = module.to(device)
+    cuda = str(device).startswith("cuda")
+    if cuda:
+        torch.cuda.reset_peak_memory_stats(device)
+    shapes = _input_shapes(args, kwargs)
+    batch = shapes[0][0] if shapes else 1
+    result = {"params": sum(p.numel() for p in module.parameters())}
+
+    f_args, f_kwargs = _make_inputs(args, kwargs, device)
+    module.eval()
+    result["flops"] = _count_flops(module, f_args, f_kwargs) if flops else None
+    fwd = []
+    with torch.no_grad():
+        for i in range(warmup + repeat):
+            _sync(device)
+            start = time.perf_counter()
+            module(*f_args, **f_kwargs)
+            _sync(device)
+            if i >= warmup:
+                fwd.append(time.perf_counter() - start)
+    result["fwd_ms"] = statistics.median(fwd) * 1e3
+    result["throughput"] = batch / statistics.median(fwd)
+
+    result["bwd_ms"] = None
+    if backward:
+        module.train()
+        b_args, b_kwargs = _make_inputs(args, kwargs, device, requires_grad=True)
+        bwd = []
+        for i in range(warmup + repeat):
+            module.zero_grad(set_to_none=True)
+            out = module(*b_args, **b_kwargs)
+            grads = [t for t in _tensors(out) if t.requires_grad]
+            if not grads:
+                break
+            loss = sum(t.float().sum() for t in grads)
+            _sync(device)
+            start = time.perf_counter()
+            loss.backward()
+            _sync(device)
+            if i >= warmup:
+                bwd.append(time.perf_counter() - start)
+        if bwd:
+            result["bwd_ms"] = statistics.median(bwd) * 1e3
+    result["peak_rss_mb"] = _rss_mb()
+    result["peak_alloc_mb"] = torch.cuda.max_memory_allocated(device) / 2 ** 20 if cuda else None
+    return result
+
+
+def build(example, ctor, setup, device="cpu", setup_errors=None):
+    """Instantiate ``ctor`` in the namespace of the example's source file.
+
+    ``setup`` may contain statements the constructor does not need (e.g. assignments
+    derived from input tensors that are never materialised), so a failing statement
+    does not stop the build.  Failures are appended to ``setup_errors`` as
+    ``"<statement>: <ExcType>: <message>"``; if the constructor itself then fails,
+    the error is re-raised with those statements in its message.
+    """
+    module = registry.load_source(example.source, block=example.block)
+    namespace = dict(vars(module))
+    failed = []
+    for stmt in setup:
+        try:
+            exec(stmt, namespace)
+        except Exception as e:
+            failed.append(f"{stmt!r}: {type(e).__name__}: {e}")
+    if setup_errors is not None:
+        setup_errors.extend(failed)
+    try:
+        block = eval(ctor, namespace)
+    except Exception as e:
+        if not failed:
+            raise
+        raise RuntimeError(f"{ctor!r} failed ({type(e).__name__}: {e}) after failed setup statements: "
+                           + "; ".join(failed)) from e
+    return block.to(device)
+
+
+def _case(example, batch, channels, resolution, options):
+    torch = _torch()
+    record = {
+        "source": Path(example.source).name, "block": example.block, "example": example.name,
+        "batch": batch, "channels": channels, "resolution": resolution,
+        "device": options["device"], "status": "ok", "error": None,
+    }
+    try:
+        ctor, setup, args, kwargs = configure(example, batch, channels, resolution)
+    except ValueError as e:
+        record.update(status="skipped", error=str(e))
+        return record
+    record["input_shapes"] = json.dumps(_input_shapes(args, kwargs))
+    try:
+        torch.manual_seed(0)
+        setup_errors = []
+        module = build(example, ctor, setup, options["device"], setup_errors=setup_errors)
+        if setup_errors:
+            # the block was built regardless; keep the ignored failures visible in the record
+            record["error"] = "ignored setup failures: " + "; ".join(setup_errors)
+        record.update(measure(module, args, kwargs, device=options["device"], warmup=options["warmup"],
+                              repeat=options["repeat"], backward=options["backward"],
+                              flops=options["flops"]))
+    except Exception as e:
+        record.update(status="error", error=f"{type(e).__name__}: {e}")
+        if options.get("verbose"):
+            traceback.print_exc()
+    return record
+
+
+def _case_in_child(payload):
+    example, batch, channels, resolution, options = payload
+    if options["threads"]:
+        _torch().set_num_threads(options["threads"])
+    return _case(example, batch, channels, resolution, options)
+
+
+def run(examples, batches=(None,), channels=(None,), resolutions=(None,), *, device="cpu", warmup=2,
+        repeat=5, backward=True, flops=True, isolate=False, threads=None, verbose=False, log=None):
+    """Benchmark ``examples`` over the cartesian product of the sweep values.
+
+    ``None`` in a sweep list keeps the example's own value.  Returns a list of records.
+    """
+    options = dict(device=device, warmup=warmup, repeat=repeat, backward=backward, flops=flops,
+                   threads=threads, verbose=verbose)
+    payloads = [(e, b, c, r, options) for e in examples
+                for b, c, r in itertools.product(batches, channels, resolutions)]
+    records = []
+    if isolate:
+        import multiprocessing
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(1, maxtasksperchild=1) as pool:
+            for payload in payloads:
+                records.append(pool.apply(_case_in_child, (payload,)))
+                if log is not None:
+                    log(records[-1])
+    else:
+        if threads:
+            _torch().set_num_threads(threads)
+        for payload in payloads:
+            records.append(_case(*payload[:4], options))
+            if log is not None:
+                log(records[-1])
+    return records
+
+
+# --------------------------------------------------------------------------- reports
+def _key(record):
+    return tuple(record.get(k) for k in ("example", "batch", "channels", "resolution", "device"))
+
+
+def compare(records, baseline, tolerance=0.1):
+    """Compare ``records`` against ``baseline`` records and return the regressions.
+
+    A metric regresses when it exceeds the baseline by more than ``tolerance``
+    (relative).  Time metrics are always compared; memory metrics only when both
+    sides report them.
+    """
+    base = {_key(r): r for r in baseline if r.get("status") == "ok"}
+    regressions = []
+    for record in records:
+        old = base.get(_key(record))
+        if old is None or record.get("status") != "ok":
+            continue
+        for metric in _TIME_METRICS + _MEMORY_METRICS:
+            new_value, old_value = record.get(metric), old.get(metric)
+            if new_value is None or not old_value:
+                continue
+            ratio = new_value / old_value
+            if ratio > 1 + tolerance:
+                regressions.append({"example": record["example"], "batch": record["batch"],
+                                    "channels": record["channels"], "resolution": record["resolution"],
+                                    "metric": metric, "baseline": old_value, "current": new_value,
+                                    "ratio": ratio})
+    return regressions
+
+
+def environment():
+    torch = _torch()
+    return {"torch": torch.__version__, "python": platform.python_version(), "platform": platform.platform(),
+            "threads": torch.get_num_threads(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def write_json(path, records, regressions=None):
+    report = {"environment": environment(), "records": records}
+    if regressions is not None:
+        report["regressions"] = regressions
+    Path(path).write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+
+
+def load_json(path):
+    report = json.loads(Path(path).read_text(encoding="utf-8"))
+    return report["records"] if isinstance(report, dict) else report
+
+
+def write_csv(path, records):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(records)
+
+
+def _fmt(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+def _print_record(record):
+    shape = record.get("input_shapes", "")
+    if record["status"] != "ok":
+        print(f"{record['example']:<60} {shape:<28} {record['status']}: {record['error']}")
+        return
+    flops = record["flops"] / 1e9 if record.get("flops") is not None else None
+    print(f"{record['example']:<60} {shape:<28} fwd {_fmt(record['fwd_ms'], '9.2f')} ms  "
+          f"bwd {_fmt(record['bwd_ms'], '9.2f')} ms  {_fmt(record['params'] / 1e6, '7.3f')} M  "
+          f"{_fmt(flops, '8.2f')} GFLOPs  rss {_fmt(record['peak_rss_mb'], '8.1f')} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m blocks.benchmark", description=__doc__.split("\n\n")[0])
+    parser.add_argument("--match", help="regex on '<file stem>:<block>' selecting examples")
+    parser.add_argument("--list", action="store_true", help="list the discovered examples and exit")
+    parser.add_argument("--batch", type=int, nargs="+", default=[None])
+    parser.add_argument("--resolution", type=int, nargs="+", default=[None],
+                        help="spatial size of the first input (others are scaled proportionally)")
+    parser.add_argument("--channels", type=int, nargs="+", default=[None])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--threads", type=int, help="torch.set_num_threads for the measurement")
+    parser.add_argument("--no-backward", dest="backward", action="store_false")
+    parser.add_argument("--no-flops", dest="flops", action="store_false")
+    parser.add_argument("--isolate", action="store_true", help="run every case in a fresh process")
+    parser.add_argument("--json", help="write the report as JSON")
+    parser.add_argument("--csv", help="write the records as CSV")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative slowdown (default 0.1)")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    examples, skipped = discover(match=args.match)
+    if args.list:
+        for example in examples:
+            print(f"{example.name:<60} {example.ctor:<50} {example.shapes}")
+        for name, reason in skipped:
+            print(f"{name:<60} skipped: {reason}")
+        return 0
+
+    records = run(examples, args.batch, args.channels, args.resolution, device=args.device,
+                  warmup=args.warmup, repeat=args.repeat, backward=args.backward, flops=args.flops,
+                  isolate=args.isolate, threads=args.threads, verbose=args.verbose, log=_print_record)
+    regressions = None
+    if args.baseline:
+        regressions = compare(records, load_json(args.baseline), args.tolerance)
+        for r in regressions:
+            print(f"REGRESSION {r['example']} b={r['batch']} c={r['channels']} r={r['resolution']} "
+                  f"{r['metric']}: {r['baseline']:.2f} -> {r['current']:.2f} ({r['ratio']:.2f}x)")
+    if args.json:
+        write_json(args.json, records, regressions)
+    if args.csv:
+        write_csv(args.csv, records)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+"""Lazy registry over the standalone block files in the repository root.
+
+Every block lives in its own top-level script whose file name contains
+parentheses, full-width brackets and Chinese text, so none of them can be
+imported with a plain ``import`` statement.  The registry indexes the class
+definitions of those scripts *textually* (nothing is imported while the index
+is built) and only loads a script the first time one of its classes is
+requested.  Heavy optional imports such as ``timm``, ``einops``, ``pywt``,
+``ultralytics`` or ``mamba_ssm`` are therefore paid for only by the blocks that
+actually need them.
+
+Usage::
+
+    from blocks import registry
+
+    WTConv2d = registry.get("WTConv2d")
+    attn = registry.get("Attention", source="(cvpr2022)MDTA")
+    print(registry.missing_dependencies("SS2D"))   # e.g. ['mamba_ssm']
+"""
+import ast
+import hashlib
+import importlib.util
+import re
+import sys
+import threading
+from pathlib import Path
+
+__all__ = [
+    "BlockRegistry",
+    "BlockNotFoundError",
+    "AmbiguousBlockError",
+    "MissingDependencyError",
+    "REPO_ROOT",
+    "registry",
+]
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# only top-level (column 0) class statements are blocks; nested helpers are not exported
+_CLASS_RE = re.compile(r"^class[ \t]+([A-Za-z_]\w*)[ \t]*[(:]", re.MULTILINE)
+# browser-style duplicate downloads, e.g. "（iccv2023）LSK (1).py" next to "（iccv2023）LSK.py"
+_COPY_RE = re.compile(r"^(.*) \(\d+\)$")
+_MODULE_PREFIX = "blocks._sources"
+
+
+class BlockNotFoundError(KeyError):
+    """Raised when no source file defines the requested block."""
+
+
+class AmbiguousBlockError(LookupError):
+    """Raised when several source files define a block with the same name."""
+
+    def __init__(self, name, sources):
+        self.name = name
+        self.sources = sources
+        candidates = ", ".join(repr(s.stem) for s in sources)
+        super().__init__(f"block '{name}' is defined in several files ({candidates}); pass source=... to select one")
+
+
+class MissingDependencyError(ImportError):
+    """Raised when a block's source file needs an optional package that is not installed."""
+
+    def __init__(self, block, source, dependency):
+        self.block = block
+        self.source = source
+        self.dependency = dependency
+        super().__init__(
+            f"block '{block}' ({source.name}) requires the optional dependency '{dependency}', "
+            f"which is not installed",
+            name=dependency,
+        )
+
+
+class BlockRegistry:
+    """Maps block (class) names to the script that defines them and loads scripts on demand.
+
+    Args:
+        root: directory holding the block scripts (default: the repository root).
+    """
+
+    def __init__(self, root=REPO_ROOT):
+        self.root = Path(root)
+        self._index = None
+        self._modules = {}
+        self._lock = threading.RLock()
+
+    # ------------------------------------------------------------------ index
+    def _build_index(self):
+        defined = {}
+        for path in sorted(self.root.glob("*.py")):
+            try:
+                text = path.read_text(encoding="utf-8")
+            except (OSError, UnicodeDecodeError):
+                continue
+            defined[path] = list(dict.fromkeys(_CLASS_RE.findall(text)))
+        index = {}
+        for path, names in defined.items():
+            copy_of = _COPY_RE.match(path.stem)
+            original = defined.get(path.with_name(f"{copy_of.group(1)}.py"), ()) if copy_of else ()
+            for name in names:
+                # a class that also exists in the original file is served from the original only
+                if name not in original:
+                    index.setdefault(name, []).append(path)
+        return index
+
+    @property
+    def index(self):
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = self._build_index()
+        return self._index
+
+    def refresh(self):
+        """Drop the cached index so newly added block files are picked up."""
+        with self._lock:
+            self._index = None
+
+    def names(self):
+        """Sorted list of all registered block names."""
+        return sorted(self.index)
+
+    def sources(self, name):
+        """All files that define ``name`` (empty if none)."""
+        return list(self.index.get(name, ()))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def __len__(self):
+        return len(self.index)
+
+    def _match_source(self, source):
+        source = str(source)
+        for path in sorted(self.root.glob("*.py")):
+            if source in (path.name, path.stem, str(path)):
+                return path
+        raise BlockNotFoundError(f"no block file named '{source}' in {self.root}")
+
+    def resolve(self, name, source=None):
+        """Return the path of the file that defines ``name``.
+
+        ``name`` may also be given as ``"<file stem>:<class name>"``.
+        """
+        if source is None and ":" in name:
+            source, name = name.rsplit(":", 1)
+        candidates = self.index.get(name)
+        if not candidates:
+            raise BlockNotFoundError(f"unknown block '{name}'")
+        if source is not None:
+            path = self._match_source(source)
+            if path not in candidates:
+                raise BlockNotFoundError(f"block '{name}' is not defined in '{path.name}'")
+            return path
+        if len(candidates) > 1:
+            raise AmbiguousBlockError(name, candidates)
+        return candidates[0]
+
+    # ---------------------------------------------------------------- loading
+    def _module_name(self, path):
+        digest = hashlib.sha1(path.name.encode("utf-8")).hexdigest()[:12]
+        return f"{_MODULE_PREFIX}.m_{digest}"
+
+    def load_source(self, path, block=None):
+        """Import a block file (once) and return the module object."""
+        path = Path(path)
+        with self._lock:
+            module = self._modules.get(path)
+            if module is not None:
+                return module
+            # block files import their siblings (e.g. vision_lstm_util) by plain module name
+            root = str(self.root)
+            if root not in sys.path:
+                sys.path.append(root)
+            module_name = self._module_name(path)
+            spec = importlib.util.spec_from_file_location(module_name, path)
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[module_name] = module
+            try:
+                spec.loader.exec_module(module)
+            except ModuleNotFoundError as e:
+                del sys.modules[module_name]
+                if e.name is None or self._is_local_module(e.name):
+                    raise
+                raise MissingDependencyError(block or path.stem, path, e.name.split(".")[0]) from e
+            except BaseException:
+                del sys.modules[module_name]
+                raise
+            self._modules[path] = module
+            return module
+
+    def _is_local_module(self, name):
+        return (self.root / f"{name.split('.')[0]}.py").exists()
+
+    def get(self, name, source=None):
+        """Return the block class ``name``, importing its source file on first access."""
+        path = self.resolve(name, source)
+        if ":" in name:
+            name = name.rsplit(":", 1)[1]
+        module = self.load_source(path, block=name)
+        return getattr(module, name)
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def is_loaded(self, name, source=None):
+        return self.resolve(name, source) in self._modules
+
+    # ----------------------------------------------------------- dependencies
+    def imports(self, name, source=None):
+        """Top-level package names imported by the file defining ``name`` (static, no import)."""
+        path = self.resolve(name, source)
+        tree = ast.parse(path.read_text(encoding="utf-8"), filename=str(path))
+        packages = []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                packages.extend(alias.name.split(".")[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                packages.append(node.module.split(".")[0])
+        return list(dict.fromkeys(packages))
+
+    def missing_dependencies(self, name, source=None):
+        """Packages imported by ``name``'s file that cannot be found, checked without importing them.
+
+        Imports guarded by ``try``/``except`` inside the file are reported as well, so an entry here
+        does not necessarily mean that loading the block will fail.
+        """
+        missing = []
+        for package in self.imports(name, source):
+            if package in sys.builtin_module_names or self._is_local_module(package):
+                continue
+            if importlib.util.find_spec(package) is None:
+                missing.append(package)
+        return missing
+
+
+registry = BlockRegistry()
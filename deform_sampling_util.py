@@ -0,0 +1,104 @@
+"""
+Shared sampling engine for the deformable convolutions (AKConv, LDConv_2D/LDConv_3D, DSConv).
+
+cached_grid keeps the base sampling grids (initial kernel layout + pixel positions) so they are built once per
+(H, W, stride, N, device) instead of with meshgrids in every forward, and linear_sample gathers all corners of all
+sample points with a single gather.
+"""
+import itertools
+import math
+import threading
+from collections import OrderedDict
+
+import torch
+
+_GRID_CACHE = OrderedDict()
+_GRID_CACHE_SIZE = 64
+_GRID_CACHE_LOCK = threading.Lock()
+
+
+def cached_grid(key, build):
+    """ Return build() for key, built once and kept in a small LRU cache (key must contain shape/device/dtype). """
+    with _GRID_CACHE_LOCK:
+        grid = _GRID_CACHE.get(key)
+        if grid is not None:
+            _GRID_CACHE.move_to_end(key)
+            return grid
+    # built outside inference mode so that the grid can also be used in training afterwards
+    with torch.inference_mode(False), torch.no_grad():
+        grid = build()
+    with _GRID_CACHE_LOCK:
+        _GRID_CACHE[key] = grid
+        if len(_GRID_CACHE) > _GRID_CACHE_SIZE:
+            _GRID_CACHE.popitem(last=False)
+    return grid
+
+
+def clear_grid_cache():
+    with _GRID_CACHE_LOCK:
+        _GRID_CACHE.clear()
+
+
+def linear_sample(x, p, corners=None, clamp_positions=True, channels_last=None):
+    """
+    (Bi/tri)linear sampling of x at the positions p with one fused gather.
+
+    :param x: (b, c, *size) input, D = len(size) spatial dims
+    :param p: (b, D, *out) sample positions in pixels, p[:, d] indexes x.shape[2 + d]; *out can be any layout, the
+        samples are returned in that layout (e.g. (h, N, w) to get the N kernel points stacked along the rows)
+    :param corners: corners used per sample point, tuples of D bits (0: floor, 1: floor + 1), default all 2 ** D
+    :param clamp_positions: True follows AKConv/LDConv: the positions are clamped into the map and the weights are
+        computed from the clamped corners; False follows DSConv: plain linear weights of the unclamped positions,
+        the corners are clamped for indexing only
+    :param channels_last: gather whole channel rows (for channels-last inputs); None decides by the memory format of x
+    :return: (b, c, *out)
+    """
+    b, c = x.shape[:2]
+    size = x.shape[2:]
+    D = len(size)
+    out_shape = p.shape[2:]
+    if corners is None:
+        corners = list(itertools.product((0, 1), repeat=D))
+    if channels_last is None:
+        channels_last = D in (2, 3) and x.is_contiguous(
+            memory_format=torch.channels_last if D == 2 else torch.channels_last_3d)
+
+    p = p.flatten(2)  # (b, D, M)
+    p_floor = p.detach().floor()
+    lo, hi, w_lo, w_hi = [], [], [], []
+    for d in range(D):
+        q_lo = p_floor[:, d].clamp(0, size[d] - 1)
+        q_hi = (p_floor[:, d] + 1).clamp(0, size[d] - 1)
+        lo.append(q_lo.long())
+        hi.append(q_hi.long())
+        if clamp_positions:
+            p_d = p[:, d].clamp(0, size[d] - 1)
+            w_lo.append(1 + (q_lo - p_d))
+            w_hi.append(1 - (q_hi - p_d))
+        else:
+            w_lo.append((p_floor[:, d] + 1).clamp(0, size[d]) - p[:, d])
+            w_hi.append(p[:, d] - p_floor[:, d].clamp(0, size[d]))
+
+    # flat index and weight of every corner, (b, K, M)
+    strides = [math.prod(size[d + 1:]) for d in range(D)]
+    index = torch.stack([
+        sum((hi if bit else lo)[d] * strides[d] for d, bit in enumerate(corner)) for corner in corners
+    ], dim=1)
+    weight = torch.stack([
+        math.prod((w_hi if bit else w_lo)[d] for d, bit in enumerate(corner)) for corner in corners
+    ], dim=1).to(x.dtype)
+    K, M = index.shape[1:]
+
+    if channels_last:
+        # rows of c channels, x is a view for channels-last memory
+        x_flat = x.permute(0, *range(2, D + 2), 1).reshape(b, -1, c)  # (b, prod(size), c)
+        values = x_flat.gather(1, index.view(b, K * M, 1).expand(-1, -1, c)).view(b, K, M, c)
+        out = (values * weight.unsqueeze(-1)).sum(dim=1)  # (b, M, c)
+        out = out.view(b, *out_shape, c)
+        # channels-last view in (b, c, *out) order
+        return out.permute(0, out.dim() - 1, *range(1, out.dim() - 1))
+
+    x_flat = x.reshape(b, c, -1)  # (b, c, prod(size))
+    values = x_flat.gather(2, index.view(b, 1, K * M).expand(-1, c, -1)).view(b, c, K, M)
+    out = (values * weight.unsqueeze(1)).sum(dim=2)  # (b, c, M)
+    return out.view(b, c, *out_shape)
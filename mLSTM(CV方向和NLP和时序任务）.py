@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from typing import Tuple, Optional, List
 '''xLSTM改进
 xLSTM（高级版）之所以称之为xLSTM就是因为它将LSTM扩展为多个LSTM的变体，sLSTM(初级版)和mLSTM（中级版），
@@ -12,110 +13,165 @@ mLSTM特别适合于处理大规模数据集或需要高度复杂数据模式识
 这不仅提高了计算效率，还允许模型更好地扩展到大规模数据集上。
 '''
 class mLSTMCell(nn.Module):
+    # Order of the gate blocks inside the packed W / B
+    GATES = ("i", "f", "o", "q", "k", "v")
+
     def __init__(self, input_size: int, hidden_size: int, bias: bool = True) -> None:
         super().__init__()
         self.input_size = input_size
         self.hidden_size = hidden_size
         self.bias = bias
 
-        # Initialize weights and biases
-        self.W_i = nn.Parameter(
-            nn.init.xavier_uniform_(torch.zeros(input_size, hidden_size)),
-            requires_grad=True,
-        )
-        self.W_f = nn.Parameter(
-            nn.init.xavier_uniform_(torch.zeros(input_size, hidden_size)),
-            requires_grad=True,
-        )
-        self.W_o = nn.Parameter(
-            nn.init.xavier_uniform_(torch.zeros(input_size, hidden_size)),
-            requires_grad=True,
-        )
-        self.W_q = nn.Parameter(
-            nn.init.xavier_uniform_(torch.zeros(input_size, hidden_size)),
-            requires_grad=True,
-        )
-        self.W_k = nn.Parameter(
-            nn.init.xavier_uniform_(torch.zeros(input_size, hidden_size)),
-            requires_grad=True,
-        )
-        self.W_v = nn.Parameter(
-            nn.init.xavier_uniform_(torch.zeros(input_size, hidden_size)),
-            requires_grad=True,
-        )
+        # Initialize weights and biases.
+        # The six input projections (i, f, o, q, k, v) are packed into a single
+        # (input_size, 6 * hidden_size) matrix so that one GEMM computes every gate;
+        # each block keeps its own xavier init as when they were separate W_* parameters.
+        W = torch.zeros(input_size, 6 * hidden_size)
+        for block in W.split(hidden_size, dim=1):
+            nn.init.xavier_uniform_(block)
+        self.W = nn.Parameter(W, requires_grad=True)
 
         if self.bias:
-            self.B_i = nn.Parameter(torch.zeros(hidden_size), requires_grad=True)
-            self.B_f = nn.Parameter(torch.zeros(hidden_size), requires_grad=True)
-            self.B_o = nn.Parameter(torch.zeros(hidden_size), requires_grad=True)
-            self.B_q = nn.Parameter(torch.zeros(hidden_size), requires_grad=True)
-            self.B_k = nn.Parameter(torch.zeros(hidden_size), requires_grad=True)
-            self.B_v = nn.Parameter(torch.zeros(hidden_size), requires_grad=True)
+            self.B = nn.Parameter(torch.zeros(6 * hidden_size), requires_grad=True)
 
-    def forward(
+        # k is scaled by 1/sqrt(hidden_size) before its bias is added
+        scale = torch.ones(6 * hidden_size)
+        scale[4 * hidden_size:5 * hidden_size] = hidden_size ** -0.5
+        self.register_buffer("gate_scale", scale, persistent=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        # Checkpoints saved before the projections were packed hold W_i ... W_v / B_i ... B_v
+        for packed, old in (("W", "W_"), ("B", "B_")):
+            keys = [f"{prefix}{old}{gate}" for gate in self.GATES]
+            if all(key in state_dict for key in keys):
+                state_dict[prefix + packed] = torch.cat([state_dict.pop(key) for key in keys], dim=-1)
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                                      error_msgs)
+
+    def project(self, x: torch.Tensor) -> torch.Tensor:
+        """Packed gate pre-activations (..., 6 * hidden_size) of x (..., input_size).
+
+        Call it once on the whole sequence (T, B, input_size) and feed the slices to step().
+        """
+        if self.bias:
+            return torch.addcmul(self.B, torch.matmul(x, self.W), self.gate_scale)
+        return torch.matmul(x, self.W) * self.gate_scale
+
+    def step(
         self,
-        x: torch.Tensor,
+        gates: torch.Tensor,
         internal_state: Tuple[torch.Tensor, torch.Tensor, torch.Tensor],
     ) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        """Recurrent update from precomputed gate pre-activations (B, 6 * hidden_size)."""
         # Get the internal state
         C, n, m = internal_state
 
-        #  Calculate the input, forget, output, query, key and value gates
-        i_tilda = (
-            torch.matmul(x, self.W_i) + self.B_i
-            if self.bias
-            else torch.matmul(x, self.W_i)
-        )
-        f_tilda = (
-            torch.matmul(x, self.W_f) + self.B_f
-            if self.bias
-            else torch.matmul(x, self.W_f)
-        )
-        o_tilda = (
-            torch.matmul(x, self.W_o) + self.B_o
-            if self.bias
-            else torch.matmul(x, self.W_o)
-        )
-        q_t = (
-            torch.matmul(x, self.W_q) + self.B_q
-            if self.bias
-            else torch.matmul(x, self.W_q)
-        )
-        k_t = (
-            torch.matmul(x, self.W_k) / torch.sqrt(torch.tensor(self.hidden_size))
-            + self.B_k
-            if self.bias
-            else torch.matmul(x, self.W_k) / torch.sqrt(torch.tensor(self.hidden_size))
-        )
-        v_t = (
-            torch.matmul(x, self.W_v) + self.B_v
-            if self.bias
-            else torch.matmul(x, self.W_v)
-        )
+        i_tilda, f_tilda, o_tilda, q_t, k_t, v_t = gates.chunk(6, dim=-1)
 
-        # Exponential activation of the input gate
-        i_t = torch.exp(i_tilda)
         f_t = torch.sigmoid(f_tilda)
         o_t = torch.sigmoid(o_tilda)
 
-        # Stabilization state
-        m_t = torch.max(torch.log(f_t) + m, torch.log(i_t))
+        # Stabilization state (log of the exponential input gate is i_tilda itself)
+        m_t = torch.max(torch.log(f_t) + m, i_tilda)
         i_prime = torch.exp(i_tilda - m_t)
 
         # Covarieance matrix and normalization state
-        C_t = f_t.unsqueeze(-1) * C + i_prime.unsqueeze(-1) * torch.einsum(
-            "bi, bk -> bik", v_t, k_t
-        )
+        C_t = torch.baddbmm(f_t.unsqueeze(-1) * C, (i_prime * v_t).unsqueeze(-1), k_t.unsqueeze(1))
         n_t = f_t * n + i_prime * k_t
 
-        normalize_inner = torch.diagonal(torch.matmul(n_t, q_t.T))
+        normalize_inner = (n_t * q_t).sum(dim=-1, keepdim=True)
         divisor = torch.max(
             torch.abs(normalize_inner), torch.ones_like(normalize_inner)
         )
-        h_tilda = torch.einsum("bkj,bj -> bk", C_t, q_t) / divisor.view(-1, 1)
+        h_tilda = torch.bmm(C_t, q_t.unsqueeze(-1)).squeeze(-1) / divisor
         h_t = o_t * h_tilda
 
         return h_t, (C_t, n_t, m_t)
+
+    def forward(
+        self,
+        x: torch.Tensor,
+        internal_state: Tuple[torch.Tensor, torch.Tensor, torch.Tensor],
+    ) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        return self.step(self.project(x), internal_state)
+
+    def forward_chunkwise(
+        self,
+        x: torch.Tensor,
+        internal_state: Tuple[torch.Tensor, torch.Tensor, torch.Tensor],
+        chunk_size: int = 64,
+        return_all_states: bool = True,
+    ) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        """Run the whole sequence x (T, B, input_size) chunk by chunk.
+
+        Equivalent to calling forward() once per step: inside a chunk every step is
+        computed in parallel, and only (C, n, m) is carried from one chunk to the next.
+        Returns h of shape (T, B, hidden_size) and either the per-step states stacked
+        along dim 0 (return_all_states=True) or only the final (C, n, m).
+        """
+        C, n, m = internal_state
+
+        # Input projections of all timesteps at once, batch first: (B, T, hidden_size) each
+        i_tilda, f_tilda, o_tilda, q, k, v = self.project(x.transpose(0, 1)).chunk(6, dim=-1)
+        log_f = F.logsigmoid(f_tilda)
+        o = torch.sigmoid(o_tilda)
+
+        hs, Cs, ns, ms = [], [], [], []
+        for start in range(0, q.size(1), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            h_tilda, (C, n, m), states = self._chunk(
+                i_tilda[:, chunk], log_f[:, chunk], q[:, chunk], k[:, chunk], v[:, chunk],
+                (C, n, m), return_all_states,
+            )
+            hs.append(h_tilda)
+            if return_all_states:
+                Cs.append(states[0])
+                ns.append(states[1])
+                ms.append(states[2])
+
+        h = (o * torch.cat(hs, dim=1)).transpose(0, 1)
+        if return_all_states:
+            return h, (
+                torch.cat(Cs, dim=1).transpose(0, 1),
+                torch.cat(ns, dim=1).transpose(0, 1),
+                torch.cat(ms, dim=1).transpose(0, 1),
+            )
+        return h, (C, n, m)
+
+    @staticmethod
+    def _chunk(i_tilda, log_f, q, k, v, internal_state, return_all_states):
+        # All inputs are (B, L, hidden_size); row i of C is gated by i_tilda[..., i] and log_f[..., i].
+        C, n, m = internal_state
+        L = i_tilda.size(1)
+
+        # Cumulative log forget gate since the start of the chunk
+        log_f_cum = torch.cumsum(log_f, dim=1)
+        # m_t = max(log f_t + m_{t-1}, i_t) unrolled: log_f_cum_t + max(m_0, max_{s<=t}(i_s - log_f_cum_s))
+        m_t = log_f_cum + torch.maximum(m.unsqueeze(1), torch.cummax(i_tilda - log_f_cum, dim=1).values)
+
+        # D[b, t, s, i]: weight of step s's input in the state at step t,
+        # prod_{s<r<=t} f_r * exp(i_s - m_s), always <= 1
+        log_D = log_f_cum.unsqueeze(2) - (log_f_cum - i_tilda + m_t).unsqueeze(1)
+        causal = torch.ones(L, L, dtype=torch.bool, device=log_D.device).tril()
+        D = torch.exp(log_D.masked_fill(~causal[None, :, :, None], float("-inf")))
+        decay = torch.exp(log_f_cum)
+
+        qk = torch.einsum("btj,bsj->bts", q, k)
+        h_num = decay * torch.einsum("bij,btj->bti", C, q) + torch.einsum("btsi,bts,bsi->bti", D, qk, v)
+        n_t = decay * n.unsqueeze(1) + torch.einsum("btsi,bsi->bti", D, k)
+
+        normalize_inner = (n_t * q).sum(dim=-1, keepdim=True)
+        divisor = torch.max(torch.abs(normalize_inner), torch.ones_like(normalize_inner))
+        h_tilda = h_num / divisor
+
+        C_last = decay[:, -1].unsqueeze(-1) * C + torch.einsum("bsi,bsj->bij", D[:, -1] * v, k)
+        states = None
+        if return_all_states:
+            C_t = decay.unsqueeze(-1) * C.unsqueeze(1) + torch.einsum("btsi,bsj->btij", D * v.unsqueeze(1), k)
+            states = (C_t, n_t, m_t)
+        return h_tilda, (C_last, n_t[:, -1], m_t[:, -1]), states
+
      # python版本<=3.8
     def init_hidden(self, batch_size: int, **kwargs ) -> Tuple[torch.Tensor, torch.Tensor]:
      # python版本>3.8
@@ -135,13 +191,23 @@ class mLSTM(nn.Module):
         num_layers: int,
         bias: bool = True,
         batch_first: bool = False,
+        chunk_size: Optional[int] = None,
+        return_all_states: bool = True,
     ) -> None:
+        """
+        chunk_size: None keeps the step-by-step loop; an integer switches to the
+            chunkwise-parallel form (same result, no per-step Python loop).
+        return_all_states: False returns only the final (C, n, m) of every layer
+            instead of stacking the states of every timestep, which is O(T·B·H²) memory.
+        """
         super().__init__()
         self.input_size = input_size
         self.hidden_size = hidden_size
         self.num_layers = num_layers
         self.bias = bias
         self.batch_first = batch_first
+        self.chunk_size = chunk_size
+        self.return_all_states = return_all_states
 
         self.cells = nn.ModuleList(
             [
@@ -175,22 +241,42 @@ class mLSTM(nn.Module):
         H, C, N, M = [], [], [], []
 
         for layer, cell in enumerate(self.cells):
+            if self.chunk_size is not None:
+                h, states = cell.forward_chunkwise(
+                    x if layer == 0 else H[layer - 1],
+                    hidden_states[layer],
+                    self.chunk_size,
+                    self.return_all_states,
+                )
+                hidden_states[layer] = (
+                    tuple(state[-1] for state in states) if self.return_all_states else states
+                )
+                H.append(h)
+                C.append(states[0])
+                N.append(states[1])
+                M.append(states[2])
+                continue
+
+            # One packed GEMM for the input projections of every timestep
+            gates = cell.project(x if layer == 0 else H[layer - 1])
             lh, lc, ln, lm = [], [], [], []
             for t in range(x.size(0)):
-                h_t, hidden_states[layer] = (
-                    cell(x[t], hidden_states[layer])
-                    if layer == 0
-                    else cell(H[layer - 1][t], hidden_states[layer])
-                )
+                h_t, hidden_states[layer] = cell.step(gates[t], hidden_states[layer])
                 lh.append(h_t)
-                lc.append(hidden_states[layer][0])
-                ln.append(hidden_states[layer][1])
-                lm.append(hidden_states[layer][2])
+                if self.return_all_states:
+                    lc.append(hidden_states[layer][0])
+                    ln.append(hidden_states[layer][1])
+                    lm.append(hidden_states[layer][2])
 
             H.append(torch.stack(lh, dim=0))
-            C.append(torch.stack(lc, dim=0))
-            N.append(torch.stack(ln, dim=0))
-            M.append(torch.stack(lm, dim=0))
+            if self.return_all_states:
+                C.append(torch.stack(lc, dim=0))
+                N.append(torch.stack(ln, dim=0))
+                M.append(torch.stack(lm, dim=0))
+            else:
+                C.append(hidden_states[layer][0])
+                N.append(hidden_states[layer][1])
+                M.append(hidden_states[layer][2])
 
         H = torch.stack(H, dim=0)
         C = torch.stack(C, dim=0)
@@ -199,6 +285,52 @@ class mLSTM(nn.Module):
 
         return H[-1], (H, C, N, M)
 
+    def step(
+        self,
+        x: torch.Tensor,
+        hidden_states: Optional[List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]] = None,
+    ) -> Tuple[torch.Tensor, List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]]:
+        """Streaming inference: push one timestep (B, input_size) or a small block
+        (T, B, input_size) -- (B, T, input_size) if batch_first -- into the stream.
+
+        hidden_states is the state returned by the previous call (None starts a new stream).
+        Only the current (C, n, m) of every layer is kept, so the work per timestep does not
+        grow with the length of the stream. The state is a list of plain tensor tuples: it can
+        be stored with torch.save() and passed back in after a restart.
+
+        Returns the last layer's output in the layout of x and the new state.
+        """
+        single = x.dim() == 2
+        if single:
+            x = x.unsqueeze(0)
+        elif self.batch_first:
+            x = x.transpose(0, 1)
+
+        if hidden_states is None:
+            hidden_states = self.init_hidden(x.size(1), device=x.device, dtype=x.dtype)
+        elif len(hidden_states) != self.num_layers:
+            raise ValueError(
+                f"Expected hidden states of length {self.num_layers}, but got {len(hidden_states)}"
+            )
+        hidden_states = list(hidden_states)
+
+        for layer, cell in enumerate(self.cells):
+            if self.chunk_size is not None and x.size(0) > 1:
+                x, hidden_states[layer] = cell.forward_chunkwise(
+                    x, hidden_states[layer], self.chunk_size, return_all_states=False
+                )
+                continue
+            gates = cell.project(x)
+            lh = []
+            for t in range(x.size(0)):
+                h_t, hidden_states[layer] = cell.step(gates[t], hidden_states[layer])
+                lh.append(h_t)
+            x = torch.stack(lh, dim=0)
+
+        if single:
+            return x[0], hidden_states
+        return (x.transpose(0, 1) if self.batch_first else x), hidden_states
+
     def init_hidden(
         self, batch_size: int, **kwargs
     ) -> List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
@@ -221,4 +353,11 @@ if __name__ == '__main__':
     output =output.view(8,input_dim,16,16)#将三维度转化成图片四维度张量
     # 输出输入图片张量和输出图片张量的形状
     print("mLSTM_input size:", input.size())
-    print("mLSTM_Output size:", output.size())
\ No newline at end of file
+    print("mLSTM_Output size:", output.size())
+
+    # 分块并行模式：chunk_size控制块长度，return_all_states=False只返回每层最终的(C, n, m)，长序列不会OOM
+    block_chunk = mLSTM(input_dim, hidden_size, num_layers, chunk_size=64, return_all_states=False)
+    block_chunk.load_state_dict(block.state_dict())
+    output_chunk, (H, C, N, M) = block_chunk(input_img)
+    print("mLSTM_chunkwise max diff:", (output_chunk.view(8, input_dim, 16, 16) - output).abs().max().item())
+    print("mLSTM_chunkwise final C size:", C.size())
\ No newline at end of file
@@ -0,0 +1,18 @@
+"""
+Shared helpers of the structural re-parameterisation (deploy) paths, used by DEConv / DEConv_2 and WFEConv.
+
+frozen_conv wraps an equivalent kernel and bias, as returned by get_equivalent_kernel_bias(), into a plain
+nn.Conv2d that replaces the multi-branch training-time convolutions after switch_to_deploy().
+"""
+from torch import nn
+
+
+def frozen_conv(weight, bias, padding=1):
+    """ Plain nn.Conv2d holding the re-parameterised (out, in, k, k) kernel and bias, on their device/dtype and
+    excluded from training. """
+    conv = nn.Conv2d(weight.shape[1], weight.shape[0], weight.shape[2:], padding=padding, bias=True)
+    conv = conv.to(device=weight.device, dtype=weight.dtype)
+    conv.weight.data.copy_(weight)
+    conv.bias.data.copy_(bias)
+    conv.requires_grad_(False)
+    return conv
@@ -32,39 +32,44 @@ class sLSTMCell(nn.Module):
                 (torch.zeros(4 * self.hidden_size)), requires_grad=True
             )
 
-    def forward(
+    def project(self, x: torch.Tensor) -> torch.Tensor:
+        """Input part of the gate pre-activations (..., 4 * hidden_size), bias included.
+
+        The rows W[:input_size] only see x, so this can run once over the whole
+        sequence (T, B, input_size) before the time loop; see step().
+        """
+        gates = torch.matmul(x, self.W[: self.input_size])
+        if self.bias:
+            gates = gates + self.B
+        return gates
+
+    def step(
         self,
-        x: torch.Tensor,
+        x_gates: torch.Tensor,
         internal_state: Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor],
     ) -> Tuple[
         torch.Tensor, Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]
     ]:
+        """Recurrent update from the precomputed input gates x_gates = project(x_t)."""
         # Unpack the internal state
         h, c, n, m = internal_state  # (batch_size, hidden_size)
 
-        # Combine the weights and the input
-        combined = torch.cat((x, h), dim=1)  # (batch_size, input_size + hidden_size)
-        # Calculate the linear transformation
-        gates = torch.matmul(combined, self.W)  # (batch_size, 4 * hidden_size)
-
-        # Add the bias if included
-        if self.bias:
-            gates += self.B
+        # Only the recurrent projection is left inside the time loop
+        gates = torch.addmm(x_gates, h, self.W[self.input_size:])  # (batch_size, 4 * hidden_size)
 
         # Split the gates into the input, forget, output and stabilization gates
         z_tilda, i_tilda, f_tilda, o_tilda = torch.split(gates, self.hidden_size, dim=1)
 
         # Calculate the activation of the states
         z_t = torch.tanh(z_tilda)  # (batch_size, hidden_size)
-        # Exponential activation of the input gate
-        i_t = torch.exp(i_tilda)  # (batch_size, hidden_size)
         # Exponential activation of the forget gate
         f_t = torch.sigmoid(f_tilda)  # (batch_size, hidden_size)
 
         # Sigmoid activation of the output gate
         o_t = torch.sigmoid(o_tilda)  # (batch_size, input_size)
         # Calculate the stabilization state
-        m_t = torch.max(torch.log(f_t) + m, torch.log(i_t))  # (batch_size, hidden_size)
+        # (log of the exponential input gate exp(i_tilda) is i_tilda itself)
+        m_t = torch.max(torch.log(f_t) + m, i_tilda)  # (batch_size, hidden_size)
         # Calculate the input stabilization state
         i_prime = torch.exp(i_tilda - m_t)  # (batch_size, hidden_size)
 
@@ -83,6 +88,16 @@ class sLSTMCell(nn.Module):
             n_t,
             m_t,
         )  # (batch_size, hidden_size), (batch_size, hidden_size), (batch_size, hidden_size), (batch_size, hidden_size)
+
+    def forward(
+        self,
+        x: torch.Tensor,
+        internal_state: Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor],
+    ) -> Tuple[
+        torch.Tensor, Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]
+    ]:
+        return self.step(self.project(x), internal_state)
+
     #python版本<=3.8
     def init_hidden(self, batch_size: int, **kwargs) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
 
@@ -148,13 +163,11 @@ class sLSTM(nn.Module):
         H, C, N, M = [], [], [], []
 
         for layer, cell in enumerate(self.cells):
+            # Input projections of every timestep in one GEMM
+            x_gates = cell.project(x if layer == 0 else H[layer - 1])
             lh, lc, ln, lm = [], [], [], []
             for t in range(x.size(0)):
-                h_t, hidden_states[layer] = (
-                    cell(x[t], hidden_states[layer])
-                    if layer == 0
-                    else cell(H[layer - 1][t], hidden_states[layer])
-                )
+                h_t, hidden_states[layer] = cell.step(x_gates[t], hidden_states[layer])
                 lh.append(h_t)
                 lc.append(hidden_states[layer][0])
                 ln.append(hidden_states[layer][1])
@@ -172,6 +185,51 @@ class sLSTM(nn.Module):
 
         return H[-1], (H, C, N, M)
 
+    def step(
+        self,
+        x: torch.Tensor,
+        hidden_states: Optional[
+            List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]]
+        ] = None,
+    ) -> Tuple[
+        torch.Tensor, List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]]
+    ]:
+        """Streaming inference: push one timestep (B, input_size) or a small block
+        (T, B, input_size) -- (B, T, input_size) if batch_first -- into the stream.
+
+        hidden_states is the state returned by the previous call (None starts a new stream).
+        Only the current (h, c, n, m) of every layer is kept, so the work per timestep does not
+        grow with the length of the stream. The state is a list of plain tensor tuples: it can
+        be stored with torch.save() and passed back in after a restart.
+
+        Returns the last layer's output in the layout of x and the new state.
+        """
+        single = x.dim() == 2
+        if single:
+            x = x.unsqueeze(0)
+        elif self.batch_first:
+            x = x.transpose(0, 1)
+
+        if hidden_states is None:
+            hidden_states = self.init_hidden(x.size(1), device=x.device, dtype=x.dtype)
+        elif len(hidden_states) != self.num_layers:
+            raise ValueError(
+                f"Expected hidden states of length {self.num_layers}, but got {len(hidden_states)}"
+            )
+        hidden_states = list(hidden_states)
+
+        for layer, cell in enumerate(self.cells):
+            x_gates = cell.project(x)
+            lh = []
+            for t in range(x.size(0)):
+                h_t, hidden_states[layer] = cell.step(x_gates[t], hidden_states[layer])
+                lh.append(h_t)
+            x = torch.stack(lh, dim=0)
+
+        if single:
+            return x[0], hidden_states
+        return (x.transpose(0, 1) if self.batch_first else x), hidden_states
+
     def init_hidden(
         self, batch_size: int, **kwargs
     ) -> List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]]:
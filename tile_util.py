@@ -0,0 +1,120 @@
+"""
+Tiled inference for 2D blocks (the EVSblock / EVSS grids), usable with any module that maps (b, c, h, w) tiles to
+(b, c', h, w) tiles.
+
+The image is covered with overlapping tiles in the layout of the original EVSS `grids` loop: tiles of
+min(size, tile) pixels, evenly spaced, the last one flush with the border. The tile origins and the overlap counts
+are built once per (h, w, tile, device) and cached. All tiles of a chunk are cut with one index_select and
+accumulated back with one index_add_ (F.fold-style, but for the non-uniform stride of the last tile), overlaps are
+averaged. Nothing is stored on the calling module, so one instance can be used from several threads.
+"""
+import functools
+
+import math
+import torch
+
+
+def tile_starts(size, tile):
+    """ Start offsets of the overlapping tiles of length min(size, tile) that cover [0, size). """
+    tile = min(size, tile)
+    num = (size - 1) // tile + 1
+    step = tile if num == 1 else math.ceil((size - tile) / (num - 1) - 1e-8)
+    return tuple(range(0, size - tile, step)) + (size - tile,)
+
+
+@functools.lru_cache(maxsize=64)
+def _tile_layout(h, w, tile_h, tile_w, device):
+    """
+    Pixel offsets of every tile row/column, (n_i, k1) and (n_j, k2), and the inverse overlap count of every image
+    row/column, (h,) and (w,). The tiles form a grid, so the 2D overlap count is the outer product of the two.
+    """
+    with torch.inference_mode(False):
+        layout = []
+        for size, tile in ((h, tile_h), (w, tile_w)):
+            starts = torch.tensor(tile_starts(size, tile), device=device)
+            offsets = starts[:, None] + torch.arange(min(size, tile), device=device)
+            count = torch.zeros(size, device=device).index_add_(
+                0, offsets.flatten(), torch.ones(offsets.numel(), device=device))
+            layout += [offsets, count.reciprocal()]
+        return tuple(layout)
+
+
+def _flat_index(rows, cols, w, tiles):
+    """ Flat pixel index (t, k1 * k2) of the tiles with the given (row-major) tile ids. """
+    num_cols = cols.shape[0]
+    r = rows[tiles // num_cols]
+    c = cols[tiles % num_cols]
+    return (r[:, :, None] * w + c[:, None, :]).flatten(1)
+
+
+def _gather(x_flat, index, k1, k2):
+    # (b, c, h * w) -> (t * b, c, k1, k2), tile-major like torch.cat(parts, dim=0) in the original loop
+    b, c = x_flat.shape[:2]
+    t = index.shape[0]
+    tiles = x_flat.index_select(2, index.flatten()).view(b, c, t, k1, k2)
+    return tiles.permute(2, 0, 1, 3, 4).reshape(t * b, c, k1, k2)
+
+
+def _scatter(out_flat, tiles, index):
+    # accumulate (t * b, c, k1, k2) tiles into (b, c, h * w)
+    b, c = out_flat.shape[:2]
+    t = index.shape[0]
+    tiles = tiles.reshape(t, b, c, -1).permute(1, 2, 0, 3).reshape(b, c, -1)
+    out_flat.index_add_(2, index.flatten(), tiles)
+
+
+def _normalise(out_flat, h, w, inv_h, inv_w):
+    out = out_flat.view(*out_flat.shape[:2], h, w)
+    return out * (inv_h[:, None] * inv_w).to(out.dtype)
+
+
+def split_tiles(x, tile):
+    """
+    Cut x (b, c, h, w) into its overlapping tiles.
+
+    :param tile: (tile_h, tile_w), clipped to the image size
+    :return: (n * b, c, k1, k2) with the n tiles in row-major order, each holding the whole batch
+    """
+    b, c, h, w = x.shape
+    rows, _, cols, _ = _tile_layout(h, w, tile[0], tile[1], x.device)
+    tiles = torch.arange(rows.shape[0] * cols.shape[0], device=x.device)
+    return _gather(x.reshape(b, c, h * w), _flat_index(rows, cols, w, tiles), rows.shape[1], cols.shape[1])
+
+
+def merge_tiles(tiles, size, tile):
+    """
+    Inverse of split_tiles: put the (n * b, c, k1, k2) tiles back into a (b, c, h, w) map, overlaps are averaged.
+
+    :param size: (h, w) of the image the tiles were cut from
+    """
+    h, w = size[-2:]
+    rows, inv_h, cols, inv_w = _tile_layout(h, w, tile[0], tile[1], tiles.device)
+    num = rows.shape[0] * cols.shape[0]
+    index = _flat_index(rows, cols, w, torch.arange(num, device=tiles.device))
+    out = tiles.new_zeros(tiles.shape[0] // num, tiles.shape[1], h * w)
+    _scatter(out, tiles, index)
+    return _normalise(out, h, w, inv_h, inv_w)
+
+
+def tiled_apply(fn, x, tile, max_tiles=None):
+    """
+    merge_tiles(fn(split_tiles(x, tile)), x.shape, tile), streamed in chunks of at most max_tiles tile positions
+    (each with the whole batch), so only one chunk of tiles and their outputs is alive at a time.
+
+    :param fn: maps (t * b, c, k1, k2) to (t * b, c', k1, k2)
+    :param max_tiles: tile positions per chunk, None runs all tiles at once
+    """
+    b, c, h, w = x.shape
+    rows, inv_h, cols, inv_w = _tile_layout(h, w, tile[0], tile[1], x.device)
+    k1, k2 = rows.shape[1], cols.shape[1]
+    num = rows.shape[0] * cols.shape[0]
+    step = num if max_tiles is None else max(1, max_tiles)
+    x_flat = x.reshape(b, c, h * w)
+    out = None
+    for start in range(0, num, step):
+        index = _flat_index(rows, cols, w, torch.arange(start, min(start + step, num), device=x.device))
+        y = fn(_gather(x_flat, index, k1, k2))
+        if out is None:
+            out = y.new_zeros(b, y.shape[1], h * w)
+        _scatter(out, y, index)
+    return _normalise(out, h, w, inv_h, inv_w)
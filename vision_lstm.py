@@ -9,12 +9,23 @@ import torch
 import torch.nn.functional as F
 from torch import nn
 
-from vision_lstm_util import interpolate_sincos, to_ntuple, VitPatchEmbed, VitPosEmbed2d, DropPath
+from vision_lstm_util import (
+    interpolate_sincos,
+    to_ntuple,
+    BufferCache,
+    get_causal_mask,
+    get_bidirectional_index,
+    VitPatchEmbed,
+    VitPosEmbed2d,
+    DropPath,
+)
 
 
 class SequenceTraversal(Enum):
     ROWWISE_FROM_TOP_LEFT = "rowwise_from_top_left"
     ROWWISE_FROM_BOT_RIGHT = "rowwise_from_bot_right"
+    # both traversals in one layer with shared weights, batched into a single mLSTM call; the outputs are summed
+    BIDIRECTIONAL = "bidirectional"
 
 
 def bias_linspace_init_(param: torch.Tensor, start: float = 3.4, end: float = 6.0) -> torch.Tensor:
@@ -80,10 +91,10 @@ def parallel_stabilized_simple(
 
     # forget gate matrix
     log_fgates = torch.nn.functional.logsigmoid(fgate_preact)  # (B, NH, S, 1)
-    if lower_triangular_matrix is None or S < lower_triangular_matrix.size(-1):
+    if lower_triangular_matrix is None or lower_triangular_matrix.size(-1) < S:
         ltr = torch.tril(torch.ones((S, S), dtype=torch.bool, device=_device))
     else:
-        ltr = lower_triangular_matrix
+        ltr = lower_triangular_matrix[:S, :S]
     assert ltr.dtype == torch.bool, f"lower_triangular_matrix must be of dtype bool, got {ltr.dtype}"
 
     log_fgates_cumsum = torch.cat(
@@ -130,6 +141,157 @@ def parallel_stabilized_simple(
     return h_tilde_state
 
 
+def chunkwise_stabilized_simple(
+        queries: torch.Tensor,
+        keys: torch.Tensor,
+        values: torch.Tensor,
+        igate_preact: torch.Tensor,
+        fgate_preact: torch.Tensor,
+        chunk_size: int = 256,
+        initial_state: tuple = None,
+        return_last_state: bool = False,
+        lower_triangular_matrix: torch.Tensor = None,
+        eps: float = 1e-6,
+):
+    """
+    This is the mLSTM cell in chunkwise form, a memory-linear replacement of parallel_stabilized_simple.
+    The sequence is processed in chunks of chunk_size: inside a chunk the parallel form is used, across chunks the
+    recurrent state (C, n, m) is carried. m is kept equal to the running row maximum of log D, so every query is
+    stabilized exactly as in parallel_stabilized_simple (stabilize_rowwise=True) and the outputs agree up to
+    floating point rounding. Memory is O(S * DH + chunk_size^2) per batch/head instead of O(S^2).
+
+    Args:
+        :param queries: (torch.Tensor) (B, NH, S, DH)
+        :param keys: (torch.Tensor) (B, NH, S, DH)
+        :param values: (torch.Tensor) (B, NH, S, DH)
+        :param igate_preact: (torch.Tensor) (B, NH, S, 1)
+        :param fgate_preact: (torch.Tensor) (B, NH, S, 1)
+        :param chunk_size: (int) length of the chunks. Defaults to 256.
+        :param initial_state: (tuple) (C, n, m) of shapes (B, NH, DH, DH), (B, NH, DH, 1), (B, NH, 1, 1) to continue
+            from, as returned with return_last_state=True or by recurrent_step_stabilized_simple. Defaults to None.
+        :param return_last_state: (bool) Whether to also return the state after the last timestep. Defaults to False.
+        :param lower_triangular_matrix: (torch.Tensor) (chunk_size, chunk_size) bool. Defaults to None.
+        :param eps: (float) small constant to avoid division by 0. Defaults to 1e-6.
+
+    Returns:
+        torch.Tensor: (B, NH, S, DH), h_tilde_state (and (C, n, m) if return_last_state)
+    """
+    B, NH, S, DH = queries.shape
+    _dtype, _device = queries.dtype, queries.device
+
+    if lower_triangular_matrix is None or lower_triangular_matrix.size(-1) < min(chunk_size, S):
+        ltr = torch.tril(torch.ones((chunk_size, chunk_size), dtype=torch.bool, device=_device))
+    else:
+        ltr = lower_triangular_matrix
+    assert ltr.dtype == torch.bool, f"lower_triangular_matrix must be of dtype bool, got {ltr.dtype}"
+
+    if initial_state is None:
+        c_state = torch.zeros((B, NH, DH, DH), dtype=_dtype, device=_device)
+        n_state = torch.zeros((B, NH, DH, 1), dtype=_dtype, device=_device)
+        m_state = torch.full((B, NH, 1, 1), -float("inf"), dtype=_dtype, device=_device)
+    else:
+        c_state, n_state, m_state = initial_state
+
+    log_fgates = torch.nn.functional.logsigmoid(fgate_preact)  # (B, NH, S, 1)
+    keys_scaled = keys / math.sqrt(DH)
+
+    h_chunks = []
+    for start in range(0, S, chunk_size):
+        q = queries[:, :, start:start + chunk_size]  # (B, NH, L, DH)
+        k = keys_scaled[:, :, start:start + chunk_size]  # (B, NH, L, DH)
+        v = values[:, :, start:start + chunk_size]  # (B, NH, L, DH)
+        igates = igate_preact[:, :, start:start + chunk_size]  # (B, NH, L, 1)
+        L = q.size(2)
+
+        # cumsum of the log forget gates since the start of the chunk (inclusive)
+        log_fg_cumsum = torch.cumsum(log_fgates[:, :, start:start + chunk_size], dim=-2)  # (B, NH, L, 1)
+
+        # intra-chunk gate decay matrix, as in the parallel form
+        log_D_matrix = log_fg_cumsum - log_fg_cumsum.transpose(-2, -1) + igates.transpose(-2, -1)  # (B, NH, L, L)
+        log_D_matrix = log_D_matrix.masked_fill(~ltr[:L, :L], -float("inf"))
+        # contribution of the carried state, seen from each query of the chunk
+        log_inter = log_fg_cumsum + m_state  # (B, NH, L, 1)
+        # row maximum over all keys of the sequence so far
+        max_log_D = torch.maximum(torch.max(log_D_matrix, dim=-1, keepdim=True)[0], log_inter)  # (B, NH, L, 1)
+        D_matrix = torch.exp(log_D_matrix - max_log_D)  # (B, NH, L, L)
+        inter_scale = torch.exp(log_inter - max_log_D)  # (B, NH, L, 1)
+
+        C_matrix = (q @ k.transpose(-2, -1)) * D_matrix  # (B, NH, L, L)
+        h_num = C_matrix @ v + inter_scale * (q @ c_state)  # (B, NH, L, DH)
+        qn = C_matrix.sum(dim=-1, keepdim=True) + inter_scale * (q @ n_state)  # (B, NH, L, 1)
+        normalizer = torch.maximum(qn.abs(), torch.exp(-max_log_D))  # (B, NH, L, 1)
+        h_chunks.append(h_num / (normalizer + eps))
+
+        # carry the state to the end of the chunk
+        log_fg_total = log_fg_cumsum[:, :, -1:]  # (B, NH, 1, 1)
+        log_w = log_fg_total - log_fg_cumsum + igates  # (B, NH, L, 1)
+        m_state_new = torch.maximum(log_fg_total + m_state, torch.max(log_w, dim=-2, keepdim=True)[0])
+        decay = torch.exp(log_fg_total + m_state - m_state_new)  # (B, NH, 1, 1)
+        k_weighted = k * torch.exp(log_w - m_state_new)  # (B, NH, L, DH)
+        c_state = decay * c_state + k_weighted.transpose(-2, -1) @ v  # (B, NH, DH, DH)
+        n_state = decay * n_state + k_weighted.sum(dim=-2).unsqueeze(-1)  # (B, NH, DH, 1)
+        m_state = m_state_new
+
+    h_tilde_state = torch.cat(h_chunks, dim=2)  # (B, NH, S, DH)
+    if return_last_state:
+        return h_tilde_state, (c_state, n_state, m_state)
+    return h_tilde_state
+
+
+def recurrent_step_stabilized_simple(
+        c_state: torch.Tensor,
+        n_state: torch.Tensor,
+        m_state: torch.Tensor,
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        igate_preact: torch.Tensor,
+        fgate_preact: torch.Tensor,
+        eps: float = 1e-6,
+):
+    """
+    This is the mLSTM cell in recurrent form: one timestep of parallel_stabilized_simple.
+    Starting from c_state = n_state = 0 and m_state = -inf and stepping through a sequence gives the same
+    h as the parallel form (m_state then equals the row maximum used there for stabilization).
+
+    Args:
+        :param c_state: (torch.Tensor) (B, NH, DH, DH)
+        :param n_state: (torch.Tensor) (B, NH, DH, 1)
+        :param m_state: (torch.Tensor) (B, NH, 1, 1)
+        :param q: (torch.Tensor) (B, NH, DH)
+        :param k: (torch.Tensor) (B, NH, DH)
+        :param v: (torch.Tensor) (B, NH, DH)
+        :param igate_preact: (torch.Tensor) (B, NH, 1, 1)
+        :param fgate_preact: (torch.Tensor) (B, NH, 1, 1)
+        :param eps: (float) small constant to avoid division by 0. Defaults to 1e-6.
+
+    Returns:
+        tuple[torch.Tensor, tuple[torch.Tensor, torch.Tensor, torch.Tensor]]: (B, NH, DH), (c_state, n_state, m_state)
+    """
+    DH = q.size(-1)
+    q = q.unsqueeze(-1)  # (B, NH, DH, 1)
+    k = k.unsqueeze(-1) / math.sqrt(DH)  # (B, NH, DH, 1)
+    v = v.unsqueeze(-1)  # (B, NH, DH, 1)
+
+    # gates
+    log_fgate = torch.nn.functional.logsigmoid(fgate_preact)  # (B, NH, 1, 1)
+    m_state_new = torch.maximum(log_fgate + m_state, igate_preact)  # (B, NH, 1, 1)
+    fgate_act = torch.exp(log_fgate + m_state - m_state_new)  # (B, NH, 1, 1)
+    igate_act = torch.exp(igate_preact - m_state_new)  # (B, NH, 1, 1)
+
+    # state update
+    c_state_new = fgate_act * c_state + igate_act * (k @ v.transpose(-1, -2))  # (B, NH, DH, DH)
+    n_state_new = fgate_act * n_state + igate_act * k  # (B, NH, DH, 1)
+
+    # retrieval, normalized as in the parallel form
+    h_num = q.transpose(-1, -2) @ c_state_new  # (B, NH, 1, DH)
+    qn_dotproduct = q.transpose(-1, -2) @ n_state_new  # (B, NH, 1, 1)
+    h_denom = torch.maximum(qn_dotproduct.abs(), torch.exp(-m_state_new)) + eps  # (B, NH, 1, 1)
+    h = (h_num / h_denom).squeeze(-2)  # (B, NH, DH)
+
+    return h, (c_state_new, n_state_new, m_state_new)
+
+
 class LinearHeadwiseExpand(nn.Module):
     """
     This is a structured projection layer that projects the input to a higher dimension.
@@ -220,6 +382,18 @@ class CausalConv1d(nn.Module):
         x = einops.rearrange(x, "b d l -> b l d")
         return x
 
+    def step(self, x: torch.Tensor, conv_state: torch.Tensor = None):
+        """
+        Streaming counterpart of forward(): x (B, T, F) are the next timesteps, conv_state (B, kernel_size - 1, F)
+        the inputs preceding them (None = start of the sequence, i.e. the zero padding of forward()).
+        Returns the convolved timesteps (B, T, F) and the new conv_state.
+        """
+        if conv_state is None:
+            conv_state = x.new_zeros(x.size(0), self.pad, x.size(2))
+        window = torch.cat([conv_state, x], dim=1)  # (B, kernel_size - 1 + T, F)
+        out = F.conv1d(window.transpose(1, 2), self.conv.weight, self.conv.bias, groups=self.dim)
+        return out.transpose(1, 2), window[:, window.size(1) - self.pad:]
+
 
 class LayerNorm(nn.Module):
     """ LayerNorm but with an optional bias. PyTorch doesn't support simply bias=False. """
@@ -288,15 +462,22 @@ class MultiHeadLayerNorm(LayerNorm):
 
 
 class MatrixLSTMCell(nn.Module):
-    def __init__(self, dim, num_heads):
+    def __init__(self, dim, num_heads, chunk_size=256, chunkwise_threshold=1024, buffer_cache=None):
+        """
+        chunkwise_threshold: sequences longer than this use chunkwise_stabilized_simple (memory O(S * chunk_size))
+            instead of parallel_stabilized_simple (memory O(S^2)); None always uses the parallel form.
+        buffer_cache: BufferCache for the causal masks, usually shared by all blocks of a model (None = own cache).
+        """
         super().__init__()
         self.dim = dim
         self.num_heads = num_heads
+        self.chunk_size = chunk_size
+        self.chunkwise_threshold = chunkwise_threshold
 
         self.igate = nn.Linear(3 * dim, num_heads)
         self.fgate = nn.Linear(3 * dim, num_heads)
         self.outnorm = MultiHeadLayerNorm(ndim=dim, weight=True, bias=False)
-        self.causal_mask_cache = {}
+        self.buffer_cache = BufferCache() if buffer_cache is None else buffer_cache
         self.reset_parameters()
 
     def forward(self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor) -> torch.Tensor:
@@ -317,12 +498,21 @@ class MatrixLSTMCell(nn.Module):
         fgate_preact = self.fgate(if_gate_input)  # (B, S, NH)
         fgate_preact = fgate_preact.transpose(-1, -2).unsqueeze(-1)  # (B, NH, S, 1)#
 
+        if self.chunkwise_threshold is not None and S > self.chunkwise_threshold:
+            h_state = chunkwise_stabilized_simple(
+                queries=q,
+                keys=k,
+                values=v,
+                igate_preact=igate_preact,
+                fgate_preact=fgate_preact,
+                chunk_size=self.chunk_size,
+                lower_triangular_matrix=get_causal_mask(self.chunk_size, q.device, cache=self.buffer_cache),
+            )  # (B, NH, S, DH)
+            h_state_norm = self.outnorm(h_state)  # (B, NH, S, DH)
+            return h_state_norm.transpose(1, 2).reshape(B, S, -1)
+
         # cache causal mask to avoid memory allocation in every iteration
-        if S in self.causal_mask_cache:
-            causal_mask = self.causal_mask_cache[(S, str(q.device))]
-        else:
-            causal_mask = torch.tril(torch.ones(S, S, dtype=torch.bool, device=q.device))
-            self.causal_mask_cache[(S, str(q.device))] = causal_mask
+        causal_mask = get_causal_mask(S, q.device, cache=self.buffer_cache)
 
         h_state = parallel_stabilized_simple(
             queries=q,
@@ -338,6 +528,69 @@ class MatrixLSTMCell(nn.Module):
 
         return h_state_norm
 
+    def init_state(self, batch_size: int, head_dim: int, **kwargs):
+        """Empty recurrent state (C, n, m) for step()."""
+        return (
+            torch.zeros(batch_size, self.num_heads, head_dim, head_dim, **kwargs),
+            torch.zeros(batch_size, self.num_heads, head_dim, 1, **kwargs),
+            torch.full((batch_size, self.num_heads, 1, 1), -float("inf"), **kwargs),
+        )
+
+    def step(self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, state=None):
+        """
+        Recurrent counterpart of forward() for streaming: q, k, v (B, T, H) are the next T tokens and
+        state the (C, n, m) returned by the previous call (None = start of the sequence).
+        Returns (B, T, H) and the new state; the work per token is independent of the sequence length.
+        """
+        B, T, _ = q.shape  # (B, T, H)
+
+        if_gate_input = torch.cat([q, k, v], dim=-1)
+        q = q.view(B, T, self.num_heads, -1)  # (B, T, NH, DH)
+        k = k.view(B, T, self.num_heads, -1)  # (B, T, NH, DH)
+        v = v.view(B, T, self.num_heads, -1)  # (B, T, NH, DH)
+        igate_preact = self.igate(if_gate_input)[..., None, None]  # (B, T, NH, 1, 1)
+        fgate_preact = self.fgate(if_gate_input)[..., None, None]  # (B, T, NH, 1, 1)
+
+        if state is None:
+            state = self.init_state(B, q.size(-1), dtype=q.dtype, device=q.device)
+        c_state, n_state, m_state = state
+
+        if T > 1:
+            # a block of tokens: parallel inside the block, continuing from the carried state
+            h_state, (c_state, n_state, m_state) = chunkwise_stabilized_simple(
+                queries=q.transpose(1, 2),
+                keys=k.transpose(1, 2),
+                values=v.transpose(1, 2),
+                igate_preact=igate_preact.squeeze(-1).transpose(1, 2),
+                fgate_preact=fgate_preact.squeeze(-1).transpose(1, 2),
+                chunk_size=self.chunk_size,
+                initial_state=(c_state, n_state, m_state),
+                lower_triangular_matrix=get_causal_mask(self.chunk_size, q.device, cache=self.buffer_cache),
+                return_last_state=True,
+            )  # (B, NH, T, DH)
+            h_state_norm = self.outnorm(h_state).transpose(1, 2).reshape(B, T, -1)  # (B, T, H)
+            return h_state_norm, (c_state, n_state, m_state)
+
+        h_states = []
+        for t in range(T):
+            h, (c_state, n_state, m_state) = recurrent_step_stabilized_simple(
+                c_state=c_state,
+                n_state=n_state,
+                m_state=m_state,
+                q=q[:, t],
+                k=k[:, t],
+                v=v[:, t],
+                igate_preact=igate_preact[:, t],
+                fgate_preact=fgate_preact[:, t],
+            )  # (B, NH, DH)
+            h_states.append(h)
+        h_state = torch.stack(h_states, dim=2)  # (B, NH, T, DH)
+
+        h_state_norm = self.outnorm(h_state)  # (B, NH, T, DH)
+        h_state_norm = h_state_norm.transpose(1, 2).reshape(B, T, -1)  # (B, T, H)
+
+        return h_state_norm, (c_state, n_state, m_state)
+
     def reset_parameters(self):
         self.outnorm.reset_parameters()
         # forget gate initialization
@@ -358,6 +611,7 @@ class ViLLayer(nn.Module):
             proj_bias=False,
             conv_bias=True,
             kernel_size=4,
+            buffer_cache=None,
     ):
         super().__init__()
         if dim % qkv_block_size != 0:
@@ -402,6 +656,7 @@ class ViLLayer(nn.Module):
         self.mlstm_cell = MatrixLSTMCell(
             dim=inner_dim,
             num_heads=qkv_block_size,
+            buffer_cache=buffer_cache,
         )
         self.learnable_skip = nn.Parameter(torch.ones(inner_dim))
 
@@ -415,6 +670,9 @@ class ViLLayer(nn.Module):
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         B, S, _ = x.shape
 
+        if self.direction == SequenceTraversal.BIDIRECTIONAL:
+            return self._forward_bidirectional(x)
+
         # alternate direction in successive layers
         if self.direction == SequenceTraversal.ROWWISE_FROM_TOP_LEFT:
             pass
@@ -452,6 +710,74 @@ class ViLLayer(nn.Module):
 
         return x
 
+    def _forward_bidirectional(self, x: torch.Tensor) -> torch.Tensor:
+        B, S, _ = x.shape
+
+        # up-projection, shared by both directions
+        x_inner = self.proj_up(x)
+        x_mlstm, z = torch.chunk(x_inner, chunks=2, dim=-1)
+
+        # stack each sequence and its reverse along the batch dim with one gather instead of flip + cat
+        index = get_bidirectional_index(S, x.device, cache=self.mlstm_cell.buffer_cache)
+        x_mlstm = x_mlstm.index_select(1, index).view(2 * B, S, -1)  # (2B, S, inner_dim)
+
+        # mlstm branch, one call for both directions
+        x_mlstm_conv = self.conv1d(x_mlstm)
+        x_mlstm_conv_act = F.silu(x_mlstm_conv)
+        q = self.q_proj(x_mlstm_conv_act)
+        k = self.k_proj(x_mlstm_conv_act)
+        v = self.v_proj(x_mlstm)
+        h_tilde_state = self.mlstm_cell(q=q, k=k, v=v)
+        h_tilde_state_skip = h_tilde_state + (self.learnable_skip * x_mlstm_conv_act)  # (2B, S, inner_dim)
+
+        # sum the directions in sequence order, then gate and project down once
+        h_tilde_state_skip = h_tilde_state_skip.view(B, 2, S, -1)
+        h_tilde_state_skip = h_tilde_state_skip[:, 0] + h_tilde_state_skip[:, 1].flip(dims=[1])
+        h_state = h_tilde_state_skip * F.silu(z)
+        return self.proj_down(h_state)
+
+    def step(self, x: torch.Tensor, state=None):
+        """
+        Streaming inference with constant work per token.
+
+        x is (B, D) for a single token or (B, T, D) for a small block of tokens, state is the value returned by the
+        previous call (None starts a new sequence). Tokens are consumed in the order they are pushed, so feeding a
+        sequence token by token reproduces forward() for ROWWISE_FROM_TOP_LEFT layers; a ROWWISE_FROM_BOT_RIGHT
+        layer cannot look ahead and expects the caller to push the tokens in its (reversed) traversal order.
+
+        The state is a tuple of plain tensors (conv buffer, C, n, m); it can be stored with torch.save() and passed
+        back in to resume the stream after a restart.
+        """
+        if self.direction == SequenceTraversal.BIDIRECTIONAL:
+            raise NotImplementedError("a bidirectional layer needs the whole sequence and cannot be streamed")
+        single = x.ndim == 2
+        if single:
+            x = x.unsqueeze(1)
+        conv_state, mlstm_state = (None, None) if state is None else (state[0], state[1:])
+
+        # up-projection
+        x_inner = self.proj_up(x)
+        x_mlstm, z = torch.chunk(x_inner, chunks=2, dim=-1)
+
+        # mlstm branch
+        x_mlstm_conv, conv_state = self.conv1d.step(x_mlstm, conv_state)
+        x_mlstm_conv_act = F.silu(x_mlstm_conv)
+        q = self.q_proj(x_mlstm_conv_act)
+        k = self.k_proj(x_mlstm_conv_act)
+        v = self.v_proj(x_mlstm)
+        h_tilde_state, mlstm_state = self.mlstm_cell.step(q=q, k=k, v=v, state=mlstm_state)
+        h_tilde_state_skip = h_tilde_state + (self.learnable_skip * x_mlstm_conv_act)
+
+        # output / z branch
+        h_state = h_tilde_state_skip * F.silu(z)
+
+        # down-projection
+        x = self.proj_down(h_state)
+
+        if single:
+            x = x.squeeze(1)
+        return x, (conv_state, *mlstm_state)
+
     def reset_parameters(self):
         # init inproj
         small_init_(self.proj_up.weight, dim=self.dim)
@@ -478,7 +804,7 @@ class ViLLayer(nn.Module):
 
 
 class ViLBlock(nn.Module):
-    def __init__(self, dim, direction, drop_path=0.0, norm_bias=False):
+    def __init__(self, dim, direction, drop_path=0.0, norm_bias=False, buffer_cache=None):
         super().__init__()
         self.dim = dim
         self.direction = direction
@@ -487,7 +813,7 @@ class ViLBlock(nn.Module):
 
         self.drop_path = DropPath(drop_prob=drop_path)
         self.norm = LayerNorm(ndim=dim, weight=True, bias=norm_bias)
-        self.layer = ViLLayer(dim=dim, direction=direction)
+        self.layer = ViLLayer(dim=dim, direction=direction, buffer_cache=buffer_cache)
 
         self.reset_parameters()
 
@@ -501,6 +827,11 @@ class ViLBlock(nn.Module):
         # print('In xlstm now')
         return x
 
+    def step(self, x: torch.Tensor, state=None):
+        """ Streaming counterpart of forward() (inference, drop path inactive), see ViLLayer.step. """
+        out, state = self.layer.step(self.norm(x), state)
+        return x + out, state
+
     def reset_parameters(self):
         self.layer.reset_parameters()
         self.norm.reset_parameters()
@@ -536,6 +867,9 @@ class VisionLSTM(nn.Module):
         self.drop_path_rate = drop_path_rate
         self.drop_path_decay = drop_path_decay
 
+        # causal masks and resized pos_embeds shared by all blocks, built once per resolution
+        self.buffer_cache = BufferCache()
+
         # initialize patch_embed
         self.patch_embed = VitPatchEmbed(
             dim=dim,
@@ -546,13 +880,7 @@ class VisionLSTM(nn.Module):
         )
 
         # pos embed
-        self.pos_embed = VitPosEmbed2d(seqlens=self.patch_embed.seqlens, dim=dim)
-
-        # calculate stochastic depth per block
-        if drop_path_decay and drop_path_rate > 0.:
-            dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]
-        else:
-            dpr = [drop_path_rate] * depth
+        self.pos_embed = VitPosEmbed2d(seqlens=self.patch_embed.seqlens, dim=dim, cache=self.buffer_cache)
 
         # directions
         directions = []
@@ -562,8 +890,19 @@ class VisionLSTM(nn.Module):
                     directions.append(SequenceTraversal.ROWWISE_FROM_TOP_LEFT)
                 else:
                     directions.append(SequenceTraversal.ROWWISE_FROM_BOT_RIGHT)
+        elif alternation == "bidirectional_batched":
+            # every pair of alternating blocks becomes one block that runs both directions in a single batched call
+            assert depth % 2 == 0, f"alternation '{alternation}' pairs up blocks, depth must be even (got {depth})"
+            directions = [SequenceTraversal.BIDIRECTIONAL] * (depth // 2)
         else:
             raise NotImplementedError(f"invalid alternation '{alternation}'")
+        num_blocks = len(directions)
+
+        # calculate stochastic depth per block
+        if drop_path_decay and drop_path_rate > 0.:
+            dpr = [x.item() for x in torch.linspace(0, drop_path_rate, num_blocks)]
+        else:
+            dpr = [drop_path_rate] * num_blocks
 
         # blocks
         self.blocks = nn.ModuleList(
@@ -572,8 +911,9 @@ class VisionLSTM(nn.Module):
                     dim=dim,
                     drop_path=dpr[i],
                     direction=directions[i],
+                    buffer_cache=self.buffer_cache,
                 )
-                for i in range(depth)
+                for i in range(num_blocks)
             ]
         )
         # LEGACY: only norm after pooling is needed, norm after blocks is not needed but was used for training
@@ -673,6 +1013,9 @@ class VisionLSTM3D(nn.Module):
         self.drop_path_rate = drop_path_rate
         self.drop_path_decay = drop_path_decay
 
+        # causal masks and resized pos_embeds shared by all blocks, built once per resolution
+        self.buffer_cache = BufferCache()
+
         # initialize patch_embed
         self.patch_embed = VitPatchEmbed(
             dim=dim,
@@ -683,13 +1026,7 @@ class VisionLSTM3D(nn.Module):
         )
 
         # pos embed
-        self.pos_embed = VitPosEmbed2d(seqlens=self.patch_embed.seqlens, dim=dim)
-
-        # calculate stochastic depth per block
-        if drop_path_decay and drop_path_rate > 0.:
-            dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]
-        else:
-            dpr = [drop_path_rate] * depth
+        self.pos_embed = VitPosEmbed2d(seqlens=self.patch_embed.seqlens, dim=dim, cache=self.buffer_cache)
 
         # directions
         directions = []
@@ -699,8 +1036,19 @@ class VisionLSTM3D(nn.Module):
                     directions.append(SequenceTraversal.ROWWISE_FROM_TOP_LEFT)
                 else:
                     directions.append(SequenceTraversal.ROWWISE_FROM_BOT_RIGHT)
+        elif alternation == "bidirectional_batched":
+            # every pair of alternating blocks becomes one block that runs both directions in a single batched call
+            assert depth % 2 == 0, f"alternation '{alternation}' pairs up blocks, depth must be even (got {depth})"
+            directions = [SequenceTraversal.BIDIRECTIONAL] * (depth // 2)
         else:
             raise NotImplementedError(f"invalid alternation '{alternation}'")
+        num_blocks = len(directions)
+
+        # calculate stochastic depth per block
+        if drop_path_decay and drop_path_rate > 0.:
+            dpr = [x.item() for x in torch.linspace(0, drop_path_rate, num_blocks)]
+        else:
+            dpr = [drop_path_rate] * num_blocks
 
         # blocks
         self.blocks = nn.ModuleList(
@@ -709,8 +1057,9 @@ class VisionLSTM3D(nn.Module):
                     dim=dim,
                     drop_path=dpr[i],
                     direction=directions[i],
+                    buffer_cache=self.buffer_cache,
                 )
-                for i in range(depth)
+                for i in range(num_blocks)
             ]
         )
         # LEGACY: only norm after pooling is needed, norm after blocks is not needed but was used for training
@@ -812,6 +1161,9 @@ class VIL3DPatchEncoder(nn.Module):
 
         
 
+        # causal masks shared by all blocks, built once per sequence length
+        self.buffer_cache = BufferCache()
+
         # initialize patch_embed
         self.patch_embed1 = VitPatchEmbed(
             dim=embed_dims[0],
@@ -857,6 +1209,11 @@ class VIL3DPatchEncoder(nn.Module):
                     directions.append(SequenceTraversal.ROWWISE_FROM_TOP_LEFT)
                 else:
                     directions.append(SequenceTraversal.ROWWISE_FROM_BOT_RIGHT)
+        elif alternation == "bidirectional_batched":
+            # VIL3DPatchEncoder / VIL3DPatchEncoder3dconv use one direction per stage (not alternating blocks), so
+            # there are no block pairs to batch (unlike VisionLSTM / VisionLSTM3D, which pair them and halve the
+            # depth); turning every block into a BIDIRECTIONAL one would double the compute
+            raise NotImplementedError(f"alternation '{alternation}' is not supported by {type(self).__name__}")
         else:
             raise NotImplementedError(f"invalid alternation '{alternation}'")
         
@@ -866,6 +1223,7 @@ class VIL3DPatchEncoder(nn.Module):
                     dim=embed_dims[0],
                     drop_path=dpr[cur+i],
                     direction=directions[0],
+                    buffer_cache=self.buffer_cache,
                 )
             for i in range(depths[0])])
         self.norm1 = LayerNorm(embed_dims[0])
@@ -876,6 +1234,7 @@ class VIL3DPatchEncoder(nn.Module):
                     dim=embed_dims[1],
                     drop_path=dpr[cur+i],
                     direction=directions[1],
+                    buffer_cache=self.buffer_cache,
                 )
             for i in range(depths[1])])
         self.norm2 = LayerNorm(embed_dims[1])
@@ -886,6 +1245,7 @@ class VIL3DPatchEncoder(nn.Module):
                     dim=embed_dims[2],
                     drop_path=dpr[cur+i],
                     direction=directions[2],
+                    buffer_cache=self.buffer_cache,
                 )
             for i in range(depths[2])])
         self.norm3 = LayerNorm(embed_dims[2])
@@ -896,6 +1256,7 @@ class VIL3DPatchEncoder(nn.Module):
                     dim=embed_dims[3],
                     drop_path=dpr[cur+i],
                     direction=directions[3],
+                    buffer_cache=self.buffer_cache,
                 )
             for i in range(depths[3])])
         self.norm4 = LayerNorm(embed_dims[3])
@@ -991,6 +1352,9 @@ class VIL3DPatchEncoder3dconv(nn.Module):
                               padding=patch_size // 2, bias=False)
         self.proj_norm_1 = nn.BatchNorm3d(embed_dim)
 
+        # causal masks shared by all blocks, built once per sequence length
+        self.buffer_cache = BufferCache()
+
         # initialize patch_embed
         self.patch_embed1 = VitPatchEmbed(
             dim=embed_dims[0],
@@ -1036,6 +1400,11 @@ class VIL3DPatchEncoder3dconv(nn.Module):
                     directions.append(SequenceTraversal.ROWWISE_FROM_TOP_LEFT)
                 else:
                     directions.append(SequenceTraversal.ROWWISE_FROM_BOT_RIGHT)
+        elif alternation == "bidirectional_batched":
+            # VIL3DPatchEncoder / VIL3DPatchEncoder3dconv use one direction per stage (not alternating blocks), so
+            # there are no block pairs to batch (unlike VisionLSTM / VisionLSTM3D, which pair them and halve the
+            # depth); turning every block into a BIDIRECTIONAL one would double the compute
+            raise NotImplementedError(f"alternation '{alternation}' is not supported by {type(self).__name__}")
         else:
             raise NotImplementedError(f"invalid alternation '{alternation}'")
         
@@ -1045,6 +1414,7 @@ class VIL3DPatchEncoder3dconv(nn.Module):
                     dim=embed_dims[0],
                     drop_path=dpr[cur+i],
                     direction=directions[0],
+                    buffer_cache=self.buffer_cache,
                 )
             for i in range(depths[0])])
         self.norm1 = LayerNorm(embed_dims[0])
@@ -1055,6 +1425,7 @@ class VIL3DPatchEncoder3dconv(nn.Module):
                     dim=embed_dims[1],
                     drop_path=dpr[cur+i],
                     direction=directions[1],
+                    buffer_cache=self.buffer_cache,
                 )
             for i in range(depths[1])])
         self.norm2 = LayerNorm(embed_dims[1])
@@ -1065,6 +1436,7 @@ class VIL3DPatchEncoder3dconv(nn.Module):
                     dim=embed_dims[2],
                     drop_path=dpr[cur+i],
                     direction=directions[2],
+                    buffer_cache=self.buffer_cache,
                 )
             for i in range(depths[2])])
         self.norm3 = LayerNorm(embed_dims[2])
@@ -1075,6 +1447,7 @@ class VIL3DPatchEncoder3dconv(nn.Module):
                     dim=embed_dims[3],
                     drop_path=dpr[cur+i],
                     direction=directions[3],
+                    buffer_cache=self.buffer_cache,
                 )
             for i in range(depths[3])])
         self.norm4 = LayerNorm(embed_dims[3])
@@ -36,6 +36,76 @@ def interpolate_sincos(embed, seqlens, mode="bicubic"):
     return embed
 
 
+class BufferCache:
+    """
+    Bounded LRU cache for derived tensors that only depend on the input shape, e.g. causal masks and resized position
+    embeddings, keyed by (kind, size, device, dtype). A model creates one instance and hands it to all of its blocks,
+    so each resolution is built once and later requests for it are lookups. hits/misses count the lookups.
+    """
+
+    def __init__(self, maxsize: int = 16):
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, factory):
+        """ Return the entry for key, calling factory() to build it on a miss. """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+        self.misses += 1
+        entry = factory()
+        self._entries[key] = entry
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self._entries), maxsize=self.maxsize)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{k}={v}' for k, v in self.info().items())})"
+
+
+def get_causal_mask(size, device, cache=None):
+    """ (size, size) bool lower triangular matrix, looked up in cache if one is given. """
+    def build():
+        return torch.tril(torch.ones(size, size, dtype=torch.bool, device=device))
+
+    if cache is None:
+        return build()
+    return cache.get(("causal_mask", size, str(device), torch.bool), build)
+
+
+def get_bidirectional_index(size, device, cache=None):
+    """
+    Index [0, ..., size - 1, size - 1, ..., 0]: index_select along the sequence dim of a (B, S, D) tensor followed by a
+    view as (2 * B, S, D) yields every sequence and its reverse as neighbouring batch entries in a single copy.
+    """
+    def build():
+        index = torch.arange(size, device=device)
+        return torch.cat([index, index.flip(0)])
+
+    if cache is None:
+        return build()
+    return cache.get(("bidirectional_index", size, str(device), torch.long), build)
+
+
 # from kappamodules.vit import VitPatchEmbed
 class VitPatchEmbed(nn.Module):
     def __init__(self, dim, num_channels, resolution, patch_size, stride=None, init_weights="xavier_uniform"):
@@ -104,11 +174,12 @@ class VitPatchEmbed(nn.Module):
 
 # from kappamodules.vit import VitPosEmbed2d
 class VitPosEmbed2d(nn.Module):
-    def __init__(self, seqlens, dim: int, allow_interpolation: bool = True):
+    def __init__(self, seqlens, dim: int, allow_interpolation: bool = True, cache: BufferCache = None):
         super().__init__()
         self.seqlens = seqlens
         self.dim = dim
         self.allow_interpolation = allow_interpolation
+        self.cache = cache
         self.embed = nn.Parameter(torch.zeros(1, *seqlens, dim))
         self.reset_parameters()
 
@@ -123,7 +194,14 @@ class VitPosEmbed2d(nn.Module):
         assert x.ndim == self._expected_x_ndim
         if x.shape[1:] != self.embed.shape[1:]:
             assert self.allow_interpolation
-            embed = interpolate_sincos(embed=self.embed, seqlens=x.shape[1:-1])
+            seqlens = tuple(x.shape[1:-1])
+            if self.cache is None or (torch.is_grad_enabled() and self.embed.requires_grad):
+                # while training the interpolation has to stay in the autograd graph
+                embed = interpolate_sincos(embed=self.embed, seqlens=seqlens)
+            else:
+                # _version is bumped by every in-place update of the parameter (optimizer step, load_state_dict)
+                key = ("pos_embed", id(self), self.embed._version, seqlens, str(self.embed.device), self.embed.dtype)
+                embed = self.cache.get(key, lambda: interpolate_sincos(embed=self.embed, seqlens=seqlens))
         else:
             embed = self.embed
         return x + embed
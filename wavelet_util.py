@@ -0,0 +1,117 @@
+"""
+Shared wavelet code of WTConv2d (both copies of the ECCV2024 WTConv file) and WFEConv.
+
+create_wavelet_filter builds the 2D analysis / synthesis filter banks from 1D scaling filters that are hard-coded for
+the standard orthogonal wavelets (haar/db1, db2, db3), so pywt is only imported for other wavelets; the banks are
+cached per (wave, dtype). wavelet_pyramid runs the whole multi-level WTConv branch (DWT, scaled depthwise conv,
+inverse DWT) with one stored tensor per level.
+"""
+import functools
+
+import torch
+import torch.nn.functional as F
+
+# reconstruction low-pass (scaling) filters, the values pywt uses
+_SCALING_FILTERS = {
+    'haar': (0.7071067811865476, 0.7071067811865476),
+    'db1': (0.7071067811865476, 0.7071067811865476),
+    'db2': (0.48296291314469025, 0.836516303737469, 0.22414386804185735, -0.12940952255092145),
+    'db3': (0.3326705529509569, 0.8068915093133388, 0.4598775021193313, -0.13501102001039084,
+            -0.08544127388224149, 0.035226291882100656),
+}
+
+
+def _wavelet_filters_1d(wave):
+    """ (dec_lo, dec_hi, rec_lo, rec_hi) as in pywt.Wavelet(wave). """
+    rec_lo = _SCALING_FILTERS.get(wave)
+    if rec_lo is None:
+        import pywt
+        w = pywt.Wavelet(wave)
+        return w.dec_lo, w.dec_hi, w.rec_lo, w.rec_hi
+    # orthogonal wavelet: quadrature mirror filters of the scaling filter
+    dec_lo = rec_lo[::-1]
+    dec_hi = tuple((-1) ** (k + 1) * h for k, h in enumerate(rec_lo))
+    rec_hi = dec_hi[::-1]
+    return dec_lo, dec_hi, rec_lo, rec_hi
+
+
+def _outer_bank(lo, hi):
+    return torch.stack([lo.unsqueeze(0) * lo.unsqueeze(1),
+                        lo.unsqueeze(0) * hi.unsqueeze(1),
+                        hi.unsqueeze(0) * lo.unsqueeze(1),
+                        hi.unsqueeze(0) * hi.unsqueeze(1)], dim=0)[:, None]
+
+
+@functools.lru_cache(maxsize=16)
+def _filter_bank(wave, dtype):
+    """ Single-channel (4, 1, k, k) decomposition and reconstruction filters. """
+    with torch.inference_mode(False):
+        dec_lo, dec_hi, rec_lo, rec_hi = _wavelet_filters_1d(wave)
+        dec_filters = _outer_bank(torch.tensor(dec_lo[::-1], dtype=dtype), torch.tensor(dec_hi[::-1], dtype=dtype))
+        rec_filters = _outer_bank(torch.tensor(rec_lo[::-1], dtype=dtype).flip(dims=[0]),
+                                  torch.tensor(rec_hi[::-1], dtype=dtype).flip(dims=[0]))
+        return dec_filters, rec_filters
+
+
+def create_wavelet_filter(wave, in_size, out_size, type=torch.float):
+    dec_filters, rec_filters = _filter_bank(wave, type)
+    # repeat copies, so the cached bank is never shared with (and modified through) a module parameter
+    return dec_filters.repeat(in_size, 1, 1, 1), rec_filters.repeat(out_size, 1, 1, 1)
+
+
+def wavelet_transform(x, filters):
+    b, c, h, w = x.shape
+    pad = (filters.shape[2] // 2 - 1, filters.shape[3] // 2 - 1)
+    x = F.conv2d(x, filters, stride=2, groups=c, padding=pad)
+    x = x.reshape(b, c, 4, h // 2, w // 2)
+    return x
+
+
+def inverse_wavelet_transform(x, filters):
+    b, c, _, h_half, w_half = x.shape
+    pad = (filters.shape[2] // 2 - 1, filters.shape[3] // 2 - 1)
+    x = x.reshape(b, c * 4, h_half, w_half)
+    x = F.conv_transpose2d(x, filters, stride=2, groups=c, padding=pad)
+    return x
+
+
+def scaled_conv(conv, scale, x):
+    """ scale(conv(x)) with the per-channel scale folded into the kernel and bias (no full-size product). """
+    scale_weight = getattr(scale, 'weight', None)  # nn.Identity after WFEConv.switch_to_deploy()
+    if scale_weight is None:
+        return conv(x)
+    scale_weight = scale_weight.reshape(-1)
+    weight = conv.weight * scale_weight.view(-1, 1, 1, 1)
+    bias = conv.bias * scale_weight if conv.bias is not None else None
+    return conv._conv_forward(x, weight, bias)
+
+
+def wavelet_pyramid(x, wt_filter, iwt_filter, convs, scales):
+    """
+    The multi-level wavelet branch of WTConv: every level takes the DWT of the previous LL band and filters all four
+    bands with scales[i](convs[i](.)); then, coarsest level first, the filtered bands (plus the reconstruction of the
+    coarser level added to their LL band) go through the inverse DWT. Returns the (b, c, h, w) reconstruction, 0
+    without levels.
+
+    Only the filtered (b, c, 4, h_l, w_l) bands are kept per level: the coarser reconstruction is added into their LL
+    band in place instead of being concatenated with the high bands again.
+    """
+    levels = []
+    curr_x_ll = x
+    for conv, scale in zip(convs, scales):
+        h, w = curr_x_ll.shape[2:]
+        if h % 2 > 0 or w % 2 > 0:
+            curr_x_ll = F.pad(curr_x_ll, (0, w % 2, 0, h % 2))
+        curr_x = wavelet_transform(curr_x_ll, wt_filter)
+        curr_x_ll = curr_x[:, :, 0, :, :]
+
+        b, c, _, h_half, w_half = curr_x.shape
+        curr_x_tag = scaled_conv(conv, scale, curr_x.reshape(b, c * 4, h_half, w_half))
+        levels.append((curr_x_tag.view(b, c, 4, h_half, w_half), h, w))
+
+    next_x_ll = 0
+    for curr_x_tag, h, w in reversed(levels):
+        if torch.is_tensor(next_x_ll):
+            curr_x_tag[:, :, 0, :, :] += next_x_ll
+        next_x_ll = inverse_wavelet_transform(curr_x_tag, iwt_filter)[:, :, :h, :w]
+    return next_x_ll
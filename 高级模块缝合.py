@@ -199,9 +199,10 @@ class EMA(nn.Module):
         return (group_x * weights.sigmoid()).reshape(b, c, h, w)
 import torch.nn as nn
 import torch
-from einops import rearrange
 import math
 
+from deform_sampling_util import cached_grid, linear_sample
+
 __all__ = ['AKConv', 'C2f_AKConv']
 
 class AKConv(nn.Module):
@@ -229,41 +230,14 @@ class AKConv(nn.Module):
         N = offset.size(1) // 2
         # (b, 2N, h, w)
         p = self._get_p(offset, dtype)
+        b, _, h, w = p.size()
+
+        # (b, 2, h, N, w): the sampled points come out already stacked in the row direction
+        p = p.reshape(b, 2, N, h, w).transpose(2, 3)
 
-        # (b, h, w, 2N)
-        p = p.contiguous().permute(0, 2, 3, 1)
-        q_lt = p.detach().floor()
-        q_rb = q_lt + 1
-
-        q_lt = torch.cat([torch.clamp(q_lt[..., :N], 0, x.size(2) - 1), torch.clamp(q_lt[..., N:], 0, x.size(3) - 1)],
-                         dim=-1).long()
-        q_rb = torch.cat([torch.clamp(q_rb[..., :N], 0, x.size(2) - 1), torch.clamp(q_rb[..., N:], 0, x.size(3) - 1)],
-                         dim=-1).long()
-        q_lb = torch.cat([q_lt[..., :N], q_rb[..., N:]], dim=-1)
-        q_rt = torch.cat([q_rb[..., :N], q_lt[..., N:]], dim=-1)
-
-        # clip p
-        p = torch.cat([torch.clamp(p[..., :N], 0, x.size(2) - 1), torch.clamp(p[..., N:], 0, x.size(3) - 1)], dim=-1)
-
-        # bilinear kernel (b, h, w, N)
-        g_lt = (1 + (q_lt[..., :N].type_as(p) - p[..., :N])) * (1 + (q_lt[..., N:].type_as(p) - p[..., N:]))
-        g_rb = (1 - (q_rb[..., :N].type_as(p) - p[..., :N])) * (1 - (q_rb[..., N:].type_as(p) - p[..., N:]))
-        g_lb = (1 + (q_lb[..., :N].type_as(p) - p[..., :N])) * (1 - (q_lb[..., N:].type_as(p) - p[..., N:]))
-        g_rt = (1 - (q_rt[..., :N].type_as(p) - p[..., :N])) * (1 + (q_rt[..., N:].type_as(p) - p[..., N:]))
-
-        # resampling the features based on the modified coordinates.
-        x_q_lt = self._get_x_q(x, q_lt, N)
-        x_q_rb = self._get_x_q(x, q_rb, N)
-        x_q_lb = self._get_x_q(x, q_lb, N)
-        x_q_rt = self._get_x_q(x, q_rt, N)
-
-        # bilinear
-        x_offset = g_lt.unsqueeze(dim=1) * x_q_lt + \
-                   g_rb.unsqueeze(dim=1) * x_q_rb + \
-                   g_lb.unsqueeze(dim=1) * x_q_lb + \
-                   g_rt.unsqueeze(dim=1) * x_q_rt
-
-        x_offset = self._reshape_x_offset(x_offset, self.num_param)
+        # resampling the features based on the modified coordinates, bilinear over the four corners of all
+        # N points in one gather: (b, c, h, N, w) -> (b, c, h*N, w)
+        x_offset = linear_sample(x, p).reshape(b, x.size(1), h * N, w)
         out = self.conv(x_offset)
 
         return out
@@ -305,46 +279,14 @@ class AKConv(nn.Module):
     def _get_p(self, offset, dtype):
         N, h, w = offset.size(1) // 2, offset.size(2), offset.size(3)
 
-        # (1, 2N, 1, 1)
-        p_n = self._get_p_n(N, dtype)
-        # (1, 2N, h, w)
-        p_0 = self._get_p_0(h, w, N, dtype)
-        p = p_0 + p_n + offset
+        # (1, 2N, h, w) = p_0 + p_n, built once per (h, w, stride, N, device, dtype)
+        p_base = cached_grid(
+            (type(self), h, w, self.stride, N, offset.device, dtype),
+            lambda: (self._get_p_0(h, w, N, dtype) + self._get_p_n(N, dtype)).to(offset.device),
+        )
+        p = p_base + offset
         return p
 
-    def _get_x_q(self, x, q, N):
-        b, h, w, _ = q.size()
-        padded_w = x.size(3)
-        c = x.size(1)
-        # (b, c, h*w)
-        x = x.contiguous().view(b, c, -1)
-
-        # (b, h, w, N)
-        index = q[..., :N] * padded_w + q[..., N:]  # offset_x*w + offset_y
-        # (b, c, h*w*N)
-
-        index = index.contiguous().unsqueeze(dim=1).expand(-1, c, -1, -1, -1).contiguous().view(b, c, -1)
-
-        # 根据实际情况调整
-        index = index.clamp(min=0, max=x.shape[-1] - 1)
-
-        x_offset = x.gather(dim=-1, index=index).contiguous().view(b, c, h, w, N)
-
-        return x_offset
-
-    #  Stacking resampled features in the row direction.
-    @staticmethod
-    def _reshape_x_offset(x_offset, num_param):
-        b, c, h, w, n = x_offset.size()
-        # using Conv3d
-        # x_offset = x_offset.permute(0,1,4,2,3), then Conv3d(c,c_out, kernel_size =(num_param,1,1),stride=(num_param,1,1),bias= False)
-        # using 1 × 1 Conv
-        # x_offset = x_offset.permute(0,1,4,2,3), then, x_offset.view(b,c×num_param,h,w)  finally, Conv2d(c×num_param,c_out, kernel_size =1,stride=1,bias= False)
-        # using the column conv as follow， then, Conv2d(inc, outc, kernel_size=(num_param, 1), stride=(num_param, 1), bias=bias)
-
-        x_offset = rearrange(x_offset, 'b c h w n -> b c (h n) w')
-        return x_offset
-
 def autopad(k, p=None, d=1):  # kernel, padding, dilation
     """Pad to 'same' shape outputs."""
     if d > 1:
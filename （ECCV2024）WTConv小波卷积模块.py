@@ -1,9 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from functools import partial
-import pywt
-import pywt.data
+from wavelet_util import create_wavelet_filter, scaled_conv, wavelet_pyramid
 
 '''
 近年来，研究者尝试通过增加卷积神经网络（CNNs）的卷积核大小来模拟视觉变压器（ViTs）
@@ -21,39 +19,6 @@ import pywt.data
 
 '''
 
-def create_wavelet_filter(wave, in_size, out_size, type=torch.float):
-    w = pywt.Wavelet(wave)
-    dec_hi = torch.tensor(w.dec_hi[::-1], dtype=type)
-    dec_lo = torch.tensor(w.dec_lo[::-1], dtype=type)
-    dec_filters = torch.stack([dec_lo.unsqueeze(0) * dec_lo.unsqueeze(1),
-                               dec_lo.unsqueeze(0) * dec_hi.unsqueeze(1),
-                               dec_hi.unsqueeze(0) * dec_lo.unsqueeze(1),
-                               dec_hi.unsqueeze(0) * dec_hi.unsqueeze(1)], dim=0)
-
-    dec_filters = dec_filters[:, None].repeat(in_size, 1, 1, 1)
-
-    rec_hi = torch.tensor(w.rec_hi[::-1], dtype=type).flip(dims=[0])
-    rec_lo = torch.tensor(w.rec_lo[::-1], dtype=type).flip(dims=[0])
-    rec_filters = torch.stack([rec_lo.unsqueeze(0) * rec_lo.unsqueeze(1),
-                               rec_lo.unsqueeze(0) * rec_hi.unsqueeze(1),
-                               rec_hi.unsqueeze(0) * rec_lo.unsqueeze(1),
-                               rec_hi.unsqueeze(0) * rec_hi.unsqueeze(1)], dim=0)
-
-    rec_filters = rec_filters[:, None].repeat(out_size, 1, 1, 1)
-
-    return dec_filters, rec_filters
-def wavelet_transform(x, filters):
-    b, c, h, w = x.shape
-    pad = (filters.shape[2] // 2 - 1, filters.shape[3] // 2 - 1)
-    x = F.conv2d(x, filters, stride=2, groups=c, padding=pad)
-    x = x.reshape(b, c, 4, h // 2, w // 2)
-    return x
-def inverse_wavelet_transform(x, filters):
-    b, c, _, h_half, w_half = x.shape
-    pad = (filters.shape[2] // 2 - 1, filters.shape[3] // 2 - 1)
-    x = x.reshape(b, c * 4, h_half, w_half)
-    x = F.conv_transpose2d(x, filters, stride=2, groups=c, padding=pad)
-    return x
 class WTConv2d(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size=5, stride=1, bias=True, wt_levels=1, wt_type='db1'):
         super(WTConv2d, self).__init__()
@@ -69,8 +34,6 @@ class WTConv2d(nn.Module):
         self.wt_filter = nn.Parameter(self.wt_filter, requires_grad=False)
         self.iwt_filter = nn.Parameter(self.iwt_filter, requires_grad=False)
 
-        self.wt_function = partial(wavelet_transform, filters=self.wt_filter)
-        self.iwt_function = partial(inverse_wavelet_transform, filters=self.iwt_filter)
 
         self.base_conv = nn.Conv2d(in_channels, in_channels, kernel_size, padding='same', stride=1, dilation=1,
                                    groups=in_channels, bias=bias)
@@ -92,49 +55,10 @@ class WTConv2d(nn.Module):
             self.do_stride = None
 
     def forward(self, x):
+        # all wavelet levels in one pass, see wavelet_util.wavelet_pyramid
+        x_tag = wavelet_pyramid(x, self.wt_filter, self.iwt_filter, self.wavelet_convs, self.wavelet_scale)
 
-        x_ll_in_levels = []
-        x_h_in_levels = []
-        shapes_in_levels = []
-
-        curr_x_ll = x
-
-        for i in range(self.wt_levels):
-            curr_shape = curr_x_ll.shape
-            shapes_in_levels.append(curr_shape)
-            if (curr_shape[2] % 2 > 0) or (curr_shape[3] % 2 > 0):
-                curr_pads = (0, curr_shape[3] % 2, 0, curr_shape[2] % 2)
-                curr_x_ll = F.pad(curr_x_ll, curr_pads)
-
-            curr_x = self.wt_function(curr_x_ll)
-            curr_x_ll = curr_x[:, :, 0, :, :]
-
-            shape_x = curr_x.shape
-            curr_x_tag = curr_x.reshape(shape_x[0], shape_x[1] * 4, shape_x[3], shape_x[4])
-            curr_x_tag = self.wavelet_scale[i](self.wavelet_convs[i](curr_x_tag))
-            curr_x_tag = curr_x_tag.reshape(shape_x)
-
-            x_ll_in_levels.append(curr_x_tag[:, :, 0, :, :])
-            x_h_in_levels.append(curr_x_tag[:, :, 1:4, :, :])
-
-        next_x_ll = 0
-
-        for i in range(self.wt_levels - 1, -1, -1):
-            curr_x_ll = x_ll_in_levels.pop()
-            curr_x_h = x_h_in_levels.pop()
-            curr_shape = shapes_in_levels.pop()
-
-            curr_x_ll = curr_x_ll + next_x_ll
-
-            curr_x = torch.cat([curr_x_ll.unsqueeze(2), curr_x_h], dim=2)
-            next_x_ll = self.iwt_function(curr_x)
-
-            next_x_ll = next_x_ll[:, :, :curr_shape[2], :curr_shape[3]]
-
-        x_tag = next_x_ll
-        assert len(x_ll_in_levels) == 0
-
-        x = self.base_scale(self.base_conv(x))
+        x = scaled_conv(self.base_conv, self.base_scale, x)
         x = x + x_tag
 
         if self.do_stride is not None:
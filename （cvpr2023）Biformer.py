@@ -98,6 +98,110 @@ class QKVLinear(nn.Module):
         # return q, k, v
 
 
+def _routed_regions(key: Tensor, value: Tensor, region_graph: LongTensor, offset: Tensor, i: int):
+    """ Flat region index (bs*nhead*q_nregion,) and the (unweighted) key/value of the i-th routed region. """
+    bs, nhead, q_nregion, _ = region_graph.size()
+    idx = (region_graph[..., i] + offset).flatten()
+    return (idx, key[idx].view(bs, nhead, q_nregion, *key.shape[1:]),
+            value[idx].view(bs, nhead, q_nregion, *value.shape[1:]))
+
+
+class _RoutedAttention(torch.autograd.Function):
+    """
+    Online-softmax attention over the routed regions (see _routed_attention_blockwise). Only the inputs, the output
+    and the per-row logsumexp are saved; backward visits the routed regions again one at a time (flash-attention
+    style), so training also never holds topk gathered copies of key/value or the attention matrix.
+    """
+
+    @staticmethod
+    def forward(ctx, query, key, value, region_graph, r_weight, scale):
+        bs, nhead, q_nregion, topk = region_graph.size()
+        kv_nregion = key.size(2)
+        # offset of every (batch, head) in the flattened region axis
+        offset = torch.arange(bs * nhead, device=region_graph.device).view(bs, nhead, 1) * kv_nregion
+        key_flat = key.reshape(bs * nhead * kv_nregion, *key.shape[3:])
+        value_flat = value.reshape(bs * nhead * kv_nregion, *value.shape[3:])
+        query_s = query * scale
+
+        row_max, row_sum, output = None, None, None
+        for i in range(topk):
+            _, key_i, value_i = _routed_regions(key_flat, value_flat, region_graph, offset, i)
+            if r_weight is not None:
+                weight_i = r_weight[..., i, None, None]
+                key_i, value_i = key_i * weight_i, value_i * weight_i
+            attn = query_s @ key_i.transpose(-1, -2)  # (bs, nhead, q_nregion, q_reg_size, kv_reg_size)
+            attn_max = attn.amax(dim=-1, keepdim=True)
+            if row_max is None:
+                row_max = attn_max
+                attn = torch.exp(attn - row_max)
+                row_sum = attn.sum(dim=-1, keepdim=True)
+                output = attn @ value_i
+            else:
+                new_max = torch.maximum(row_max, attn_max)
+                correction = torch.exp(row_max - new_max)
+                attn = torch.exp(attn - new_max)
+                row_sum = row_sum * correction + attn.sum(dim=-1, keepdim=True)
+                output = output * correction + attn @ value_i
+                row_max = new_max
+        output = output / row_sum
+        ctx.save_for_backward(query, key, value, region_graph, r_weight, output, row_max + torch.log(row_sum))
+        ctx.scale = scale
+        return output
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad):
+        query, key, value, region_graph, r_weight, output, lse = ctx.saved_tensors
+        bs, nhead, q_nregion, topk = region_graph.size()
+        kv_nregion = key.size(2)
+        offset = torch.arange(bs * nhead, device=region_graph.device).view(bs, nhead, 1) * kv_nregion
+        key_flat = key.reshape(bs * nhead * kv_nregion, *key.shape[3:])
+        value_flat = value.reshape(bs * nhead * kv_nregion, *value.shape[3:])
+        query_s = query * ctx.scale
+
+        delta = (grad * output).sum(dim=-1, keepdim=True)
+        grad_query = torch.zeros_like(query_s)
+        grad_key, grad_value = torch.zeros_like(key_flat), torch.zeros_like(value_flat)
+        grad_weight = r_weight.new_zeros(r_weight.shape) if r_weight is not None and ctx.needs_input_grad[4] else None
+        for i in range(topk):
+            idx, key_i, value_i = _routed_regions(key_flat, value_flat, region_graph, offset, i)
+            key_w, value_w = key_i, value_i
+            if r_weight is not None:
+                weight_i = r_weight[..., i, None, None]
+                key_w, value_w = key_i * weight_i, value_i * weight_i
+            prob = torch.exp(query_s @ key_w.transpose(-1, -2) - lse)
+            d_value = prob.transpose(-1, -2) @ grad
+            d_attn = prob * (grad @ value_w.transpose(-1, -2) - delta)
+            grad_query += d_attn @ key_w
+            d_key = d_attn.transpose(-1, -2) @ query_s
+            if r_weight is not None:
+                if grad_weight is not None:
+                    grad_weight[..., i] = (d_key * key_i).sum(dim=(-1, -2)) + (d_value * value_i).sum(dim=(-1, -2))
+                d_key, d_value = d_key * weight_i, d_value * weight_i
+            grad_key.index_add_(0, idx, d_key.reshape(-1, *key_flat.shape[1:]))
+            grad_value.index_add_(0, idx, d_value.reshape(-1, *value_flat.shape[1:]))
+        return grad_query * ctx.scale, grad_key.view_as(key), grad_value.view_as(value), None, grad_weight, None
+
+
+def _routed_attention_blockwise(query: Tensor, key: Tensor, value: Tensor, scale: float,
+                                region_graph: LongTensor, r_weight: Optional[Tensor] = None) -> Tensor:
+    """
+    Token-to-token attention over the routed regions without materialising the topk-times duplicated key/value
+    tensor: the routed regions are visited one after another (one indexed region per query region at a time) and
+    combined with an online softmax, so the peak is one copy of key/value instead of topk copies. The custom
+    backward recomputes the routed regions instead of saving them, so this holds for training as well.
+
+    Args:
+        query: (bs, nhead, q_nregion, q_reg_size, head_dim) tensor
+        key, value: (bs, nhead, kv_nregion, kv_reg_size, head_dim) tensor
+        region_graph: (bs, nhead, q_nregion, topk) tensor
+        r_weight: optional (bs, nhead, q_nregion, topk) tensor, soft routing weights applied to the routed key/value
+    Return:
+        output: (bs, nhead, q_nregion, q_reg_size, head_dim) tensor
+    """
+    return _RoutedAttention.apply(query, key, value, region_graph, r_weight, scale)
+
+
 class BiLevelRoutingAttention(nn.Module):
     """
     n_win: number of windows in one side (so the actual number of windows is n_win*n_win)
@@ -107,14 +211,19 @@ class BiLevelRoutingAttention(nn.Module):
     param_routing: extra linear for routing
     diff_routing: wether to set routing differentiable
     soft_routing: wether to multiply soft routing weights
+    attn_backend: 'torch' gathers the topk key/value windows (topk copies of kv), 'blockwise' attends to the routed
+        windows one by one with an online softmax (one copy of kv, no attention matrix for ret_attn_mask)
     """
 
     def __init__(self, dim, n_win=7, num_heads=8, qk_dim=None, qk_scale=None,
                  kv_per_win=4, kv_downsample_ratio=4, kv_downsample_kernel=None, kv_downsample_mode='identity',
                  topk=4, param_attention="qkvo", param_routing=False, diff_routing=False, soft_routing=False,
                  side_dwconv=3,
-                 auto_pad=True):
+                 auto_pad=True, attn_backend='torch'):
         super().__init__()
+        if attn_backend not in ('torch', 'blockwise'):
+            raise ValueError(f'attn_backend {attn_backend} is not surpported!')
+        self.attn_backend = attn_backend
         # local attention setting
         self.dim = dim
         self.n_win = n_win  # Wh, Ww
@@ -249,6 +358,23 @@ class BiLevelRoutingAttention(nn.Module):
 
         r_weight, r_idx = self.router(q_win, k_win)  # both are (n, p^2, topk) tensors
 
+        if self.attn_backend == 'blockwise':
+            if self.kv_gather.mul_weight == 'hard':
+                raise NotImplementedError('differentiable hard routing TBA')
+            out = _routed_attention_blockwise(
+                query=rearrange(q_pix, 'n p2 w2 (m c) -> n m p2 w2 c', m=self.num_heads),
+                key=rearrange(kv_pix[..., :self.qk_dim], 'n p2 w2 (m c) -> n m p2 w2 c', m=self.num_heads),
+                value=rearrange(kv_pix[..., self.qk_dim:], 'n p2 w2 (m c) -> n m p2 w2 c', m=self.num_heads),
+                scale=self.scale,
+                region_graph=r_idx.unsqueeze(1).expand(-1, self.num_heads, -1, -1),
+                r_weight=r_weight.unsqueeze(1).expand(-1, self.num_heads, -1, -1)
+                if self.kv_gather.mul_weight == 'soft' else None,
+            )  # (n, m, p^2, w^2, c_v//m)
+            out = rearrange(out, 'n m (j i) (h w) c -> n (j h) (i w) (m c)', j=self.n_win, i=self.n_win,
+                            h=H // self.n_win, w=W // self.n_win)
+            return self._output(out, lepe, H_in if self.auto_pad else H, W_in if self.auto_pad else W,
+                                ret_attn_mask, r_weight, r_idx, None)
+
         kv_pix_sel = self.kv_gather(r_idx=r_idx, r_weight=r_weight, kv=kv_pix)  # (n, p^2, topk, h_kv*w_kv, c_qk+c_v)
         k_pix_sel, v_pix_sel = kv_pix_sel.split([self.qk_dim, self.dim], dim=-1)
         # kv_pix_sel: (n, p^2, topk, h_kv*w_kv, c_qk)
@@ -269,14 +395,17 @@ class BiLevelRoutingAttention(nn.Module):
         out = attn_weight @ v_pix_sel  # (n*p^2, m, w^2, topk*h_kv*w_kv) @ (n*p^2, m, topk*h_kv*w_kv, c) -> (n*p^2, m, w^2, c)
         out = rearrange(out, '(n j i) m (h w) c -> n (j h) (i w) (m c)', j=self.n_win, i=self.n_win,
                         h=H // self.n_win, w=W // self.n_win)
+        return self._output(out, lepe, H_in if self.auto_pad else H, W_in if self.auto_pad else W,
+                            ret_attn_mask, r_weight, r_idx, attn_weight)
 
+    def _output(self, out, lepe, H_in, W_in, ret_attn_mask, r_weight, r_idx, attn_weight):
         out = out + lepe
         # output linear
         out = self.wo(out)
 
         # NOTE: use padding for semantic segmentation
         # crop padded region
-        if self.auto_pad and (pad_r > 0 or pad_b > 0):
+        if out.size(1) != H_in or out.size(2) != W_in:
             out = out[:, :H_in, :W_in, :].contiguous()
 
         if ret_attn_mask:
@@ -488,6 +617,51 @@ def regional_routing_attention_torch(
     return output, attn
 
 
+def regional_routing_attention_blockwise(
+        query: Tensor, key: Tensor, value: Tensor, scale: float,
+        region_graph: LongTensor, region_size: Tuple[int],
+        kv_region_size: Optional[Tuple[int]] = None,
+        auto_pad=True) -> Tensor:
+    """
+    Same interface and result as regional_routing_attention_torch, but without gathering the topk key/value regions
+    (see _routed_attention_blockwise). The attention matrix is never formed as a whole, so None is returned for it.
+    """
+    kv_region_size = kv_region_size or region_size
+
+    # Auto pad to deal with any input size
+    q_pad_b, q_pad_r = 0, 0
+    if auto_pad:
+        _, _, Hq, Wq = query.size()
+        q_pad_b = (region_size[0] - Hq % region_size[0]) % region_size[0]
+        q_pad_r = (region_size[1] - Wq % region_size[1]) % region_size[1]
+        if (q_pad_b > 0 or q_pad_r > 0):
+            query = F.pad(query, (0, q_pad_r, 0, q_pad_b))  # zero padding
+
+        _, _, Hk, Wk = key.size()
+        kv_pad_b = (kv_region_size[0] - Hk % kv_region_size[0]) % kv_region_size[0]
+        kv_pad_r = (kv_region_size[1] - Wk % kv_region_size[1]) % kv_region_size[1]
+        if (kv_pad_r > 0 or kv_pad_b > 0):
+            key = F.pad(key, (0, kv_pad_r, 0, kv_pad_b))  # zero padding
+            value = F.pad(value, (0, kv_pad_r, 0, kv_pad_b))  # zero padding
+
+    # to sequence format, i.e. (bs, nhead, nregion, reg_size, head_dim)
+    nhead = region_graph.size(1)
+    query, q_region_h, q_region_w = _grid2seq(query, region_size=region_size, num_heads=nhead)
+    key, _, _ = _grid2seq(key, region_size=kv_region_size, num_heads=nhead)
+    value, _, _ = _grid2seq(value, region_size=kv_region_size, num_heads=nhead)
+
+    output = _routed_attention_blockwise(query, key, value, scale=scale, region_graph=region_graph)
+
+    # to BCHW format
+    output = _seq2grid(output, region_h=q_region_h, region_w=q_region_w, region_size=region_size)
+
+    # remove paddings if needed
+    if auto_pad and (q_pad_b > 0 or q_pad_r > 0):
+        output = output[:, :, :Hq, :Wq]
+
+    return output, None
+
+
 class BiLevelRoutingAttention_nchw(nn.Module):
     """Bi-Level Routing Attention that takes nchw input
 
@@ -529,6 +703,9 @@ class BiLevelRoutingAttention_nchw(nn.Module):
 
         if attn_backend == 'torch':
             self.attn_fn = regional_routing_attention_torch
+        elif attn_backend == 'blockwise':
+            # no topk-times duplicated key/value, attn_mat is None
+            self.attn_fn = regional_routing_attention_blockwise
         else:
             raise ValueError('CUDA implementation is not available yet. Please stay tuned.')
 
@@ -577,3 +754,23 @@ if __name__ == '__main__':
     input = torch.rand(1, 64, 64, 64).cuda()
     output = block(input)
     print(input.size(), output.size())
+
+    # blockwise 后端：前向与反向都不保存 topk 份 key/value，输出与梯度（含软路由权重）和 gather 实现一致
+    bs, nhead, nregion, reg_size, head_dim, topk = 2, 2, 9, 16, 8, 3
+    q, k, v = [torch.randn(bs, nhead, nregion, reg_size, head_dim, requires_grad=True) for _ in range(3)]
+    graph = torch.randint(nregion, (bs, nhead, nregion, topk))
+    w = torch.rand(bs, nhead, nregion, topk, requires_grad=True)
+    offset = torch.arange(bs * nhead).view(bs, nhead, 1, 1) * nregion
+    flat = (graph + offset).flatten()
+    routed_k = (k.reshape(-1, reg_size, head_dim)[flat].view(bs, nhead, nregion, topk, reg_size, head_dim)
+                * w[..., None, None]).flatten(3, 4)
+    routed_v = (v.reshape(-1, reg_size, head_dim)[flat].view(bs, nhead, nregion, topk, reg_size, head_dim)
+                * w[..., None, None]).flatten(3, 4)
+    ref = ((q * head_dim ** -0.5) @ routed_k.transpose(-1, -2)).softmax(dim=-1) @ routed_v
+    out = _routed_attention_blockwise(q, k, v, head_dim ** -0.5, graph, w)
+    grad = torch.randn_like(ref)
+    ref_grads = torch.autograd.grad(ref, (q, k, v, w), grad)
+    out_grads = torch.autograd.grad(out, (q, k, v, w), grad)
+    assert torch.allclose(ref, out, atol=1e-5), (ref - out).abs().max()
+    for g_ref, g in zip(ref_grads, out_grads):
+        assert torch.allclose(g_ref, g, atol=1e-4), (g_ref - g).abs().max()
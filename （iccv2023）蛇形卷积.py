@@ -4,6 +4,8 @@ import numpy as np
 from torch import nn
 import warnings
 
+from deform_sampling_util import cached_grid, linear_sample
+
 warnings.filterwarnings("ignore")
 
 """
@@ -92,6 +94,33 @@ class DSC(object):
         self.num_batch = input_shape[0]
         self.num_channels = input_shape[1]
 
+    def _base_grid(self, device):
+        """
+        Kernel points around every pixel before the deformation: y (dim 2) and x (dim 3) coordinates, [1,K,W,H] each.
+        Built once per (W, H, K, morph, device) and broadcast over the batch.
+        """
+        def build():
+            y_center = torch.arange(0, self.width).float().view(1, 1, self.width, 1)
+            x_center = torch.arange(0, self.height).float().view(1, 1, 1, self.height)
+            """
+            Initialize the kernel and flatten the kernel
+                morph 0: y: only need 0, x: -num_points//2 ~ num_points//2 (Determined by the kernel size)
+                morph 1: y: -num_points//2 ~ num_points//2, x: only need 0
+            """
+            spread = torch.linspace(
+                -int(self.num_points // 2),
+                int(self.num_points // 2),
+                int(self.num_points),
+            ).view(1, self.num_points, 1, 1)
+            zero = torch.zeros_like(spread)
+            y_grid, x_grid = (zero, spread) if self.morph == 0 else (spread, zero)
+            shape = (1, self.num_points, self.width, self.height)
+            y_new = (y_center + y_grid).expand(shape).contiguous().to(device)
+            x_new = (x_center + x_grid).expand(shape).contiguous().to(device)
+            return y_new, x_new
+
+        return cached_grid((DSC, self.width, self.height, self.num_points, self.morph, device), build)
+
     """
     input: offset [B,2*K,W,H]  K: Kernel size (2*K: 2D image, deformation contains <x_offset> and <y_offset>)
     output_x: [B,1,W,K*H]   coordinate map
@@ -101,53 +130,9 @@ class DSC(object):
     def _coordinate_map_3D(self, offset, if_offset):
         # offset
         y_offset, x_offset = torch.split(offset, self.num_points, dim=1)
-
-        y_center = torch.arange(0, self.width).repeat([self.height])
-        y_center = y_center.reshape(self.height, self.width)
-        y_center = y_center.permute(1, 0)
-        y_center = y_center.reshape([-1, self.width, self.height])
-        y_center = y_center.repeat([self.num_points, 1, 1]).float()
-        y_center = y_center.unsqueeze(0)
-
-        x_center = torch.arange(0, self.height).repeat([self.width])
-        x_center = x_center.reshape(self.width, self.height)
-        x_center = x_center.permute(0, 1)
-        x_center = x_center.reshape([-1, self.width, self.height])
-        x_center = x_center.repeat([self.num_points, 1, 1]).float()
-        x_center = x_center.unsqueeze(0)
+        y_new, x_new = self._base_grid(offset.device)  # [1,K,W,H]
 
         if self.morph == 0:
-            """
-            Initialize the kernel and flatten the kernel
-                y: only need 0
-                x: -num_points//2 ~ num_points//2 (Determined by the kernel size)
-                !!! The related PPT will be submitted later, and the PPT will contain the whole changes of each step
-            """
-            y = torch.linspace(0, 0, 1)
-            x = torch.linspace(
-                -int(self.num_points // 2),
-                int(self.num_points // 2),
-                int(self.num_points),
-            )
-
-            y, x = torch.meshgrid(y, x)
-            y_spread = y.reshape(-1, 1)
-            x_spread = x.reshape(-1, 1)
-
-            y_grid = y_spread.repeat([1, self.width * self.height])
-            y_grid = y_grid.reshape([self.num_points, self.width, self.height])
-            y_grid = y_grid.unsqueeze(0)  # [B*K*K, W,H]
-
-            x_grid = x_spread.repeat([1, self.width * self.height])
-            x_grid = x_grid.reshape([self.num_points, self.width, self.height])
-            x_grid = x_grid.unsqueeze(0)  # [B*K*K, W,H]
-
-            y_new = y_center + y_grid
-            x_new = x_center + x_grid
-
-            y_new = y_new.repeat(self.num_batch, 1, 1, 1).to(self.device)
-            x_new = x_new.repeat(self.num_batch, 1, 1, 1).to(self.device)
-
             y_offset_new = y_offset.detach().clone()
 
             if if_offset:
@@ -161,56 +146,18 @@ class DSC(object):
                 for index in range(1, center):
                     y_offset_new[center + index] = (y_offset_new[center + index - 1] + y_offset[center + index])
                     y_offset_new[center - index] = (y_offset_new[center - index + 1] + y_offset[center - index])
-                y_offset_new = y_offset_new.permute(1, 0, 2, 3).to(self.device)
+                y_offset_new = y_offset_new.permute(1, 0, 2, 3)
                 y_new = y_new.add(y_offset_new.mul(self.extend_scope))
 
-            y_new = y_new.reshape(
-                [self.num_batch, self.num_points, 1, self.width, self.height])
-            y_new = y_new.permute(0, 3, 1, 4, 2)
-            y_new = y_new.reshape([
-                self.num_batch, self.num_points * self.width, 1 * self.height
-            ])
-            x_new = x_new.reshape(
-                [self.num_batch, self.num_points, 1, self.width, self.height])
-            x_new = x_new.permute(0, 3, 1, 4, 2)
-            x_new = x_new.reshape([
-                self.num_batch, self.num_points * self.width, 1 * self.height
-            ])
+            # [B,K,W,H] -> [B,W,K,H] -> [B,K*W,H]
+            shape = (self.num_batch, self.num_points, self.width, self.height)
+            y_new = y_new.expand(shape).permute(0, 2, 1, 3).reshape(
+                [self.num_batch, self.num_points * self.width, 1 * self.height])
+            x_new = x_new.expand(shape).permute(0, 2, 1, 3).reshape(
+                [self.num_batch, self.num_points * self.width, 1 * self.height])
             return y_new, x_new
 
         else:
-            """
-            Initialize the kernel and flatten the kernel
-                y: -num_points//2 ~ num_points//2 (Determined by the kernel size)
-                x: only need 0
-            """
-            y = torch.linspace(
-                -int(self.num_points // 2),
-                int(self.num_points // 2),
-                int(self.num_points),
-            )
-            x = torch.linspace(0, 0, 1)
-
-            y, x = torch.meshgrid(y, x)
-            y_spread = y.reshape(-1, 1)
-            x_spread = x.reshape(-1, 1)
-
-            y_grid = y_spread.repeat([1, self.width * self.height])
-            y_grid = y_grid.reshape([self.num_points, self.width, self.height])
-            y_grid = y_grid.unsqueeze(0)
-
-            x_grid = x_spread.repeat([1, self.width * self.height])
-            x_grid = x_grid.reshape([self.num_points, self.width, self.height])
-            x_grid = x_grid.unsqueeze(0)
-
-            y_new = y_center + y_grid
-            x_new = x_center + x_grid
-
-            y_new = y_new.repeat(self.num_batch, 1, 1, 1)
-            x_new = x_new.repeat(self.num_batch, 1, 1, 1)
-
-            y_new = y_new.to(self.device)
-            x_new = x_new.to(self.device)
             x_offset_new = x_offset.detach().clone()
 
             if if_offset:
@@ -221,126 +168,28 @@ class DSC(object):
                 for index in range(1, center):
                     x_offset_new[center + index] = (x_offset_new[center + index - 1] + x_offset[center + index])
                     x_offset_new[center - index] = (x_offset_new[center - index + 1] + x_offset[center - index])
-                x_offset_new = x_offset_new.permute(1, 0, 2, 3).to(self.device)
+                x_offset_new = x_offset_new.permute(1, 0, 2, 3)
                 x_new = x_new.add(x_offset_new.mul(self.extend_scope))
 
-            y_new = y_new.reshape(
-                [self.num_batch, 1, self.num_points, self.width, self.height])
-            y_new = y_new.permute(0, 3, 1, 4, 2)
-            y_new = y_new.reshape([
-                self.num_batch, 1 * self.width, self.num_points * self.height
-            ])
-            x_new = x_new.reshape(
-                [self.num_batch, 1, self.num_points, self.width, self.height])
-            x_new = x_new.permute(0, 3, 1, 4, 2)
-            x_new = x_new.reshape([
-                self.num_batch, 1 * self.width, self.num_points * self.height
-            ])
+            # [B,K,W,H] -> [B,W,H,K] -> [B,W,K*H]
+            shape = (self.num_batch, self.num_points, self.width, self.height)
+            y_new = y_new.expand(shape).permute(0, 2, 3, 1).reshape(
+                [self.num_batch, 1 * self.width, self.num_points * self.height])
+            x_new = x_new.expand(shape).permute(0, 2, 3, 1).reshape(
+                [self.num_batch, 1 * self.width, self.num_points * self.height])
             return y_new, x_new
 
     """
-    input: input feature map [N,C,D,W,H]；coordinate map [N,K*D,K*W,K*H] 
-    output: [N,1,K*D,K*W,K*H]  deformed feature map
+    input: input feature map [N,C,W,H]；coordinate map [N,K*W,H] or [N,W,K*H]
+    output: [N,C,K*W,H] or [N,C,W,K*H]  deformed feature map
     """
 
     def _bilinear_interpolate_3D(self, input_feature, y, x):
-        y = y.reshape([-1]).float()
-        x = x.reshape([-1]).float()
-
-        zero = torch.zeros([]).int()
-        max_y = self.width - 1
-        max_x = self.height - 1
-
-        # find 8 grid locations
-        y0 = torch.floor(y).int()
-        y1 = y0 + 1
-        x0 = torch.floor(x).int()
-        x1 = x0 + 1
-
-        # clip out coordinates exceeding feature map volume
-        y0 = torch.clamp(y0, zero, max_y)
-        y1 = torch.clamp(y1, zero, max_y)
-        x0 = torch.clamp(x0, zero, max_x)
-        x1 = torch.clamp(x1, zero, max_x)
-
-        input_feature_flat = input_feature.flatten()
-        input_feature_flat = input_feature_flat.reshape(
-            self.num_batch, self.num_channels, self.width, self.height)
-        input_feature_flat = input_feature_flat.permute(0, 2, 3, 1)
-        input_feature_flat = input_feature_flat.reshape(-1, self.num_channels)
-        dimension = self.height * self.width
-
-        base = torch.arange(self.num_batch) * dimension
-        base = base.reshape([-1, 1]).float()
-
-        repeat = torch.ones([self.num_points * self.width * self.height
-                             ]).unsqueeze(0)
-        repeat = repeat.float()
-
-        base = torch.matmul(base, repeat)
-        base = base.reshape([-1])
-
-        base = base.to(self.device)
-
-        base_y0 = base + y0 * self.height
-        base_y1 = base + y1 * self.height
-
-        # top rectangle of the neighbourhood volume
-        index_a0 = base_y0 - base + x0
-        index_c0 = base_y0 - base + x1
-
-        # bottom rectangle of the neighbourhood volume
-        index_a1 = base_y1 - base + x0
-        index_c1 = base_y1 - base + x1
-
-        # get 8 grid values
-        value_a0 = input_feature_flat[index_a0.type(torch.int64)].to(self.device)
-        value_c0 = input_feature_flat[index_c0.type(torch.int64)].to(self.device)
-        value_a1 = input_feature_flat[index_a1.type(torch.int64)].to(self.device)
-        value_c1 = input_feature_flat[index_c1.type(torch.int64)].to(self.device)
-
-        # find 8 grid locations
-        y0 = torch.floor(y).int()
-        y1 = y0 + 1
-        x0 = torch.floor(x).int()
-        x1 = x0 + 1
-
-        # clip out coordinates exceeding feature map volume
-        y0 = torch.clamp(y0, zero, max_y + 1)
-        y1 = torch.clamp(y1, zero, max_y + 1)
-        x0 = torch.clamp(x0, zero, max_x + 1)
-        x1 = torch.clamp(x1, zero, max_x + 1)
-
-        x0_float = x0.float()
-        x1_float = x1.float()
-        y0_float = y0.float()
-        y1_float = y1.float()
-
-        vol_a0 = ((y1_float - y) * (x1_float - x)).unsqueeze(-1).to(self.device)
-        vol_c0 = ((y1_float - y) * (x - x0_float)).unsqueeze(-1).to(self.device)
-        vol_a1 = ((y - y0_float) * (x1_float - x)).unsqueeze(-1).to(self.device)
-        vol_c1 = ((y - y0_float) * (x - x0_float)).unsqueeze(-1).to(self.device)
-
-        outputs = (value_a0 * vol_a0 + value_c0 * vol_c0 + value_a1 * vol_a1 +
-                   value_c1 * vol_c1)
-
-        if self.morph == 0:
-            outputs = outputs.reshape([
-                self.num_batch,
-                self.num_points * self.width,
-                1 * self.height,
-                self.num_channels,
-            ])
-            outputs = outputs.permute(0, 3, 1, 2)
-        else:
-            outputs = outputs.reshape([
-                self.num_batch,
-                1 * self.width,
-                self.num_points * self.height,
-                self.num_channels,
-            ])
-            outputs = outputs.permute(0, 3, 1, 2)
-        return outputs
+        # the 4 neighbours of all sample points in one gather (shared engine, see deform_sampling_util).
+        # Behaviour change (bug fix): the original flat index was base_y0 - base + x0, which dropped the batch offset,
+        # so every batch element sampled the features of batch element 0. Each element now samples its own features;
+        # outputs are unchanged for B == 1 and differ from the old implementation for B > 1.
+        return linear_sample(input_feature, torch.stack([y, x], dim=1).float(), clamp_positions=False)
 
     def deform_conv(self, input, offset, if_offset):
         y, x = self._coordinate_map_3D(offset, if_offset)
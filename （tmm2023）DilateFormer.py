@@ -1,5 +1,8 @@
+import functools
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class DilateAttention(nn.Module):
@@ -30,12 +33,100 @@ class DilateAttention(nn.Module):
         return x
 
 
+@functools.lru_cache(maxsize=32)
+def _neighbour_index(H, W, kernel_size, dilation, device):
+    """
+    Flat index of neighbour j of every pixel in the zero-padded (H + 2P) x (W + 2P) map, per dilation group:
+    (kernel_size ** 2, len(dilation), H * W), in nn.Unfold order (P is the padding of the largest dilation).
+    """
+    with torch.inference_mode(False):
+        dilation = torch.tensor(dilation, device=device)
+        pad = dilation * (kernel_size - 1) // 2
+        P = int(pad.max())
+        taps = torch.arange(kernel_size, device=device)
+        offsets = taps[:, None] * dilation - pad  # (k, num_dilation), same as the unfold padding of each group
+        rows = P + torch.arange(H, device=device)[:, None] + offsets[:, None, :, None, None]  # k, 1, nd, H, 1
+        cols = P + torch.arange(W, device=device)[None, :] + offsets[None, :, :, None, None]  # 1, k, nd, 1, W
+        index = rows * (W + 2 * P) + cols  # k, k, nd, H, W
+        return index.reshape(kernel_size * kernel_size, len(dilation), H * W), P
+
+
+def _tap(t, index):
+    """ Neighbour `index` (num_dilation, N) of every pixel of t (B, num_dilation, c, L): (B, num_dilation, c, N). """
+    return t.gather(3, index.view(1, *index.shape[:1], 1, -1).expand(t.shape[0], -1, t.shape[2], -1))
+
+
+def _untap_(out, grad, index):
+    """ Adjoint of _tap: scatter-add grad (B, num_dilation, c, N) into out (B, num_dilation, c, L) in place. """
+    return out.scatter_add_(3, index.view(1, *index.shape[:1], 1, -1).expand_as(grad), grad)
+
+
+class _NeighbourScores(torch.autograd.Function):
+    """
+    attn[:, :, :, j] = (q * tap(k, j)).sum(head_dim) for every tap j, q (B, nd, heads, head_dim, N) and the padded
+    k (B, nd, C // nd, L). Only q and k are saved: backward gathers / scatters the taps again, so training does not
+    keep k*k gathered copies of k either.
+    """
+
+    @staticmethod
+    def forward(ctx, q, k, index):
+        ctx.save_for_backward(q, k, index)
+        return torch.stack([(q * _tap(k, index[j]).view_as(q)).sum(dim=3) for j in range(index.shape[0])], dim=3)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad):
+        q, k, index = ctx.saved_tensors
+        grad_q = grad_k = None
+        if ctx.needs_input_grad[0]:
+            grad_q = sum(grad[:, :, :, j, None] * _tap(k, index[j]).view_as(q) for j in range(index.shape[0]))
+        if ctx.needs_input_grad[1]:
+            grad_k = torch.zeros_like(k)
+            for j in range(index.shape[0]):
+                _untap_(grad_k, (grad[:, :, :, j, None] * q).flatten(2, 3), index[j])
+        return grad_q, grad_k, None
+
+
+class _NeighbourMix(torch.autograd.Function):
+    """
+    x = sum_j attn[:, :, :, j] * tap(v, j), attn (B, nd, heads, k*k, N) and the padded v (B, nd, C // nd, L), with
+    the taps gathered again in backward (see _NeighbourScores).
+    """
+
+    @staticmethod
+    def forward(ctx, attn, v, index):
+        ctx.save_for_backward(attn, v, index)
+        B, nd, heads, _, N = attn.shape
+        x = 0
+        for j in range(index.shape[0]):
+            x = x + attn[:, :, :, j, None] * _tap(v, index[j]).view(B, nd, heads, -1, N)
+        return x
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad):
+        attn, v, index = ctx.saved_tensors
+        grad_attn = grad_v = None
+        if ctx.needs_input_grad[0]:
+            grad_attn = torch.stack([(grad * _tap(v, index[j]).view_as(grad)).sum(dim=3)
+                                     for j in range(index.shape[0])], dim=3)
+        if ctx.needs_input_grad[1]:
+            grad_v = torch.zeros_like(v)
+            for j in range(index.shape[0]):
+                _untap_(grad_v, (attn[:, :, :, j, None] * grad).flatten(2, 3), index[j])
+        return grad_attn, grad_v, None
+
+
 class MultiDilatelocalAttention(nn.Module):
     "Implementation of Dilate-attention"
 
     def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None,
-                 attn_drop=0., proj_drop=0., kernel_size=3, dilation=[2, 3]):
+                 attn_drop=0., proj_drop=0., kernel_size=3, dilation=[2, 3], impl='gather'):
         super().__init__()
+        assert impl in ('gather', 'unfold')
+        # 'gather': all dilation groups at once, neighbours read one tap at a time by index (no k*k unfolded copies);
+        # 'unfold': the original per-group DilateAttention
+        self.impl = impl
         self.dim = dim
         self.num_heads = num_heads
         head_dim = dim // num_heads
@@ -48,19 +139,39 @@ class MultiDilatelocalAttention(nn.Module):
         self.dilate_attention = nn.ModuleList(
             [DilateAttention(head_dim, qk_scale, attn_drop, kernel_size, dilation[i])
              for i in range(self.num_dilation)])
+        self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
+    def _attention_gather(self, qkv, H, W):
+        # qkv: B, 3C, H, W -> B, H, W, C
+        # Every group attends to its k*k neighbours at its own dilation (zero padding, like nn.Unfold). One tap is
+        # read at a time with a gather over all groups, so only one k/v-sized copy is alive instead of k*k of them;
+        # the custom autograd functions gather the taps again in backward, so this also holds for training.
+        B, C = qkv.shape[0], self.dim
+        num_heads_group = self.num_heads // self.num_dilation
+        head_dim = C // self.num_heads
+        index, P = _neighbour_index(H, W, self.kernel_size, tuple(self.dilation), qkv.device)
+        q = qkv[:, :C].reshape(B, self.num_dilation, num_heads_group, head_dim, H * W) * self.scale
+        kv = F.pad(qkv[:, C:], (P, P, P, P)).reshape(B, 2, self.num_dilation, C // self.num_dilation, -1)
+        k, v = kv[:, 0], kv[:, 1]
+        attn = _NeighbourScores.apply(q, k, index)
+        attn = attn.softmax(dim=3)  # B, num_dilation, heads per group, k*k, H*W
+        attn = self.attn_drop(attn)
+        x = _NeighbourMix.apply(attn, v, index)  # B, num_dilation, heads per group, head_dim, H*W
+        return x.reshape(B, C, H * W).transpose(1, 2).reshape(B, H, W, C)
+
     def forward(self, x):
         B, H, W, C = x.shape
         x = x.permute(0, 3, 1, 2)  # B, C, H, W
-        qkv = self.qkv(x).reshape(B, 3, self.num_dilation, C // self.num_dilation, H, W).permute(2, 1, 0, 3, 4, 5)
-        # num_dilation,3,B,C//num_dilation,H,W
-        x = x.reshape(B, self.num_dilation, C // self.num_dilation, H, W).permute(1, 0, 3, 4, 2)
-        # num_dilation, B, H, W, C//num_dilation
-        for i in range(self.num_dilation):
-            x[i] = self.dilate_attention[i](qkv[i][0], qkv[i][1], qkv[i][2])  # B, H, W,C//num_dilation
-        x = x.permute(1, 2, 3, 0, 4).reshape(B, H, W, C)
+        if self.impl == 'gather':
+            x = self._attention_gather(self.qkv(x), H, W)
+        else:
+            qkv = self.qkv(x).reshape(B, 3, self.num_dilation, C // self.num_dilation, H, W).permute(2, 1, 0, 3, 4, 5)
+            # num_dilation,3,B,C//num_dilation,H,W
+            x = torch.stack([self.dilate_attention[i](qkv[i][0], qkv[i][1], qkv[i][2])  # B, H, W,C//num_dilation
+                             for i in range(self.num_dilation)], dim=3)
+            x = x.reshape(B, H, W, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -68,7 +179,28 @@ class MultiDilatelocalAttention(nn.Module):
 
 #  输入 N C H W,  输出 N C H W
 if __name__ == "__main__":
-    x = torch.rand([3, 64, 64, 64]).cuda()
-    m = MultiDilatelocalAttention(64).cuda()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    x = torch.rand([3, 64, 64, 64]).to(device)
+    m = MultiDilatelocalAttention(64).to(device)
     y = m(x)
     print(y.shape)
+
+    # gather 实现与原始 unfold 实现结果一致，且支持任意 H/W
+    x = torch.rand([2, 29, 45, 64]).to(device)
+    with torch.no_grad():
+        y = m(x)
+        m.impl = 'unfold'
+        y_ref = m(x)
+    assert torch.allclose(y, y_ref, rtol=1e-4, atol=1e-5), (y - y_ref).abs().max()
+
+    # 训练时反向传播中重新 gather 邻居，梯度与 unfold 实现一致
+    x.requires_grad_(True)
+    grads = []
+    for impl in ('gather', 'unfold'):
+        m.impl = impl
+        x.grad = None
+        m.zero_grad()
+        m(x).square().sum().backward()
+        grads.append((x.grad.clone(), m.qkv.weight.grad.clone()))
+    for g, g_ref in zip(*grads):
+        assert torch.allclose(g, g_ref, rtol=1e-4, atol=1e-4), (g - g_ref).abs().max()